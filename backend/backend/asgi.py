@@ -2,6 +2,8 @@
 ASGI config for backend project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+HTTP requests go to Django as usual; WebSocket connections on /ws/chat/
+are handled by the real-time chat socket in base/consumers.py.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/5.1/howto/deployment/asgi/
@@ -13,4 +15,25 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
 
-application = get_asgi_application()
+# Django трябва да е инициализиран преди да се импортират модулите на приложението
+django_application = get_asgi_application()
+
+from base.consumers import chat_socket  # noqa: E402
+
+# WebSocket маршрути
+websocket_routes = {
+    '/ws/chat/': chat_socket,
+}
+
+
+async def application(scope, receive, send):
+    """Routes WebSocket connections to their handlers and everything else to Django"""
+    if scope['type'] == 'websocket':
+        handler = websocket_routes.get(scope['path'])
+        if handler is None:
+            # Непознат път - отказва връзката
+            await receive()
+            await send({'type': 'websocket.close'})
+            return
+        return await handler(scope, receive, send)
+    return await django_application(scope, receive, send)
@@ -98,6 +98,25 @@ CORS_ALLOW_ALL_ORIGINS = True
 # Разрешава изпращане на credentials (cookies, auth headers) при CORS заявки
 CORS_ALLOW_CREDENTIALS = True
 
+# Слой за разпращане на чат събития в реално време (WebSocket)
+# InMemoryBroadcast работи само в рамките на един процес
+CHAT_BROADCAST_BACKEND = 'base.realtime.InMemoryBroadcast'
+
+# Максимално време (в секунди), за което long-poll заявка чака нови съобщения
+CHAT_LONG_POLL_MAX_TIMEOUT = 30
+
+# Максимален размер на прикачен файл в чата (в байтове)
+CHAT_ATTACHMENT_MAX_SIZE = 10 * 1024 * 1024
+
+# Валидност (в секунди) на подписаната форма за директно качване в S3
+CHAT_UPLOAD_URL_EXPIRES = 600
+
+# Нишки за генериране на умалени копия на изображенията (0 - веднага, в заявката)
+MEDIA_DERIVATIVE_WORKERS = 2
+
+# Формати на умалените копия; първият е за полета с един URL (AVIF само ако Pillow го поддържа)
+MEDIA_DERIVATIVE_FORMATS = ['webp', 'avif']
+
 # Base URL for the API (used for media files and links)
 BASE_URL = 'http://16.171.182.216'
 
@@ -183,6 +202,14 @@ DEFAULT_FROM_EMAIL = 'Q-up Support qupbot@gmail.com'
 # Време за валидност на линка за възстановяване на парола (в секунди)
 PASSWORD_RESET_TIMEOUT = 3600
 
+# Оценка за съвместимост на съотборници (base/matching.py)
+# Тегла на частите на оценката - липсващите ключове остават по подразбиране
+MATCH_SCORE_WEIGHTS = {}
+# Най-дълго време (в секунди), преди матрицата с характеристики да се построи наново
+MATCH_FEATURES_TTL = 300
+# Най-често (в секунди) преизграждане след промяна на профил или статистика
+MATCH_FEATURES_REFRESH = 30
+
 # Define LOGGING before using it in S3 configuration
 LOGGING = {
     'version': 1,
@@ -257,6 +284,44 @@ if True:  # Enable S3 storage
     AWS_S3_ADDRESSING_STYLE = 'virtual'
     AWS_S3_VERIFY = True
     
+    # Адрес на S3-съвместимо хранилище (напр. MinIO) - празно за AWS
+    AWS_S3_ENDPOINT_URL = os.environ.get('AWS_S3_ENDPOINT_URL') or None
+    
+    # Качване на части: праг, размер на част и брой паралелни части
+    AWS_S3_MULTIPART_THRESHOLD = 8 * 1024 * 1024
+    AWS_S3_MULTIPART_CHUNKSIZE = 8 * 1024 * 1024
+    AWS_S3_MAX_CONCURRENCY = 4
+    
+    # Допълнителна HEAD проверка след всяко качване (изключена - upload_fileobj вече проверява отговора)
+    AWS_S3_VERIFY_UPLOADS = os.environ.get('AWS_S3_VERIFY_UPLOADS', 'False') == 'True'
+    
+    # Общ S3 клиент: размер на пула от връзки, опити при грешка и таймаути (секунди)
+    AWS_S3_MAX_POOL_CONNECTIONS = int(os.environ.get('AWS_S3_MAX_POOL_CONNECTIONS', 50))
+    AWS_S3_MAX_ATTEMPTS = 5
+    AWS_S3_CONNECT_TIMEOUT = 5
+    AWS_S3_READ_TIMEOUT = 60
+    
+    # Качванията в тези папки се пазят по съдържание - еднаквите файлове се качват веднъж (виж MediaBlob)
+    MEDIA_DEDUPLICATE = os.environ.get('MEDIA_DEDUPLICATE', 'True') == 'True'
+    # Прикачените в чата файлове остават извън тях: ключ по съдържание би издал дали даден файл е изпратен в чужд чат
+    MEDIA_CONTENT_ADDRESSED_PREFIXES = (
+        'post_images/', 'profile_pics/',
+        '_derivatives/blobs/', '_derivatives/post_images/', '_derivatives/profile_pics/'
+    )
+    
+    # Изтриването от S3 минава през опашка (MediaDeletion), обработвана от process_media_deletions
+    MEDIA_DELETE_QUEUE = os.environ.get('MEDIA_DELETE_QUEUE', 'True') == 'True'
+    # Опити за изтриване на ключ, преди да се остави за ръчна проверка
+    MEDIA_DELETE_MAX_ATTEMPTS = 8
+    
+    # CDN домейн за медийните файлове (напр. CloudFront) - празно за директни S3 адреси
+    MEDIA_CDN_DOMAIN = os.environ.get('MEDIA_CDN_DOMAIN') or None
+    # Брой кеширани URL адреси на файлове за процес
+    MEDIA_URL_CACHE_SIZE = 10000
+    
+    # Тестова връзка и качване при зареждане на storage_backends (само за отстраняване на проблеми)
+    AWS_S3_DEBUG_ON_STARTUP = os.environ.get('AWS_S3_DEBUG_ON_STARTUP', 'False') == 'True'
+    
     # Ensure clear logging for S3 operations
     LOGGING['loggers']['storages'] = {
         'handlers': ['console'],
@@ -1,18 +1,260 @@
 from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from django.dispatch import receiver
 from storages.backends.s3boto3 import S3Boto3Storage
+from django.utils.encoding import filepath_to_uri
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import ClientError
+import hashlib
 import logging
+import mimetypes
+import threading
+import time
 import traceback
+from collections import OrderedDict
+from urllib.parse import urlencode
 import boto3
 import os
-import io
 
 logger = logging.getLogger(__name__)
 
-class StaticStorage(S3Boto3Storage):
+_s3_client = None
+_s3_client_lock = threading.Lock()
+
+# Брояч на създадените клиенти и извиканите S3 операции
+_s3_metrics = {'clients_created': 0, 'api_calls': 0}
+
+
+def get_s3_client_config():
+    """
+    botocore Config for the shared client: a connection pool big enough for
+    the worker threads plus parallel multipart parts, standard retries with
+    backoff and explicit timeouts instead of botocore's 60 s connect default.
+    """
+    return Config(
+        signature_version='s3v4',
+        max_pool_connections=getattr(settings, 'AWS_S3_MAX_POOL_CONNECTIONS', 50),
+        retries={
+            'max_attempts': getattr(settings, 'AWS_S3_MAX_ATTEMPTS', 5),
+            'mode': 'standard',
+        },
+        connect_timeout=getattr(settings, 'AWS_S3_CONNECT_TIMEOUT', 5),
+        read_timeout=getattr(settings, 'AWS_S3_READ_TIMEOUT', 60),
+        tcp_keepalive=True
+    )
+
+
+def _count_api_call(**kwargs):
+    with _s3_client_lock:
+        _s3_metrics['api_calls'] += 1
+
+
+# Общ S3 клиент за процеса
+def get_s3_client():
+    """
+    Returns the boto3 S3 client shared by the whole process. boto3 clients
+    are thread-safe, so every storage path reuses the same credentials,
+    endpoint setup and pool of kept-alive connections instead of paying for
+    them per call. AWS_S3_ENDPOINT_URL points it at an S3-compatible stand-in
+    such as MinIO for local development.
+    """
+    global _s3_client
+    if _s3_client is None:
+        with _s3_client_lock:
+            if _s3_client is None:
+                # Отделна сесия - boto3.client() ползва глобалната, която не е thread-safe
+                session = boto3.session.Session(
+                    aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
+                    aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
+                    region_name=settings.AWS_S3_REGION_NAME
+                )
+                client = session.client(
+                    's3',
+                    endpoint_url=getattr(settings, 'AWS_S3_ENDPOINT_URL', None),
+                    verify=getattr(settings, 'AWS_S3_VERIFY', True),
+                    config=get_s3_client_config()
+                )
+                client.meta.events.register('after-call.s3', _count_api_call)
+                _s3_metrics['clients_created'] += 1
+                _s3_client = client
+    return _s3_client
+
+
+# Статистика за повторно използване на връзките
+def get_s3_metrics():
+    """
+    Returns counters for the shared client: API calls made, HTTP requests
+    sent and TCP/TLS connections opened. A healthy pool opens far fewer
+    connections than it sends requests (connection_reuse close to 1).
+    """
+    with _s3_client_lock:
+        metrics = dict(_s3_metrics)
+        client = _s3_client
+
+    requests = connections = 0
+    if client is not None:
+        try:
+            # urllib3 пази брояч на заявки и отворени връзки във всеки пул
+            http_session = client._endpoint.http_session
+            managers = [http_session._manager] + list(http_session._proxy_managers.values())
+            for manager in managers:
+                for key in list(manager.pools.keys()):
+                    pool = manager.pools.get(key)
+                    if pool is not None:
+                        requests += pool.num_requests
+                        connections += pool.num_connections
+        except AttributeError:
+            logger.debug("Connection pool statistics are not available for this botocore version")
+
+    metrics.update({
+        'http_requests': requests,
+        'connections_opened': connections,
+        'connection_reuse': round(1 - connections / requests, 3) if requests else None,
+        'max_pool_connections': getattr(settings, 'AWS_S3_MAX_POOL_CONNECTIONS', 50),
+    })
+    return metrics
+
+
+@receiver(setting_changed)
+def reset_s3_client(setting, **kwargs):
+    """Drops the shared client and transfer config when AWS settings change (e.g. override_settings in tests)"""
+    global _s3_client, _transfer_config
+    if setting.startswith('AWS_'):
+        with _s3_client_lock:
+            _s3_client = None
+            _transfer_config = None
+
+
+_transfer_config = None
+
+
+# Общи настройки за качване на части (multipart)
+def get_transfer_config():
+    """
+    TransferConfig shared by every upload: files above the threshold go up
+    in chunks of AWS_S3_MULTIPART_CHUNKSIZE, a few at a time.
+    """
+    global _transfer_config
+    if _transfer_config is None:
+        _transfer_config = TransferConfig(
+            multipart_threshold=getattr(settings, 'AWS_S3_MULTIPART_THRESHOLD', 8 * 1024 * 1024),
+            multipart_chunksize=getattr(settings, 'AWS_S3_MULTIPART_CHUNKSIZE', 8 * 1024 * 1024),
+            max_concurrency=getattr(settings, 'AWS_S3_MAX_CONCURRENCY', 4),
+            use_threads=True
+        )
+    return _transfer_config
+
+
+# Ключ в бъкета за име на файл в MediaStorage
+def media_key(name):
+    """Maps a storage-relative file name (as saved on FileFields) to its S3 key"""
+    return f"{MediaStorage.location}/{name.lstrip('/')}"
+
+
+# Подписана форма за директно качване от браузъра
+def create_presigned_upload(name, content_type, max_size, expires_in):
+    """
+    Returns {"url", "fields"} for a browser POST straight to the bucket. The
+    policy pins the key and content type and caps the size, so the client
+    can't upload anything else with it.
+    """
+    return get_s3_client().generate_presigned_post(
+        Bucket=settings.AWS_STORAGE_BUCKET_NAME,
+        Key=media_key(name),
+        Fields={'Content-Type': content_type},
+        Conditions=[
+            {'Content-Type': content_type},
+            ['content-length-range', 1, max_size],
+        ],
+        ExpiresIn=expires_in
+    )
+
+
+# Метаданни на качен файл
+def get_uploaded_object(name):
+    """Returns (size, content_type) of an uploaded file, or None if it isn't in the bucket"""
+    try:
+        response = get_s3_client().head_object(
+            Bucket=settings.AWS_STORAGE_BUCKET_NAME,
+            Key=media_key(name)
+        )
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+            return None
+        raise
+    return response['ContentLength'], response.get('ContentType')
+
+# Ограничен LRU кеш
+class BoundedLRU:
+    """Thread-safe mapping that forgets the least recently used entry beyond maxsize"""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+# Префикс на файловете, адресирани по съдържание
+BLOB_PREFIX = 'blobs/'
+
+
+def content_digest(content):
+    """SHA-256 hex digest and size of a Django File, read in chunks and rewound"""
+    digest = hashlib.sha256()
+    size = 0
+    if hasattr(content, 'seek'):
+        content.seek(0)
+    for chunk in content.chunks():
+        digest.update(chunk)
+        size += len(chunk)
+    if hasattr(content, 'seek'):
+        content.seek(0)
+    return digest.hexdigest(), size
+
+
+class PooledS3Storage(S3Boto3Storage):
+    """
+    S3Boto3Storage with the tuned client config, so the paths still served by
+    django-storages (open, size, listdir) get the same pool, retries and
+    timeouts as the shared client unless AWS_S3_CLIENT_CONFIG overrides them.
+    """
+
+    def __init__(self, **kwargs):
+        if not getattr(settings, 'AWS_S3_CLIENT_CONFIG', None):
+            kwargs.setdefault('client_config', get_s3_client_config())
+        super().__init__(**kwargs)
+
+class StaticStorage(PooledS3Storage):
     location = 'static'
     default_acl = None  # Don't set ACL, rely on bucket policy
 
-class MediaStorage(S3Boto3Storage):
+class MediaStorage(PooledS3Storage):
     location = 'media'
     default_acl = None  # Don't set ACL, rely on bucket policy
     file_overwrite = False
@@ -43,6 +285,19 @@ class MediaStorage(S3Boto3Storage):
             
         return name
     
+    # Дали файлът се пази по съдържание (MEDIA_DEDUPLICATE)
+    def is_content_addressed(self, name):
+        """Uploads under MEDIA_CONTENT_ADDRESSED_PREFIXES are stored once per distinct content"""
+        if not getattr(settings, 'MEDIA_DEDUPLICATE', False):
+            return False
+        return name.startswith(tuple(getattr(settings, 'MEDIA_CONTENT_ADDRESSED_PREFIXES', ())))
+    
+    def get_available_name(self, name, max_length=None):
+        """Content-addressed names come from the content in _save, so no HEAD check for a free name"""
+        if self.is_content_addressed(self._clean_name(name)):
+            return self._clean_name(name)
+        return super().get_available_name(name, max_length)
+    
     def exists(self, name):
         """
         Check if a file exists in S3 storage.
@@ -52,7 +307,7 @@ class MediaStorage(S3Boto3Storage):
             name = self._clean_name(name)
             s3_key = self._normalize_name(name)
             # Actually check if file exists by attempting a HEAD request
-            self.connection.meta.client.head_object(Bucket=self.bucket_name, Key=s3_key)
+            get_s3_client().head_object(Bucket=self.bucket_name, Key=s3_key)
             logger.info(f"S3 exists check: File {name} exists in bucket {self.bucket_name}")
             return True
         except Exception as e:
@@ -60,6 +315,29 @@ class MediaStorage(S3Boto3Storage):
             logger.info(f"S3 exists check: File {name} does not exist in bucket {self.bucket_name} or error: {str(e)}")
             return False
     
+    def delete(self, name):
+        """
+        Deletes a file. Shared content-addressed files only lose one
+        reference; see _delete_object for when the object itself goes.
+        """
+        cleaned_name = self._clean_name(name)
+        if cleaned_name.startswith(BLOB_PREFIX):
+            self._release_blob(cleaned_name)
+            return
+        self._delete_object(self._normalize_name(cleaned_name))
+    
+    def _delete_object(self, s3_key):
+        """
+        With MEDIA_DELETE_QUEUE the key is only queued (base/media_deletion.py)
+        and the request doesn't wait for S3; otherwise it is deleted through
+        the shared client. Deleting a missing key is not an error in S3.
+        """
+        if getattr(settings, 'MEDIA_DELETE_QUEUE', False):
+            from base.media_deletion import enqueue_deletion
+            enqueue_deletion(self.bucket_name, [s3_key])
+            return
+        get_s3_client().delete_object(Bucket=self.bucket_name, Key=s3_key)
+    
     def _normalize_name(self, name):
         """
         Normalize the file name to S3 key format
@@ -73,155 +351,171 @@ class MediaStorage(S3Boto3Storage):
     
     def _save(self, name, content):
         """
-        Save the file to S3 with improved error handling and proper byte content management
+        Streams the file to S3 without copying it into memory first.
+        
+        upload_fileobj reads the Django File in chunks and switches to a
+        multipart upload above the shared transfer config's threshold, so the
+        memory used is a few chunks no matter how large the file is.
+        A HEAD check after the upload only runs with AWS_S3_VERIFY_UPLOADS.
+        With MEDIA_DEDUPLICATE the file is stored by content (see _save_blob).
         """
-        logger.info(f"Attempting to save file to S3: {name}")
+        cleaned_name = self._clean_name(name)
+        s3_key = self._normalize_name(cleaned_name)
+        
+        # Празни файлове не се качват
+        size = getattr(content, 'size', None)
+        if size == 0:
+            logger.error(f"Empty content received for file: {name}")
+            raise ValueError("File content is empty")
+        
+        content_type = getattr(content, 'content_type', None) or \
+            mimetypes.guess_type(name)[0] or 'application/octet-stream'
+        
+        if self.is_content_addressed(cleaned_name):
+            return self._save_blob(cleaned_name, content, content_type)
+        
+        self._upload(s3_key, content, content_type)
+        return cleaned_name
+    
+    def _upload(self, s3_key, content, content_type):
+        """Streams content to s3_key with the shared transfer config"""
+        if hasattr(content, 'seek'):
+            content.seek(0)
+        
+        size = getattr(content, 'size', None)
         try:
-            # Clean and normalize the name first
-            cleaned_name = self._clean_name(name)
-            normalized_name = self._normalize_name(cleaned_name)
-            
-            logger.info(f"Cleaned name: {cleaned_name}, Normalized name: {normalized_name}")
-            
-            # Ensure the content is at the beginning
-            if hasattr(content, 'seek'):
-                content.seek(0)
-            
-            # Get the binary content correctly
-            content_file = content
-            content_bytes = None
-            
-            if hasattr(content, 'read'):
-                try:
-                    content_bytes = content.read()
-                    # If content is empty, log and raise error
-                    if not content_bytes:
-                        logger.error(f"Empty content received for file: {name}")
-                        raise ValueError("File content is empty")
-                    
-                    # Create a new BytesIO object for upload
-                    content_file = io.BytesIO(content_bytes)
-                    
-                except Exception as e:
-                    logger.error(f"Error reading file content for {name}: {str(e)}")
-                    raise
+            s3_client = get_s3_client()
+            s3_client.upload_fileobj(
+                content,
+                self.bucket_name,
+                s3_key,
+                ExtraArgs={'ContentType': content_type},
+                Config=get_transfer_config()
+            )
+            logger.info(f"Uploaded {s3_key} to S3 ({size if size is not None else 'unknown'} bytes, {content_type})")
             
-            # Use direct upload with boto3 for better control
-            try:
-                bucket_name = self.bucket_name
-                s3_key = normalized_name
-                
-                logger.info(f"S3 upload details - Bucket: {bucket_name}, Key: {s3_key}")
-                
-                # Get S3 client with proper config
-                s3_client = boto3.client(
-                    's3',
-                    aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
-                    aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
-                    region_name=settings.AWS_S3_REGION_NAME,
-                    verify=getattr(settings, 'AWS_S3_VERIFY', True)
-                )
-                
-                # Determine content type based on file extension
-                content_type = getattr(content_file, 'content_type', None)
-                if not content_type:
-                    if name.lower().endswith(('.jpg', '.jpeg')):
-                        content_type = 'image/jpeg'
-                    elif name.lower().endswith('.png'):
-                        content_type = 'image/png'
-                    elif name.lower().endswith('.gif'):
-                        content_type = 'image/gif'
-                    else:
-                        content_type = 'application/octet-stream'
-                
-                # Log content type
-                logger.info(f"Content type for {name}: {content_type}")
-                
-                # Prepare for upload without ACL
-                extra_args = {
-                    'ContentType': content_type
-                }
-                
-                # Reset file position
-                content_file.seek(0)
-                
-                # Log upload attempt
-                logger.info(f"Uploading file to S3: {s3_key} (size: {len(content_bytes) if content_bytes else 'unknown'})")
-                
-                # Upload file to S3 using upload_fileobj for more reliable uploads
-                s3_client.upload_fileobj(
-                    content_file,
-                    bucket_name,
-                    s3_key,
-                    ExtraArgs=extra_args
-                )
-                
-                logger.info(f"Successfully uploaded file to S3: {name} -> {s3_key}")
-                
-                # Generate direct S3 URL
-                s3_url = f"https://{bucket_name}.s3.{settings.AWS_S3_REGION_NAME}.amazonaws.com/{s3_key}"
-                logger.info(f"Direct S3 URL: {s3_url}")
-                
-                # Verify upload was successful
-                try:
-                    s3_client.head_object(Bucket=bucket_name, Key=s3_key)
-                    logger.info(f"Verified file exists in S3: {s3_key}")
-                except Exception as e:
-                    logger.error(f"Failed to verify file exists in S3 after upload: {str(e)}")
-                    # Continue anyway since the upload might have been successful
-                
-                return cleaned_name
-            except Exception as e:
-                logger.error(f"Failed to upload file to S3: {name}")
-                logger.error(f"Error: {str(e)}")
-                logger.error(traceback.format_exc())
-                raise
+            if getattr(settings, 'AWS_S3_VERIFY_UPLOADS', False):
+                s3_client.head_object(Bucket=self.bucket_name, Key=s3_key)
         except Exception as e:
-            logger.error(f"Error in _save method for {name}: {str(e)}")
+            logger.error(f"Failed to upload file to S3: {s3_key}: {str(e)}")
             logger.error(traceback.format_exc())
             raise
     
+    # Качване по съдържание - еднаквите файлове се пазят веднъж
+    def _save_blob(self, name, content, content_type):
+        """
+        Stores content under blobs/<sha[:2]>/<sha><ext> and returns that name.
+        If a MediaBlob with the key already exists only its reference count
+        goes up and nothing is uploaded.
+        """
+        from base.models import MediaBlob
+        
+        digest, size = content_digest(content)
+        ext = os.path.splitext(name)[1].lower()
+        key = f"{BLOB_PREFIX}{digest[:2]}/{digest}{ext}"
+        
+        if MediaBlob.objects.filter(key=key).update(ref_count=F('ref_count') + 1, referenced_at=timezone.now()):
+            logger.info(f"Deduplicated {name}: content already stored as {key}")
+            return key
+        
+        if getattr(settings, 'MEDIA_DELETE_QUEUE', False):
+            # Същото съдържание може да чака изтриване от последната си препратка
+            from base.media_deletion import cancel_deletion
+            cancel_deletion(self.bucket_name, self._normalize_name(key))
+        self._upload(self._normalize_name(key), content, content_type)
+        with transaction.atomic():
+            blob, created = MediaBlob.objects.get_or_create(
+                key=key,
+                defaults={'sha256': digest, 'size': size, 'content_type': content_type, 'ref_count': 1}
+            )
+            if not created:
+                # Друга заявка е качила същото съдържание междувременно
+                MediaBlob.objects.filter(pk=blob.pk).update(ref_count=F('ref_count') + 1, referenced_at=timezone.now())
+        return key
+    
+    def _release_blob(self, name):
+        """
+        Drops one reference to a content-addressed file and deletes the object
+        with the last one. The row stays locked until the object is deleted
+        or queued, so a concurrent save of the same content either counts on
+        the row before the delete or uploads the content again after it
+        (cancelling the queued deletion).
+        """
+        from base.models import MediaBlob
+        
+        with transaction.atomic():
+            blob = MediaBlob.objects.select_for_update().filter(key=name).first()
+            if blob is None:
+                logger.warning(f"No reference count for {name}, leaving the object in place")
+                return
+            if blob.ref_count > 1:
+                MediaBlob.objects.filter(pk=blob.pk).update(ref_count=F('ref_count') - 1)
+                return
+            blob.delete()
+            self._delete_object(self._normalize_name(name))
+    
     def url(self, name, **kwargs):
         """
         Returns the URL where the contents of the file can be accessed.
+        
+        Serializers ask for the same avatars and attachments over and over,
+        so computed URLs are kept in a bounded LRU per storage. Signed URLs
+        are cached per expiry window (half of AWS_QUERYSTRING_EXPIRE), so a
+        cached URL always has at least half its lifetime left. Calls with
+        extra arguments (parameters, expire, http_method) are not cached.
         """
-        try:
-            name = self._clean_name(name)
-            s3_key = self._normalize_name(name)
-            
-            # Generate direct URL
-            direct_url = f"https://{self.bucket_name}.s3.{settings.AWS_S3_REGION_NAME}.amazonaws.com/{s3_key}"
-            logger.debug(f"Direct S3 URL for {name}: {direct_url}")
-            
-            return direct_url
-        except Exception as e:
-            logger.error(f"Error generating URL for {name}: {str(e)}")
-            
-            # Return a direct URL as fallback
-            try:
-                # Try to create a basic direct URL as fallback
-                if self.location:
-                    path = f"{self.location}/{name}"
-                else:
-                    path = name
-                
-                direct_url = f"https://{self.bucket_name}.s3.{settings.AWS_S3_REGION_NAME}.amazonaws.com/{path}"
-                logger.info(f"Using direct S3 URL as fallback: {direct_url}")
-                return direct_url
-            except:
-                # If all else fails, return a relative URL
-                return f"/media/{name}"
+        if kwargs:
+            return self._build_url(name, **kwargs)
+        
+        key = name
+        if self.querystring_auth:
+            window = max(int(self.querystring_expire) // 2, 1)
+            key = (name, int(time.time() // window))
+        
+        cache = self.get_url_cache()
+        url = cache.get(key)
+        if url is None:
+            url = self._build_url(name)
+            cache.put(key, url)
+        return url
+    
+    def get_url_cache(self):
+        cache = getattr(self, '_url_cache', None)
+        if cache is None:
+            cache = self._url_cache = BoundedLRU(getattr(settings, 'MEDIA_URL_CACHE_SIZE', 10000))
+        return cache
+    
+    # Изграждане на URL без кеш
+    def _build_url(self, name, parameters=None, expire=None, http_method=None):
+        """
+        Signed S3 URL with AWS_QUERYSTRING_AUTH (or a CloudFront-signed one
+        when a CloudFront key is configured), otherwise a plain URL on
+        MEDIA_CDN_DOMAIN, AWS_S3_CUSTOM_DOMAIN or the bucket's own host.
+        """
+        s3_key = self._normalize_name(self._clean_name(name))
+        domain = getattr(settings, 'MEDIA_CDN_DOMAIN', None) or self.custom_domain
+        
+        if self.querystring_auth:
+            if domain and self.cloudfront_signer:
+                return super().url(self._clean_name(name), parameters, expire, http_method)
+            params = dict(parameters or {}, Bucket=self.bucket_name, Key=s3_key)
+            return get_s3_client().generate_presigned_url(
+                'get_object',
+                Params=params,
+                ExpiresIn=expire or self.querystring_expire,
+                HttpMethod=http_method
+            )
+        
+        if not domain:
+            domain = f"{self.bucket_name}.s3.{settings.AWS_S3_REGION_NAME}.amazonaws.com"
+        query = f"?{urlencode(parameters)}" if parameters else ''
+        return f"{self.url_protocol}//{domain}/{filepath_to_uri(s3_key)}{query}"
 
 # Debug functions for direct S3 testing
 def test_s3_connection():
     """Test S3 connection using boto3 directly"""
     try:
-        s3 = boto3.client(
-            's3',
-            aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
-            aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
-            region_name=settings.AWS_S3_REGION_NAME
-        )
+        s3 = get_s3_client()
         response = s3.list_buckets()
         buckets = [bucket['Name'] for bucket in response['Buckets']]
         
@@ -247,12 +541,7 @@ def test_s3_direct_upload(file_path, s3_key=None):
         s3_key = f"test_uploads/{os.path.basename(file_path)}"
     
     try:
-        s3 = boto3.client(
-            's3',
-            aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
-            aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
-            region_name=settings.AWS_S3_REGION_NAME
-        )
+        s3 = get_s3_client()
         
         # Determine content type
         content_type = 'application/octet-stream'
@@ -283,17 +572,12 @@ def test_s3_direct_upload(file_path, s3_key=None):
 
 def debug_s3_connection():
     """Debug connection to S3 bucket and list available buckets"""
-    import boto3
-    from django.conf import settings
     logger.info(f"S3 Connection Debug - AWS_ACCESS_KEY_ID exists: {bool(settings.AWS_ACCESS_KEY_ID)}")
     logger.info(f"S3 Connection Debug - AWS_SECRET_ACCESS_KEY exists: {bool(settings.AWS_SECRET_ACCESS_KEY)}")
     logger.info(f"S3 Connection Debug - AWS_STORAGE_BUCKET_NAME: {settings.AWS_STORAGE_BUCKET_NAME}")
 
     try:
-        s3 = boto3.client('s3',
-                       aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
-                       aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
-                       region_name=settings.AWS_S3_REGION_NAME)
+        s3 = get_s3_client()
         buckets = s3.list_buckets()
         logger.info(f"S3 Connection Debug - Connection successful, buckets: {[b['Name'] for b in buckets['Buckets']]}")
         
@@ -324,12 +608,7 @@ def test_direct_upload():
         
         if settings.AWS_ACCESS_KEY_ID and settings.AWS_SECRET_ACCESS_KEY:
             logger.error("STORAGE TEST: AWS credentials found")
-            import boto3
-            
-            s3 = boto3.client('s3',
-                            aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
-                            aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
-                            region_name=settings.AWS_S3_REGION_NAME)
+            s3 = get_s3_client()
             
             # Perform a direct upload
             s3.put_object(
@@ -350,9 +629,10 @@ def test_direct_upload():
         logger.error(f"STORAGE TEST: Error in direct test: {str(e)}")
         logger.error(traceback.format_exc())
 
-# Only run these debug tests when the module is first loaded
-debug_s3_connection()
-test_direct_upload()
+# Тестовете при зареждане правят мрежови заявки, затова са само при изрично включване
+if getattr(settings, 'AWS_S3_DEBUG_ON_STARTUP', False):
+    debug_s3_connection()
+    test_direct_upload()
 
 # Debug utility for testing S3 connection
 def test_s3_connection():
@@ -362,13 +642,7 @@ def test_s3_connection():
     """
     try:
         logger.info("Testing S3 connection...")
-        s3_client = boto3.client(
-            's3',
-            aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
-            aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
-            region_name=settings.AWS_S3_REGION_NAME,
-            verify=getattr(settings, 'AWS_S3_VERIFY', True)
-        )
+        s3_client = get_s3_client()
         
         # Test if we can list objects in the bucket
         s3_client.list_objects_v2(Bucket=settings.AWS_STORAGE_BUCKET_NAME, MaxKeys=1)
@@ -389,13 +663,7 @@ def test_direct_upload_to_s3(file_path, key_name):
     try:
         logger.info(f"Testing direct upload to S3: {file_path} -> {key_name}")
         
-        s3_client = boto3.client(
-            's3',
-            aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
-            aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
-            region_name=settings.AWS_S3_REGION_NAME,
-            verify=getattr(settings, 'AWS_S3_VERIFY', True)
-        )
+        s3_client = get_s3_client()
         
         with open(file_path, 'rb') as file:
             content_type = 'application/octet-stream'
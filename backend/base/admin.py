@@ -14,6 +14,7 @@ from .models import (
     Like,
     Comment,
     Chat,
+    ChatMembership,
     Message
 )
 
@@ -214,7 +215,7 @@ class LikeAdmin(admin.ModelAdmin):
 class MessageInline(admin.TabularInline):
     model = Message
     extra = 0
-    fields = ('sender', 'content_preview', 'created_at', 'is_read', 'is_delivered')
+    fields = ('sender', 'content_preview', 'created_at', 'is_delivered')
     readonly_fields = ('created_at', 'content_preview')
     
     # Съкратено показване на съдържанието
@@ -224,12 +225,18 @@ class MessageInline(admin.TabularInline):
         return obj.content[:50] + '...' if len(obj.content) > 50 else obj.content
     content_preview.short_description = 'Съдържание'
 
+class ChatMembershipInline(admin.TabularInline):
+    model = ChatMembership
+    extra = 0
+    fields = ('user', 'last_read_message_id', 'last_read_at')
+    readonly_fields = ('last_read_at',)
+
 class ChatAdmin(admin.ModelAdmin):
     list_display = ('id', 'participants_list', 'messages_count', 'updated_at')
     list_filter = ('updated_at',)
     search_fields = ('participants__username',)
     readonly_fields = ('created_at', 'updated_at')
-    inlines = [MessageInline]
+    inlines = [ChatMembershipInline, MessageInline]
     
     # Списък с участници
     def participants_list(self, obj):
@@ -243,8 +250,8 @@ class ChatAdmin(admin.ModelAdmin):
 
 # Админ за съобщения
 class MessageAdmin(admin.ModelAdmin):
-    list_display = ('id', 'chat_id', 'sender', 'content_preview', 'created_at', 'is_read', 'is_delivered')
-    list_filter = ('created_at', 'sender', 'is_read', 'is_delivered')
+    list_display = ('id', 'chat_id', 'sender', 'content_preview', 'created_at', 'is_delivered')
+    list_filter = ('created_at', 'sender', 'is_delivered')
     search_fields = ('sender__username', 'content', 'chat__id')
     readonly_fields = ('created_at', 'updated_at')
     
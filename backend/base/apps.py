@@ -4,3 +4,13 @@ from django.apps import AppConfig
 class BaseConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'base'
+
+    def ready(self):
+        # Свързва сигналите, които поддържат индекса за търсене в съобщения
+        from . import message_search  # noqa: F401
+        # и генерирането на умалени копия на качените изображения
+        from . import media_derivatives  # noqa: F401
+        # и освобождаването на файловете на изтритите редове
+        from . import media_files  # noqa: F401
+        # Маркира матрицата за съвместимост като остаряла при промени
+        from . import matching  # noqa: F401
@@ -0,0 +1,98 @@
+import asyncio
+import json
+import logging
+from urllib.parse import parse_qs
+
+from asgiref.sync import sync_to_async
+from rest_framework.utils.encoders import JSONEncoder
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken, AuthenticationFailed
+
+from .realtime import get_broadcast, user_group
+
+"""
+WebSocket handler for real-time chat delivery.
+
+This is a plain ASGI application mounted from backend/asgi.py on /ws/chat/.
+The browser cannot send an Authorization header on a WebSocket, so the
+JWT access token is passed in the query string: /ws/chat/?token=<access>.
+Once connected, the socket receives every message created in any chat
+the user takes part in.
+"""
+
+logger = logging.getLogger(__name__)
+
+# Код за затваряне при невалиден токен (частният диапазон 4000-4999)
+CLOSE_UNAUTHORIZED = 4401
+
+
+@sync_to_async
+def get_socket_user(scope):
+    """Resolves the user from the ?token= query parameter, or None if it's invalid"""
+    query = parse_qs(scope.get('query_string', b'').decode())
+    raw_token = (query.get('token') or [None])[0]
+    if not raw_token:
+        return None
+
+    authentication = JWTAuthentication()
+    try:
+        validated_token = authentication.get_validated_token(raw_token)
+        user = authentication.get_user(validated_token)
+    except (InvalidToken, AuthenticationFailed):
+        return None
+    return user if user.is_active else None
+
+
+async def chat_socket(scope, receive, send):
+    """
+    Accepts the connection, subscribes to the user's group and forwards
+    events until the client disconnects. Clients may send {"type": "ping"}
+    to keep idle connections alive through proxies.
+    """
+    event = await receive()
+    if event['type'] != 'websocket.connect':
+        return
+
+    user = await get_socket_user(scope)
+    if user is None:
+        await send({'type': 'websocket.close', 'code': CLOSE_UNAUTHORIZED})
+        return
+
+    # Абонира се преди accept, за да не се изпусне съобщение веднага след връзката
+    subscription = get_broadcast().subscribe(user_group(user.id))
+    await send({'type': 'websocket.accept'})
+    logger.info(f"Chat socket opened for user {user.username}")
+
+    receive_task = asyncio.ensure_future(receive())
+    publish_task = asyncio.ensure_future(subscription.get())
+    try:
+        while True:
+            done, _ = await asyncio.wait(
+                {receive_task, publish_task},
+                return_when=asyncio.FIRST_COMPLETED
+            )
+
+            if publish_task in done:
+                await send({
+                    'type': 'websocket.send',
+                    'text': json.dumps(publish_task.result(), cls=JSONEncoder)
+                })
+                publish_task = asyncio.ensure_future(subscription.get())
+
+            if receive_task in done:
+                client_event = receive_task.result()
+                if client_event['type'] == 'websocket.disconnect':
+                    break
+                if client_event['type'] == 'websocket.receive':
+                    try:
+                        data = json.loads(client_event.get('text') or '{}')
+                    except ValueError:
+                        data = {}
+                    if data.get('type') == 'ping':
+                        await send({'type': 'websocket.send', 'text': json.dumps({'type': 'pong'})})
+                receive_task = asyncio.ensure_future(receive())
+    finally:
+        subscription.close()
+        receive_task.cancel()
+        publish_task.cancel()
+        logger.info(f"Chat socket closed for user {user.username}")
@@ -0,0 +1,64 @@
+import os
+import statistics
+import tempfile
+import time
+import tracemalloc
+import uuid
+
+from django.core.files import File
+from django.core.management.base import BaseCommand
+
+from backend.storage_backends import MediaStorage
+
+
+class Command(BaseCommand):
+    help = 'Measure latency and peak Python memory of MediaStorage uploads per file size'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--sizes', type=str, default='1,5,10,50',
+            help='Comma-separated file sizes in MB (default: 1,5,10,50)'
+        )
+        parser.add_argument('--repeat', type=int, default=3, help='Uploads per size (default: 3)')
+        parser.add_argument('--keep', action='store_true', help="Don't delete the uploaded files afterwards")
+
+    def handle(self, *args, **options):
+        sizes = [float(size) for size in options['sizes'].split(',') if size.strip()]
+        storage = MediaStorage()
+        run_id = uuid.uuid4().hex[:8]
+
+        self.stdout.write(f"Uploading to bucket {storage.bucket_name} ({options['repeat']} runs per size)")
+        self.stdout.write(f"{'size MB':>8} {'median ms':>10} {'max ms':>10} {'peak MB':>9} {'peak/size':>10}")
+
+        for size_mb in sizes:
+            size = int(size_mb * 1024 * 1024)
+            # Файлът е на диска, за да не влиза в измерената памет
+            with tempfile.NamedTemporaryFile(suffix='.bin') as source:
+                remaining = size
+                while remaining > 0:
+                    chunk = min(remaining, 1024 * 1024)
+                    source.write(os.urandom(chunk))
+                    remaining -= chunk
+                source.flush()
+
+                latencies = []
+                peaks = []
+                for run in range(options['repeat']):
+                    name = f"benchmarks/{run_id}/{size_mb:g}mb_{run}.bin"
+                    with open(source.name, 'rb') as fh:
+                        tracemalloc.start()
+                        started = time.perf_counter()
+                        saved_name = storage.save(name, File(fh, name=name))
+                        latencies.append((time.perf_counter() - started) * 1000)
+                        peaks.append(tracemalloc.get_traced_memory()[1])
+                        tracemalloc.stop()
+                    if not options['keep']:
+                        storage.delete(saved_name)
+
+            peak = max(peaks)
+            self.stdout.write(
+                f"{size_mb:>8g} {statistics.median(latencies):>10.1f} {max(latencies):>10.1f} "
+                f"{peak / (1024 * 1024):>9.2f} {peak / size:>10.2f}"
+            )
+
+        self.stdout.write(self.style.SUCCESS('Benchmark finished'))
@@ -0,0 +1,130 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from backend.storage_backends import BLOB_PREFIX, MediaStorage, get_s3_client
+from base.media_deletion import delete_objects
+from base.media_derivatives import DERIVATIVES_DIR, FIELDS as DERIVATIVE_FIELDS
+from base.models import MyUser, Post, Game, RankTier, Message, MediaBlob, MediaDeletion
+
+# Полета, които сочат към файлове в бъкета
+REFERENCES = [
+    (MyUser, 'avatar'),
+    (Post, 'image'),
+    (Game, 'logo'),
+    (RankTier, 'icon'),
+    (Message, 'image'),
+]
+
+
+def referenced_names(names, cutoff):
+    """
+    The subset of storage names (relative to the media location) that a row
+    still points to. Content-addressed names count while a file field or a
+    derivatives record holds them, or while their MediaBlob gained a
+    reference after cutoff (the row may still be on its way); thumbnails
+    count while their source file does.
+    """
+    # Умалените копия се пазят, докато оригиналът им е в употреба
+    sources = {}
+    for name in names:
+        if name.startswith(f"{DERIVATIVES_DIR}/"):
+            sources[name] = name[len(DERIVATIVES_DIR) + 1:].rsplit('/', 1)[0]
+    lookup = set(names) | set(sources.values())
+
+    found = set(MediaBlob.objects.filter(
+        key__in=lookup, referenced_at__gte=cutoff
+    ).values_list('key', flat=True))
+    for model, field in REFERENCES:
+        pending = list(lookup - found)
+        if not pending:
+            break
+        found.update(model.objects.filter(**{f'{field}__in': pending}).values_list(field, flat=True))
+
+    # Съдържанието на производните се пази под blobs/ и се сочи само от записа им
+    blobs = {name for name in lookup - found if name.startswith(BLOB_PREFIX)}
+    for model, (kind, file_field, record_field) in DERIVATIVE_FIELDS.items():
+        if not blobs:
+            break
+        records = model.objects.exclude(**{f'{record_field}__isnull': True}).values_list(record_field, flat=True)
+        for record in records.iterator():
+            for variants in (record or {}).get('sizes', {}).values():
+                found.update(blobs.intersection(variants.values()))
+        blobs -= found
+
+    return {name for name in names if name in found or sources.get(name) in found}
+
+
+class Command(BaseCommand):
+    help = 'Find media objects in the S3 bucket that no row references, and report or delete them'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--delete', action='store_true', help='Delete the orphans (default: only report)')
+        parser.add_argument(
+            '--min-age', type=float, default=24,
+            help='Ignore objects newer than this many hours - uploads in progress (default: 24)'
+        )
+        parser.add_argument('--prefix', default='', help='Only scan names under this prefix, e.g. chat_files/')
+        parser.add_argument('--page-size', type=int, default=1000, help='Keys checked per batch (default: 1000)')
+
+    def handle(self, *args, **options):
+        storage = MediaStorage()
+        bucket = storage.bucket_name
+        location = f"{storage.location.rstrip('/')}/"
+        cutoff = timezone.now() - timedelta(hours=options['min_age'])
+
+        scanned = orphans = orphan_bytes = deleted = 0
+        paginator = get_s3_client().get_paginator('list_objects_v2')
+        pages = paginator.paginate(
+            Bucket=bucket,
+            Prefix=location + options['prefix'],
+            PaginationConfig={'PageSize': options['page_size']}
+        )
+
+        # Една страница от списъка е в паметта наведнъж - независимо от размера на бъкета
+        for page in pages:
+            objects = {
+                obj['Key'][len(location):]: obj for obj in page.get('Contents', [])
+                if obj['LastModified'] < cutoff
+            }
+            scanned += len(page.get('Contents', []))
+            if not objects:
+                continue
+
+            referenced = referenced_names(list(objects), cutoff)
+            # Вече чакащите изтриване не се броят втори път
+            queued = set(MediaDeletion.objects.filter(
+                bucket=bucket, key__in=[location + name for name in objects]
+            ).values_list('key', flat=True))
+            page_orphans = [
+                name for name in objects
+                if name not in referenced and location + name not in queued
+            ]
+            if not page_orphans:
+                continue
+
+            orphans += len(page_orphans)
+            orphan_bytes += sum(objects[name]['Size'] for name in page_orphans)
+            for name in page_orphans:
+                self.stdout.write(f"{'deleting' if options['delete'] else 'orphan'}: {name} ({objects[name]['Size']} bytes)")
+
+            if options['delete']:
+                # Брояч на съдържание, което нищо не сочи, се премахва заедно с обекта.
+                # Заключените редове карат едновременно качване на същото съдържание да изчака изтриването
+                with transaction.atomic():
+                    blobs = MediaBlob.objects.select_for_update().filter(key__in=page_orphans)
+                    reused = set(blobs.filter(referenced_at__gte=cutoff).values_list('key', flat=True))
+                    blobs.exclude(key__in=reused).delete()
+                    keys = [location + name for name in page_orphans if name not in reused]
+                    done, errors = delete_objects(bucket, keys) if keys else (set(), {})
+                deleted += len(done)
+                for key, error in errors.items():
+                    self.stderr.write(f"Could not delete {key}: {error}")
+
+        self.stdout.write(
+            f"Scanned {scanned} objects: {orphans} orphans ({orphan_bytes / (1024 * 1024):.1f} MB)"
+            + (f", {deleted} deleted" if options['delete'] else '')
+        )
+        self.stdout.write(self.style.SUCCESS('Orphan scan finished'))
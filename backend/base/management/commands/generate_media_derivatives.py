@@ -0,0 +1,46 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from base.media_derivatives import FIELDS, is_image_name, process_instance
+
+
+class Command(BaseCommand):
+    help = 'Generate missing or outdated image thumbnails for avatars, posts and chat images'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--model', choices=[model.__name__ for model in FIELDS],
+            help='Only process this model (default: all)'
+        )
+        parser.add_argument('--workers', type=int, default=4, help='Images processed in parallel (default: 4)')
+        parser.add_argument('--all', action='store_true', help='Regenerate existing thumbnails too')
+
+    def handle(self, *args, **options):
+        for model, (kind, file_field, record_field) in FIELDS.items():
+            if options['model'] and model.__name__ != options['model']:
+                continue
+
+            rows = model.objects.exclude(**{f'{file_field}__isnull': True}).exclude(**{file_field: ''})
+            # Липсва запис или е за предишен файл - сравнението е в Python, за да работи на всяка база
+            pks = [
+                pk for pk, name, record in rows.values_list('pk', file_field, record_field).iterator()
+                if is_image_name(name) and (options['all'] or not record or record.get('source') != name)
+            ]
+
+            self.stdout.write(f"{model.__name__}: {len(pks)} images to process")
+            with ThreadPoolExecutor(max_workers=options['workers']) as executor:
+                done = sum(1 for record in executor.map(lambda pk: self.process(model, pk), pks) if record)
+            self.stdout.write(f"{model.__name__}: {done} processed, {len(pks) - done} skipped or failed")
+
+        self.stdout.write(self.style.SUCCESS('Thumbnails generated'))
+
+    def process(self, model, pk):
+        try:
+            return process_instance(model, pk)
+        except Exception as e:
+            self.stderr.write(f"{model.__name__} {pk}: {str(e)}")
+            return None
+        finally:
+            close_old_connections()
@@ -0,0 +1,40 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from base.media_deletion import MAX_KEYS_PER_REQUEST, process_batch
+
+
+class Command(BaseCommand):
+    help = 'Delete queued media objects from the S3 bucket in batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=MAX_KEYS_PER_REQUEST,
+            help=f'Keys claimed per batch (default: {MAX_KEYS_PER_REQUEST})'
+        )
+        parser.add_argument('--once', action='store_true', help='Drain what is due now and exit')
+        parser.add_argument(
+            '--interval', type=float, default=10,
+            help='Seconds to sleep when nothing is due (default: 10)'
+        )
+
+    def handle(self, *args, **options):
+        total_deleted = total_failed = 0
+        while True:
+            try:
+                deleted, failed = process_batch(options['batch_size'])
+            finally:
+                # Дълго работещ процес - връзката се подновява като при заявките
+                close_old_connections()
+            total_deleted += deleted
+            total_failed += failed
+            if deleted or failed:
+                self.stdout.write(f"Deleted {deleted} objects, {failed} failed (will retry)")
+                continue
+            if options['once']:
+                break
+            time.sleep(options['interval'])
+
+        self.stdout.write(self.style.SUCCESS(f'Done: {total_deleted} deleted, {total_failed} failed'))
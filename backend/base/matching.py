@@ -0,0 +1,309 @@
+import secrets
+import threading
+import time
+
+import numpy as np
+from django.conf import settings
+from django.db.models import Max
+from django.db.models.signals import post_delete, post_save
+
+from .models import MyUser, GameStats, GameRanking, RankTier, UserPlatform, UserLanguage
+
+"""
+Teammate match scoring.
+
+Every user is one row of a FeatureMatrix: the games they play (with the
+player goal and a rank normalized to 0..1 for each), their UTC active-hours
+mask, and their languages and platforms. The matrix is built from the
+database in a handful of queries and kept in memory; scoring a seeker
+against it is a few NumPy operations over the seeker's own games, so it
+costs about the same for 100 or 100k candidates.
+
+A score is a weighted sum of parts, each in 0..1 (weights sum to 1):
+- games:    share of the seeker's games, weighted by 1 + log(hours
+            played), that the candidate also plays
+- rank:     1 - distance of normalized ranks in those shared games
+- goals:    same PlayerGoal in the shared games
+- hours:    share of the seeker's active hours the candidate is also on
+- language: at least one common language
+- platform: at least one common platform
+Unknown ranks and goals count as a half match.
+
+The matrix is rebuilt after MATCH_FEATURES_TTL seconds, or sooner (but not
+more often than every MATCH_FEATURES_REFRESH seconds) once a profile or game
+stat saved in this process made it stale. Profile saves limited to fields
+the score doesn't use (e.g. last_login on sign-in) are ignored.
+"""
+
+# Тегла на частите на оценката
+DEFAULT_WEIGHTS = {
+    'games': 0.3,
+    'rank': 0.2,
+    'goals': 0.1,
+    'hours': 0.2,
+    'language': 0.15,
+    'platform': 0.05,
+}
+
+# Полета на MyUser, от които зависи оценката
+SCORED_USER_FIELDS = frozenset({
+    'active_hours', 'active_hours_mask', 'timezone_offset', 'platforms', 'language_preference',
+})
+
+_matrix = None
+_dirty = False
+_building = False
+_matrix_lock = threading.Lock()
+
+
+def lookup_rows(sorted_ids, user_ids):
+    """Index of each of `user_ids` in the sorted `sorted_ids` array, -1 where absent"""
+    user_ids = np.asarray(user_ids, dtype=np.int64)
+    if not len(sorted_ids):
+        return np.full(len(user_ids), -1, dtype=np.int64)
+    pos = np.minimum(np.searchsorted(sorted_ids, user_ids), len(sorted_ids) - 1)
+    return np.where(sorted_ids[pos] == user_ids, pos, -1)
+
+
+def normalized_rank(is_numeric, max_numeric_value, tier_order, max_tier_order, numeric_rank):
+    """Position of a ranking within its rank system, 0 (lowest) .. 1 (highest), or None"""
+    if is_numeric:
+        if numeric_rank is None or not max_numeric_value:
+            return None
+        return min(max(numeric_rank / max_numeric_value, 0.0), 1.0)
+    if tier_order is None or not max_tier_order:
+        return None
+    if max_tier_order <= 1:
+        return 1.0
+    return (tier_order - 1) / (max_tier_order - 1)
+
+
+class FeatureMatrix:
+    """Per-user feature vectors, one row per user id (sorted)"""
+
+    def __init__(self, user_ids, hours_mask, game_ids, plays, hours, ranks, goals,
+                 languages, language_names, platforms, platform_names):
+        self.user_ids = user_ids            # (N,) int64, възходящо
+        self.hours_mask = hours_mask        # (N,) uint32, бит = час по UTC
+        self.game_ids = game_ids            # (G,) id на играта за всяка колона
+        self.plays = plays                  # (N, G) bool
+        self.hours = hours                  # (N, G) float32 изиграни часове
+        self.ranks = ranks                  # (N, G) float32, NaN без ранг
+        self.goals = goals                  # (N, G) int32, 0 без цел
+        self.languages = languages          # (N, L) bool
+        self.platforms = platforms          # (N, P) bool
+        self.game_index = {game_id: col for col, game_id in enumerate(game_ids.tolist())}
+        self.language_index = {name: col for col, name in enumerate(language_names)}
+        self.platform_index = {name: col for col, name in enumerate(platform_names)}
+        self.built_at = time.monotonic()
+        # Различава построяванията - курсорите по съвместимост важат само за своето
+        self.version = secrets.token_hex(4)
+
+    def __len__(self):
+        return len(self.user_ids)
+
+    @classmethod
+    def build(cls, user_ids=None):
+        """Loads the features of every user (or just of `user_ids`) from the database"""
+        users = MyUser.objects.order_by('id')
+        stats = GameStats.objects.all()
+        rankings = GameRanking.objects.all()
+        platform_links = UserPlatform.objects.all()
+        language_links = UserLanguage.objects.all()
+        if user_ids is not None:
+            users = users.filter(id__in=user_ids)
+            stats = stats.filter(user_id__in=user_ids)
+            rankings = rankings.filter(game_stats__user_id__in=user_ids)
+            platform_links = platform_links.filter(user_id__in=user_ids)
+            language_links = language_links.filter(user_id__in=user_ids)
+
+        rows = list(users.values_list('id', 'active_hours_mask'))
+        ids = np.array([row[0] for row in rows], dtype=np.int64)
+        hours_mask = np.array([row[1] for row in rows], dtype=np.uint32)
+
+        stat_rows = np.array(
+            [(user_id, game_id, hours_played, goal_id or 0)
+             for user_id, game_id, hours_played, goal_id
+             in stats.values_list('user_id', 'game_id', 'hours_played', 'player_goal_id').iterator()],
+            dtype=np.int64
+        ).reshape(-1, 4)
+        # Статистики на потребители, създадени след първата заявка, се пропускат
+        stat_user_rows = lookup_rows(ids, stat_rows[:, 0])
+        stat_rows, stat_user_rows = stat_rows[stat_user_rows >= 0], stat_user_rows[stat_user_rows >= 0]
+        game_ids, game_cols = np.unique(stat_rows[:, 1], return_inverse=True)
+
+        shape = (len(ids), len(game_ids))
+        plays = np.zeros(shape, dtype=bool)
+        plays[stat_user_rows, game_cols] = True
+        hours = np.zeros(shape, dtype=np.float32)
+        hours[stat_user_rows, game_cols] = stat_rows[:, 2]
+        goals = np.zeros(shape, dtype=np.int32)
+        goals[stat_user_rows, game_cols] = stat_rows[:, 3]
+
+        # Ранг: средно от ранг системите на играта, нормализирано към 0..1
+        max_orders = dict(RankTier.objects.values('rank_system').annotate(top=Max('order')).values_list('rank_system', 'top'))
+        rank_sum = np.zeros(shape, dtype=np.float32)
+        rank_count = np.zeros(shape, dtype=np.float32)
+        game_index = {game_id: col for col, game_id in enumerate(game_ids.tolist())}
+        row_index = {user_id: row for row, user_id in enumerate(ids.tolist())}
+        for user_id, game_id, system_id, is_numeric, max_value, tier_order, numeric_rank in rankings.values_list(
+            'game_stats__user_id', 'game_stats__game_id', 'rank_system_id', 'rank_system__is_numeric',
+            'rank_system__max_numeric_value', 'rank__order', 'numeric_rank'
+        ).iterator():
+            value = normalized_rank(is_numeric, max_value, tier_order, max_orders.get(system_id), numeric_rank)
+            if value is None or user_id not in row_index or game_id not in game_index:
+                continue
+            rank_sum[row_index[user_id], game_index[game_id]] += value
+            rank_count[row_index[user_id], game_index[game_id]] += 1
+        with np.errstate(invalid='ignore', divide='ignore'):
+            ranks = np.where(rank_count > 0, rank_sum / rank_count, np.nan).astype(np.float32)
+
+        languages, language_names = cls._links(language_links.values_list('user_id', 'language__name'), row_index)
+        platforms, platform_names = cls._links(platform_links.values_list('user_id', 'platform__name'), row_index)
+
+        return cls(ids, hours_mask, game_ids, plays, hours, ranks, goals,
+                   languages, language_names, platforms, platform_names)
+
+    @staticmethod
+    def _links(pairs, row_index):
+        """(user id, name) pairs -> (N, K) bool matrix and the K column names"""
+        pairs = [(row_index[user_id], name) for user_id, name in pairs.iterator() if user_id in row_index]
+        names = sorted({name for _, name in pairs})
+        columns = {name: col for col, name in enumerate(names)}
+        matrix = np.zeros((len(row_index), len(names)), dtype=bool)
+        if pairs:
+            matrix[[row for row, _ in pairs], [columns[name] for _, name in pairs]] = True
+        return matrix, names
+
+    def score(self, seeker, candidate_ids=None, weights=None):
+        """
+        Scores candidates for `seeker` (a one-row FeatureMatrix, see
+        seeker_features). Returns (candidate ids, scores in 0..1) as NumPy
+        arrays; all users in the matrix when candidate_ids is None.
+        Candidates missing from the matrix (joined since it was built) get 0.
+        """
+        weights = {**DEFAULT_WEIGHTS, **getattr(settings, 'MATCH_SCORE_WEIGHTS', {}), **(weights or {})}
+
+        if candidate_ids is None:
+            ids = self.user_ids
+            rows = np.arange(len(ids))
+        else:
+            ids = np.asarray(candidate_ids, dtype=np.int64)
+            rows = lookup_rows(self.user_ids, ids)
+        found = rows >= 0
+        rows = rows[found]
+        partial = np.zeros(len(rows), dtype=np.float32)
+
+        # Игрите на търсещия с тегло 1 + log(часове); общата сума включва и игри, които никой друг не играе
+        seeker_hours = seeker.hours[0] if len(seeker) else np.zeros(0, dtype=np.float32)
+        seeker_weight = (1 + np.log1p(seeker_hours)) * seeker.plays[0] if len(seeker) else seeker_hours
+        if seeker_weight.sum() > 0:
+            seeker_weight = seeker_weight / seeker_weight.sum()
+            seeker_cols, cols = [], []
+            for seeker_col, game_id in enumerate(seeker.game_ids.tolist()):
+                if game_id in self.game_index and seeker_weight[seeker_col] > 0:
+                    seeker_cols.append(seeker_col)
+                    cols.append(self.game_index[game_id])
+            if cols:
+                block = np.ix_(rows, cols)
+                shared = self.plays[block] * seeker_weight[seeker_cols].astype(np.float32)
+                shared_weight = shared.sum(axis=1)
+                partial += weights['games'] * shared_weight
+                denominator = np.maximum(shared_weight, 1e-9)
+
+                rank_proximity = 1 - np.abs(self.ranks[block] - seeker.ranks[0, seeker_cols])
+                rank_proximity = np.where(np.isnan(rank_proximity), 0.5, rank_proximity)
+                partial += weights['rank'] * (shared * rank_proximity).sum(axis=1) / denominator
+
+                candidate_goals = self.goals[block]
+                seeker_goals = seeker.goals[0, seeker_cols]
+                goal_match = np.where(
+                    (candidate_goals == 0) | (seeker_goals == 0), 0.5,
+                    (candidate_goals == seeker_goals).astype(np.float32)
+                )
+                partial += weights['goals'] * (shared * goal_match).sum(axis=1) / denominator
+
+        # Общи активни часове по UTC
+        seeker_mask = int(seeker.hours_mask[0]) if len(seeker) else 0
+        if seeker_mask:
+            common = np.bitwise_count(self.hours_mask[rows] & np.uint32(seeker_mask))
+            partial += weights['hours'] * common / bin(seeker_mask).count('1')
+
+        for part, matrix, index, seeker_matrix, seeker_index in (
+            ('language', self.languages, self.language_index, seeker.languages, seeker.language_index),
+            ('platform', self.platforms, self.platform_index, seeker.platforms, seeker.platform_index),
+        ):
+            cols = [index[name] for name, col in seeker_index.items() if seeker_matrix[0, col] and name in index]
+            if cols:
+                partial += weights[part] * matrix[np.ix_(rows, cols)].any(axis=1)
+
+        scores = np.zeros(len(ids), dtype=np.float32)
+        scores[found] = partial
+        return ids, scores
+
+
+def seeker_features(user):
+    """The user's own features, read fresh from the database"""
+    return FeatureMatrix.build(user_ids=[user.pk])
+
+
+def get_feature_matrix():
+    """
+    The shared FeatureMatrix, rebuilt when it is older than the configured
+    limits. The rebuild runs outside the lock: one thread builds while the
+    others keep scoring against the current matrix, then the new one is
+    swapped in.
+    """
+    global _matrix, _dirty, _building
+    ttl = getattr(settings, 'MATCH_FEATURES_TTL', 300)
+    refresh = getattr(settings, 'MATCH_FEATURES_REFRESH', 30)
+    with _matrix_lock:
+        current = _matrix
+        age = time.monotonic() - current.built_at if current is not None else None
+        stale = age is None or age >= ttl or (_dirty and age >= refresh)
+        if not stale or (_building and current is not None):
+            return current
+        _building = True
+        _dirty = False
+
+    try:
+        matrix = FeatureMatrix.build()
+    except Exception:
+        with _matrix_lock:
+            # Следващата заявка опитва отново
+            _building = False
+            _dirty = True
+        raise
+    with _matrix_lock:
+        _building = False
+        _matrix = matrix
+    return matrix
+
+
+def rank_candidates(user, candidate_ids=None, weights=None, matrix=None):
+    """
+    Best teammates for `user` first: (ids, scores) sorted by score, then id.
+    Without candidate_ids every other user is ranked; without matrix the
+    shared one is used.
+    """
+    if matrix is None:
+        matrix = get_feature_matrix()
+    ids, scores = matrix.score(seeker_features(user), candidate_ids, weights)
+    keep = ids != user.pk
+    ids, scores = ids[keep], scores[keep]
+    order = np.lexsort((ids, -scores))
+    return ids[order], scores[order]
+
+
+# Маркира матрицата като остаряла при промяна на профил или статистика
+def invalidate_features(sender, update_fields=None, **kwargs):
+    global _dirty
+    # Напр. last_login при вход не променя оценката
+    if sender is MyUser and update_fields is not None and not SCORED_USER_FIELDS & set(update_fields):
+        return
+    _dirty = True
+
+
+for _model in (MyUser, GameStats, GameRanking):
+    post_save.connect(invalidate_features, sender=_model, dispatch_uid=f'matching_save_{_model.__name__}')
+    post_delete.connect(invalidate_features, sender=_model, dispatch_uid=f'matching_delete_{_model.__name__}')
@@ -0,0 +1,127 @@
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from backend.storage_backends import get_s3_client
+from .models import MediaDeletion
+
+"""
+Durable queue of bucket objects to delete.
+
+Requests never wait for S3 to delete a file: MediaStorage.delete records the
+key in MediaDeletion (after the delete of the row that referenced it commits,
+see base/media_files.py) and the process_media_deletions command drains the table with DeleteObjects,
+up to 1000 keys per call. Keys that fail are retried with exponential
+backoff until MEDIA_DELETE_MAX_ATTEMPTS; after that they stay in the table
+for someone to look at.
+"""
+
+logger = logging.getLogger(__name__)
+
+# Ограничение на DeleteObjects
+MAX_KEYS_PER_REQUEST = 1000
+
+# Колко време е запазен взет от работник запис, преди друг да може да го вземе
+CLAIM_TIMEOUT = timedelta(minutes=5)
+
+
+def enqueue_deletion(bucket, keys):
+    """Queues bucket keys for deletion"""
+    MediaDeletion.objects.bulk_create([MediaDeletion(bucket=bucket, key=key) for key in keys])
+
+
+def cancel_deletion(bucket, key):
+    """
+    Drops pending deletions of a key that is being written again. A row a
+    worker is deleting right now stays locked until its DeleteObjects call
+    returns, so this waits for it and the caller's upload comes after the
+    delete instead of being removed by it.
+    """
+    MediaDeletion.objects.filter(bucket=bucket, key=key).delete()
+
+
+def retry_delay(attempts):
+    """30 s, 1 min, 2 min ... capped at 6 hours"""
+    return timedelta(seconds=min(30 * 2 ** (attempts - 1), 6 * 60 * 60))
+
+
+def claim_batch(batch_size):
+    """
+    Takes up to batch_size due rows and pushes their next attempt past the
+    claim timeout, so parallel workers (or a crashed one) don't delete the
+    same keys twice.
+    """
+    now = timezone.now()
+    max_attempts = getattr(settings, 'MEDIA_DELETE_MAX_ATTEMPTS', 8)
+    with transaction.atomic():
+        due = MediaDeletion.objects.filter(next_attempt_at__lte=now, attempts__lt=max_attempts).order_by('next_attempt_at', 'id')
+        # Postgres прескача заключените от друг работник редове; SQLite сериализира записите
+        ids = list(due.select_for_update(skip_locked=True).values_list('id', flat=True)[:batch_size])
+        MediaDeletion.objects.filter(id__in=ids).update(next_attempt_at=now + CLAIM_TIMEOUT)
+    return ids
+
+
+def process_batch(batch_size=MAX_KEYS_PER_REQUEST):
+    """
+    Deletes one batch of due keys. Returns (deleted, failed) counts; (0, 0)
+    means the queue has nothing due.
+    """
+    ids = claim_batch(batch_size)
+    if not ids:
+        return 0, 0
+
+    deleted = failed = 0
+    for start in range(0, len(ids), MAX_KEYS_PER_REQUEST):
+        chunk_ids = ids[start:start + MAX_KEYS_PER_REQUEST]
+        # Редовете остават заключени до края на DeleteObjects - cancel_deletion изчаква
+        with transaction.atomic():
+            # Записите може да са отменени, докато са били взети
+            rows = list(MediaDeletion.objects.select_for_update().filter(id__in=chunk_ids))
+            by_bucket = {}
+            for row in rows:
+                by_bucket.setdefault(row.bucket, []).append(row)
+
+            for bucket, chunk in by_bucket.items():
+                done, errors = delete_objects(bucket, {row.key for row in chunk})
+                MediaDeletion.objects.filter(id__in=[row.id for row in chunk if row.key in done]).delete()
+                for row in chunk:
+                    if row.key in errors:
+                        mark_failed(row, errors[row.key])
+                deleted += len(done)
+                failed += len(errors)
+    return deleted, failed
+
+
+def delete_objects(bucket, keys):
+    """Runs one DeleteObjects call (at most 1000 keys); returns (deleted keys, {key: error})"""
+    keys = set(keys)
+    try:
+        response = get_s3_client().delete_objects(
+            Bucket=bucket,
+            Delete={'Objects': [{'Key': key} for key in keys], 'Quiet': True}
+        )
+    except Exception as e:
+        logger.error(f"DeleteObjects failed for {len(keys)} keys in {bucket}: {str(e)}")
+        return set(), {key: str(e) for key in keys}
+
+    # В тих режим S3 връща само неуспешните ключове
+    errors = {
+        error['Key']: f"{error.get('Code')}: {error.get('Message')}"
+        for error in response.get('Errors', [])
+    }
+    return keys - set(errors), errors
+
+
+def mark_failed(row, error):
+    attempts = row.attempts + 1
+    MediaDeletion.objects.filter(id=row.id).update(
+        attempts=F('attempts') + 1,
+        next_attempt_at=timezone.now() + retry_delay(attempts),
+        last_error=error[:1000]
+    )
+    if attempts >= getattr(settings, 'MEDIA_DELETE_MAX_ATTEMPTS', 8):
+        logger.error(f"Giving up deleting s3://{row.bucket}/{row.key} after {attempts} attempts: {error}")
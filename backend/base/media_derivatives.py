@@ -0,0 +1,271 @@
+import io
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import close_old_connections, transaction
+from django.db.models.signals import post_delete, post_save
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+from .models import MyUser, Post, Message
+
+"""
+Resized and re-encoded copies of uploaded images.
+
+Every image field we serve gets a few fixed-size thumbnails in modern formats
+(WebP, plus AVIF when Pillow can write it), generated off the request thread
+after the upload is committed and stored next to the original under
+_derivatives/<original name>/<size>.<format>.
+
+The result is recorded in a JSON field on the model:
+
+    {"source": "profile_pics/me.png", "width": 1200, "height": 900,
+     "sizes": {"sm": {"webp": "_derivatives/profile_pics/me.png/sm.webp"}, ...}}
+
+`source` is the file the thumbnails were made from, so a replaced image is
+never served with its predecessor's thumbnails.
+"""
+
+logger = logging.getLogger(__name__)
+
+DERIVATIVES_DIR = '_derivatives'
+
+# Размери (най-дългата страна в пиксели) за всеки вид изображение
+VARIANTS = {
+    'avatar': {'sm': 64, 'md': 256},
+    'post': {'sm': 320, 'md': 960},
+    'chat': {'sm': 320, 'md': 960},
+}
+
+# Модел -> (вид, поле с файла, поле с производните)
+FIELDS = {
+    MyUser: ('avatar', 'avatar', 'avatar_derivatives'),
+    Post: ('post', 'image', 'image_derivatives'),
+    Message: ('chat', 'image', 'image_derivatives'),
+}
+
+# Кодиране за всеки формат
+SAVE_OPTIONS = {
+    'webp': {'format': 'WEBP', 'quality': 80, 'method': 4},
+    'avif': {'format': 'AVIF', 'quality': 60},
+}
+
+CONTENT_TYPES = {
+    'webp': 'image/webp',
+    'avif': 'image/avif',
+}
+
+try:
+    # Pillow пише AVIF само с този плъгин (или от версия 11.2 нататък)
+    import pillow_avif  # noqa: F401
+except ImportError:
+    pass
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_formats():
+    """
+    Configured derivative formats this Pillow build can write. The first one
+    is what single-URL fields (avatar_url, sender_avatar) point to.
+    """
+    Image.init()
+    formats = getattr(settings, 'MEDIA_DERIVATIVE_FORMATS', ['webp', 'avif'])
+    return [fmt for fmt in formats if fmt in SAVE_OPTIONS and SAVE_OPTIONS[fmt]['format'] in Image.SAVE]
+
+
+def derivative_name(source, size, fmt):
+    return f"{DERIVATIVES_DIR}/{source}/{size}.{fmt}"
+
+
+def is_image_name(name):
+    """Only raster formats Pillow can decode; SVG and documents are left alone"""
+    return name.lower().rsplit('.', 1)[-1] in (
+        'jpg', 'jpeg', 'jfif', 'png', 'gif', 'webp', 'bmp', 'tif', 'tiff'
+    )
+
+
+def generate_derivatives(fieldfile, kind):
+    """
+    Builds every size and format for one image and saves them to the field's
+    storage. Returns the record to keep on the model.
+    """
+    sizes = VARIANTS[kind]
+    formats = get_formats()
+    storage = fieldfile.storage
+
+    with storage.open(fieldfile.name, 'rb') as source:
+        image = Image.open(source)
+        # JPEG се декодира директно в по-малък размер, ако е възможно
+        image.draft('RGB', (max(sizes.values()),) * 2)
+        image = ImageOps.exif_transpose(image)
+        width, height = image.size
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA' if 'transparency' in image.info or image.mode in ('LA', 'PA') else 'RGB')
+
+        record = {'source': fieldfile.name, 'width': width, 'height': height, 'sizes': {}}
+        for size_name, edge in sizes.items():
+            resized = image.copy()
+            resized.thumbnail((edge, edge), Image.LANCZOS)
+            record['sizes'][size_name] = {}
+            for fmt in formats:
+                buffer = io.BytesIO()
+                resized.save(buffer, **SAVE_OPTIONS[fmt])
+                content = ContentFile(buffer.getvalue())
+                content.content_type = CONTENT_TYPES[fmt]
+                name = derivative_name(fieldfile.name, size_name, fmt)
+                record['sizes'][size_name][fmt] = storage.save(name, content)
+    return record
+
+
+def process_instance(model, pk):
+    """Worker task: generates the derivatives of one row and stores the record"""
+    kind, file_field, record_field = FIELDS[model]
+    instance = model.objects.filter(pk=pk).only('pk', file_field).first()
+    if instance is None:
+        return None
+    fieldfile = getattr(instance, file_field)
+    if not fieldfile or not is_image_name(fieldfile.name):
+        return None
+
+    try:
+        record = generate_derivatives(fieldfile, kind)
+    except (UnidentifiedImageError, OSError, ValueError) as e:
+        logger.warning(f"Could not generate derivatives for {fieldfile.name}: {str(e)}")
+        return None
+
+    # Записва се само ако файлът не е сменен междувременно; update() не праща post_save
+    storage = fieldfile.storage
+    with transaction.atomic():
+        current = model.objects.select_for_update().filter(pk=pk).values_list(file_field, record_field).first()
+        if current is None or current[0] != fieldfile.name:
+            # Новите копия не са записани никъде
+            transaction.on_commit(lambda: delete_derivatives(record, storage))
+            return None
+        previous = current[1]
+        model.objects.filter(pk=pk).update(**{record_field: record})
+        if previous:
+            # Целият стар запис, и при същия източник: всяко записване по съдържание
+            # е отделна препратка, дори ключът да съвпада с новия
+            transaction.on_commit(lambda: delete_derivatives(previous, storage))
+    return record
+
+
+def delete_derivatives(record, storage):
+    """Removes the files of a derivatives record (old image replaced or row deleted)"""
+    for variants in (record or {}).get('sizes', {}).values():
+        for name in variants.values():
+            try:
+                storage.delete(name)
+            except Exception as e:
+                logger.error(f"Error deleting derivative {name}: {str(e)}")
+
+
+def _run(model, pk):
+    try:
+        process_instance(model, pk)
+    except Exception as e:
+        logger.error(f"Error generating derivatives for {model.__name__} {pk}: {str(e)}")
+
+
+def _run_in_worker(model, pk):
+    try:
+        _run(model, pk)
+    finally:
+        # Нишките на пула не минават през request цикъла, който затваря връзките
+        close_old_connections()
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=settings.MEDIA_DERIVATIVE_WORKERS,
+                    thread_name_prefix='media-derivatives'
+                )
+    return _executor
+
+
+def schedule(model, pk):
+    """
+    Queues derivative generation for a row once the current transaction
+    commits. With MEDIA_DERIVATIVE_WORKERS = 0 it runs inline instead.
+    """
+    def submit():
+        if getattr(settings, 'MEDIA_DERIVATIVE_WORKERS', 2) > 0:
+            get_executor().submit(_run_in_worker, model, pk)
+        else:
+            _run(model, pk)
+
+    transaction.on_commit(submit)
+
+
+def needs_derivatives(instance, file_field, record_field):
+    fieldfile = getattr(instance, file_field)
+    if not fieldfile or not is_image_name(fieldfile.name):
+        return False
+    record = getattr(instance, record_field) or {}
+    return record.get('source') != fieldfile.name
+
+
+# Избор на производно изображение за показване
+def pick_derivative(record, fieldfile, size, fmt=None):
+    """
+    Name of the `size` derivative (in `fmt` or the first format available),
+    or None if there is no up-to-date one for this file.
+    """
+    if not record or not fieldfile or record.get('source') != fieldfile.name:
+        return None
+    variants = record.get('sizes', {}).get(size) or {}
+    if fmt:
+        return variants.get(fmt)
+    for candidate in get_formats() + list(variants):
+        if candidate in variants:
+            return variants[candidate]
+    return None
+
+
+def derivative_urls(record, fieldfile):
+    """{size: {format: url}} for the serializers, or None while nothing is generated"""
+    if not record or not fieldfile or record.get('source') != fieldfile.name:
+        return None
+    storage = fieldfile.storage
+    return {
+        size: {fmt: storage.url(name) for fmt, name in variants.items()}
+        for size, variants in record.get('sizes', {}).items()
+    }
+
+
+# Пуска генерирането, когато се запише нов файл
+def queue_derivatives(sender, instance, **kwargs):
+    if kwargs.get('raw'):
+        return
+    kind, file_field, record_field = FIELDS[sender]
+    if not needs_derivatives(instance, file_field, record_field):
+        return
+    # Изгледите често записват реда повторно след качването - файлът се пуска веднъж
+    name = getattr(instance, file_field).name
+    if getattr(instance, '_derivatives_queued', None) == name:
+        return
+    instance._derivatives_queued = name
+    schedule(sender, instance.pk)
+
+
+# Изтрива производните заедно с реда
+def drop_derivatives(sender, instance, **kwargs):
+    kind, file_field, record_field = FIELDS[sender]
+    record = getattr(instance, record_field)
+    if record:
+        # Както оригиналът - само след потвърждаване на изтриването
+        storage = getattr(instance, file_field).storage
+        transaction.on_commit(lambda: delete_derivatives(record, storage), using=kwargs.get('using'))
+
+
+for _model in FIELDS:
+    post_save.connect(queue_derivatives, sender=_model, dispatch_uid=f'media_derivatives_{_model.__name__}')
+    post_delete.connect(drop_derivatives, sender=_model, dispatch_uid=f'media_derivatives_drop_{_model.__name__}')
@@ -0,0 +1,55 @@
+import logging
+
+from django.db import transaction
+from django.db.models.signals import post_delete
+
+from .models import MyUser, Game, RankTier, Post, Message
+
+"""
+Removes stored files together with the rows that own them.
+
+The release runs from post_delete, so rows removed by a cascade (a deleted
+user's posts, a deleted chat's messages) let go of their files too, and only
+after the transaction commits - a rolled back delete keeps both the row and
+its file. For content-addressed files (see MediaBlob) the release drops one
+reference instead of deleting the shared object.
+"""
+
+logger = logging.getLogger(__name__)
+
+# Модел -> поле с файл
+FILE_FIELDS = {
+    MyUser: 'avatar',
+    Game: 'logo',
+    RankTier: 'icon',
+    Post: 'image',
+    Message: 'image',
+}
+
+
+def release_file(storage, name):
+    try:
+        storage.delete(name)
+    except Exception as e:
+        logger.error(f"Error deleting file {name}: {str(e)}")
+
+
+def release_on_commit(fieldfile, using=None):
+    """
+    Releases the file currently in fieldfile once the transaction commits
+    (right away outside one). Replacing a file: capture the old one before
+    assigning the new, and release it only after the row is saved.
+    """
+    storage, name = fieldfile.storage, fieldfile.name
+    transaction.on_commit(lambda: release_file(storage, name), using=using)
+
+
+# Освобождава файла след потвърждаване на изтриването
+def drop_file(sender, instance, using=None, **kwargs):
+    fieldfile = getattr(instance, FILE_FIELDS[sender])
+    if fieldfile:
+        release_on_commit(fieldfile, using=using)
+
+
+for _model in FILE_FIELDS:
+    post_delete.connect(drop_file, sender=_model, dispatch_uid=f'media_files_drop_{_model.__name__}')
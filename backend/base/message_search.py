@@ -0,0 +1,178 @@
+import logging
+import re
+
+from django.db import connection
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models import Message
+
+"""
+Full-text search over chat messages.
+
+Each database gets its own index behind the same MessageIndex interface:
+- SQLite: an FTS5 virtual table (base_message_fts) keyed by message id,
+  kept in sync by the post_save/post_delete receivers at the bottom.
+- PostgreSQL: a GIN expression index on to_tsvector(content) created by the
+  migration, which the database maintains by itself.
+
+A search returns hits as (message id, chat id, score) ordered by score, best
+first, with the message id breaking ties, so the position of the last hit is
+enough to fetch the next page (keyset pagination, no OFFSET).
+"""
+
+logger = logging.getLogger(__name__)
+
+FTS_TABLE = 'base_message_fts'
+
+# Думи в заявката - всичко останало (кавички, оператори) се игнорира
+WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+
+class MessageIndex:
+    """Interface of a message search backend"""
+
+    # Дали индексът трябва да се обновява ръчно при запис/изтриване
+    needs_sync = False
+
+    def index(self, message):
+        """Adds or refreshes a message in the index"""
+
+    def remove(self, message_id):
+        """Drops a message from the index"""
+
+    def search(self, user, query, limit, chat_id=None, after=None):
+        """
+        Returns up to `limit` hits as (message_id, chat_id, score) tuples from
+        chats the user takes part in, best first. `after` is the (score, id)
+        of the last hit of the previous page.
+        """
+        raise NotImplementedError
+
+
+class SQLiteMessageIndex(MessageIndex):
+    """FTS5-backed index with bm25 ranking"""
+
+    needs_sync = True
+
+    def index(self, message):
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {FTS_TABLE} WHERE rowid = %s", [message.id])
+            if message.content:
+                cursor.execute(
+                    f"INSERT INTO {FTS_TABLE} (rowid, content, chat_id) VALUES (%s, %s, %s)",
+                    [message.id, message.content, message.chat_id]
+                )
+
+    def remove(self, message_id):
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {FTS_TABLE} WHERE rowid = %s", [message_id])
+
+    def build_match(self, query):
+        """
+        Turns user input into an FTS5 expression: every word must appear and
+        the last one may be a prefix ("hel" finds "hello").
+        """
+        words = WORD_RE.findall(query)
+        if not words:
+            return None
+        terms = [f'"{word}"' for word in words[:-1]]
+        terms.append(f'"{words[-1]}"*')
+        return ' '.join(terms)
+
+    def search(self, user, query, limit, chat_id=None, after=None):
+        match = self.build_match(query)
+        if match is None:
+            return []
+
+        # bm25 е по-малко за по-добро съвпадение, затова се обръща знакът
+        sql = [
+            f"SELECT id, chat_id, score FROM ("
+            f" SELECT rowid AS id, chat_id, -bm25({FTS_TABLE}) AS score FROM {FTS_TABLE}"
+            f" WHERE {FTS_TABLE} MATCH %s"
+            f" AND chat_id IN (SELECT chat_id FROM base_chat_participants WHERE myuser_id = %s)"
+        ]
+        params = [match, user.id]
+        if chat_id is not None:
+            sql.append(" AND chat_id = %s")
+            params.append(chat_id)
+        sql.append(") hits")
+        if after is not None:
+            sql.append(" WHERE score < %s OR (score = %s AND id < %s)")
+            params.extend([after[0], after[0], after[1]])
+        sql.append(" ORDER BY score DESC, id DESC LIMIT %s")
+        params.append(limit)
+
+        with connection.cursor() as cursor:
+            cursor.execute(''.join(sql), params)
+            return [(row[0], int(row[1]), row[2]) for row in cursor.fetchall()]
+
+
+class PostgresMessageIndex(MessageIndex):
+    """tsvector search over the message_content_search_idx GIN index"""
+
+    # Трябва да съвпада с израза на индекса в миграцията
+    VECTOR = "to_tsvector('simple', coalesce(m.content, ''))"
+
+    def search(self, user, query, limit, chat_id=None, after=None):
+        if not WORD_RE.search(query):
+            return []
+
+        sql = [
+            "SELECT id, chat_id, score FROM ("
+            f" SELECT m.id, m.chat_id, ts_rank({self.VECTOR}, q) AS score"
+            " FROM base_message m, websearch_to_tsquery('simple', %s) q"
+            f" WHERE {self.VECTOR} @@ q"
+            " AND m.chat_id IN (SELECT chat_id FROM base_chat_participants WHERE myuser_id = %s)"
+        ]
+        params = [query, user.id]
+        if chat_id is not None:
+            sql.append(" AND m.chat_id = %s")
+            params.append(chat_id)
+        sql.append(") hits")
+        if after is not None:
+            sql.append(" WHERE score < %s OR (score = %s AND id < %s)")
+            params.extend([after[0], after[0], after[1]])
+        sql.append(" ORDER BY score DESC, id DESC LIMIT %s")
+        params.append(limit)
+
+        with connection.cursor() as cursor:
+            cursor.execute(''.join(sql), params)
+            return [(row[0], row[1], row[2]) for row in cursor.fetchall()]
+
+
+# Индекс според базата данни
+BACKENDS = {
+    'sqlite': SQLiteMessageIndex,
+    'postgresql': PostgresMessageIndex,
+}
+
+
+def get_message_index():
+    """Returns the search backend for the current database, or None if it has none"""
+    backend = BACKENDS.get(connection.vendor)
+    return backend() if backend else None
+
+
+# Синхронизация на FTS таблицата при промени в съобщенията
+@receiver(post_save, sender=Message)
+def index_message(sender, instance, **kwargs):
+    message_index = get_message_index()
+    if message_index is None or not message_index.needs_sync:
+        return
+    try:
+        message_index.index(instance)
+    except Exception as e:
+        # Търсенето не трябва да проваля изпращането на съобщение
+        logger.error(f"Error indexing message {instance.id}: {str(e)}")
+
+
+@receiver(post_delete, sender=Message)
+def unindex_message(sender, instance, **kwargs):
+    message_index = get_message_index()
+    if message_index is None or not message_index.needs_sync:
+        return
+    try:
+        message_index.remove(instance.id)
+    except Exception as e:
+        logger.error(f"Error removing message {instance.id} from the search index: {str(e)}")
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.10 on 2026-10-17 02:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0015_message_is_edited'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='file_info',
+            field=models.JSONField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='message',
+            name='image',
+            field=models.FileField(blank=True, null=True, upload_to='chat_files/'),
+        ),
+    ]
@@ -0,0 +1,77 @@
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def backfill_read_cursors(apps, schema_editor):
+    """
+    Derives each member's read cursor from the old per-message is_read flags:
+    everything before the oldest unread message from the others counts as read.
+    """
+    ChatMembership = apps.get_model('base', 'ChatMembership')
+    Message = apps.get_model('base', 'Message')
+
+    for membership in ChatMembership.objects.all().iterator():
+        messages = Message.objects.filter(chat_id=membership.chat_id)
+        first_unread = messages.filter(is_read=False).exclude(
+            sender_id=membership.user_id
+        ).order_by('id').values_list('id', flat=True).first()
+        if first_unread is not None:
+            cursor = first_unread - 1
+        else:
+            cursor = messages.order_by('-id').values_list('id', flat=True).first() or 0
+        ChatMembership.objects.filter(pk=membership.pk).update(last_read_message_id=cursor)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('base', '0017_chat_and_feed_indexes'),
+    ]
+
+    operations = [
+        # Превръща автоматичната таблица на Chat.participants в ChatMembership без промяна в базата
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.CreateModel(
+                    name='ChatMembership',
+                    fields=[
+                        ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                        ('chat', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='memberships', to='base.chat')),
+                        ('user', models.ForeignKey(db_column='myuser_id', on_delete=django.db.models.deletion.CASCADE, related_name='chat_memberships', to=settings.AUTH_USER_MODEL)),
+                    ],
+                    options={
+                        'verbose_name': 'Участник в чат',
+                        'verbose_name_plural': 'Участници в чат',
+                        'db_table': 'base_chat_participants',
+                        'unique_together': {('chat', 'user')},
+                    },
+                ),
+                migrations.AlterField(
+                    model_name='chat',
+                    name='participants',
+                    field=models.ManyToManyField(related_name='chats', through='base.ChatMembership', to=settings.AUTH_USER_MODEL),
+                ),
+            ],
+        ),
+        migrations.AddField(
+            model_name='chatmembership',
+            name='last_read_message_id',
+            field=models.BigIntegerField(default=0, help_text='ID на последното прочетено съобщение (0 - нищо не е прочетено)'),
+        ),
+        migrations.AddField(
+            model_name='chatmembership',
+            name='last_read_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.RemoveIndex(
+            model_name='message',
+            name='message_chat_unread_idx',
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['chat', 'id', 'sender'], name='message_chat_id_sender_idx'),
+        ),
+        migrations.RunPython(backfill_read_cursors, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,46 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def backfill_last_message_and_unread(apps, schema_editor):
+    """
+    Fills Chat.last_message with the newest message of each chat and each
+    member's unread_count with the messages from others after their cursor.
+    """
+    Chat = apps.get_model('base', 'Chat')
+    ChatMembership = apps.get_model('base', 'ChatMembership')
+    Message = apps.get_model('base', 'Message')
+
+    for chat in Chat.objects.all().iterator():
+        latest_id = Message.objects.filter(chat_id=chat.pk).order_by(
+            '-created_at', '-id'
+        ).values_list('id', flat=True).first()
+        Chat.objects.filter(pk=chat.pk).update(last_message_id=latest_id)
+
+    for membership in ChatMembership.objects.all().iterator():
+        unread = Message.objects.filter(
+            chat_id=membership.chat_id,
+            id__gt=membership.last_read_message_id
+        ).exclude(sender_id=membership.user_id).count()
+        ChatMembership.objects.filter(pk=membership.pk).update(unread_count=unread)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0018_chatmembership'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chat',
+            name='last_message',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='base.message'),
+        ),
+        migrations.AddField(
+            model_name='chatmembership',
+            name='unread_count',
+            field=models.PositiveIntegerField(default=0, help_text='Брой непрочетени съобщения от другите участници'),
+        ),
+        migrations.RunPython(backfill_last_message_and_unread, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,43 @@
+from django.db import migrations, models
+
+
+def backfill_pair_keys(apps, schema_editor):
+    """
+    Gives every existing two-person chat its pair key. If a pair already has
+    several chats, the most recently active one gets the key (the one the old
+    lookup returned) and the others are left without it.
+    """
+    Chat = apps.get_model('base', 'Chat')
+    ChatMembership = apps.get_model('base', 'ChatMembership')
+
+    members = {}
+    for chat_id, user_id in ChatMembership.objects.values_list('chat_id', 'user_id').iterator():
+        members.setdefault(chat_id, []).append(user_id)
+
+    assigned = set()
+    for chat in Chat.objects.order_by('-updated_at', '-id').iterator():
+        user_ids = members.get(chat.pk, [])
+        if len(user_ids) != 2:
+            continue
+        low, high = sorted(user_ids)
+        pair_key = f"{low}:{high}"
+        if pair_key in assigned:
+            continue
+        assigned.add(pair_key)
+        Chat.objects.filter(pk=chat.pk).update(pair_key=pair_key)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0019_chat_last_message_unread_count'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chat',
+            name='pair_key',
+            field=models.CharField(blank=True, editable=False, max_length=64, null=True, unique=True),
+        ),
+        migrations.RunPython(backfill_pair_keys, migrations.RunPython.noop),
+    ]
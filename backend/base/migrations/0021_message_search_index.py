@@ -0,0 +1,43 @@
+from django.db import migrations
+
+
+def create_search_index(apps, schema_editor):
+    """
+    Creates the full-text index for the current database (see
+    base/message_search.py) and fills it with the existing messages.
+    """
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        schema_editor.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS base_message_fts USING fts5("
+            "content, chat_id UNINDEXED, tokenize = 'unicode61 remove_diacritics 2')"
+        )
+        schema_editor.execute(
+            "INSERT INTO base_message_fts (rowid, content, chat_id) "
+            "SELECT id, content, chat_id FROM base_message "
+            "WHERE content IS NOT NULL AND content != ''"
+        )
+    elif vendor == 'postgresql':
+        schema_editor.execute(
+            "CREATE INDEX IF NOT EXISTS message_content_search_idx ON base_message "
+            "USING GIN (to_tsvector('simple', coalesce(content, '')))"
+        )
+
+
+def drop_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        schema_editor.execute("DROP TABLE IF EXISTS base_message_fts")
+    elif vendor == 'postgresql':
+        schema_editor.execute("DROP INDEX IF EXISTS message_content_search_idx")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0020_chat_pair_key'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 4.2.10 on 2026-10-17 02:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0024_mediadeletion'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='message',
+            name='image',
+            field=models.FileField(blank=True, db_index=True, null=True, upload_to='chat_files/'),
+        ),
+        migrations.AlterField(
+            model_name='myuser',
+            name='avatar',
+            field=models.ImageField(blank=True, db_index=True, null=True, upload_to='profile_pics/'),
+        ),
+        migrations.AlterField(
+            model_name='post',
+            name='image',
+            field=models.ImageField(blank=True, db_index=True, null=True, upload_to='post_images/'),
+        ),
+    ]
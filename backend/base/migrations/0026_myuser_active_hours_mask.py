@@ -0,0 +1,36 @@
+from django.db import migrations, models
+
+
+def backfill_active_hours_mask(apps, schema_editor):
+    """
+    Computes the UTC mask for existing users (same rule as
+    base.models.hours_to_mask, copied so the migration doesn't change with it).
+    """
+    MyUser = apps.get_model('base', 'MyUser')
+    for user in MyUser.objects.only('id', 'active_hours', 'timezone_offset').iterator():
+        mask = 0
+        for hour in user.active_hours if isinstance(user.active_hours, list) else []:
+            try:
+                hour_num = int(str(hour).split(':')[0])
+            except ValueError:
+                continue
+            if 0 <= hour_num < 24:
+                mask |= 1 << ((hour_num - user.timezone_offset) % 24)
+        if mask:
+            MyUser.objects.filter(pk=user.pk).update(active_hours_mask=mask)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0025_media_file_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='myuser',
+            name='active_hours_mask',
+            field=models.IntegerField(db_index=True, default=0, editable=False),
+        ),
+        migrations.RunPython(backfill_active_hours_mask, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,109 @@
+# Generated by Django 4.2.10 on 2026-10-17 02:37
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def backfill_attribute_links(apps, schema_editor):
+    """
+    Fills Platform/Language and the user link tables from the existing
+    platforms and language_preference arrays.
+    """
+    MyUser = apps.get_model('base', 'MyUser')
+    tables = [
+        ('platforms', apps.get_model('base', 'Platform'), apps.get_model('base', 'UserPlatform'), 'platform'),
+        ('language_preference', apps.get_model('base', 'Language'), apps.get_model('base', 'UserLanguage'), 'language'),
+    ]
+    for source, attribute_model, link_model, field in tables:
+        links = set()
+        for user_id, values in MyUser.objects.values_list('id', source).iterator():
+            for value in values if isinstance(values, list) else []:
+                name = str(value).strip()[:100]
+                if name:
+                    links.add((user_id, name))
+
+        names = {name for _, name in links}
+        attribute_model.objects.bulk_create(
+            [attribute_model(name=name) for name in names], ignore_conflicts=True
+        )
+        ids = dict(attribute_model.objects.filter(name__in=names).values_list('name', 'id'))
+        link_model.objects.bulk_create(
+            [link_model(user_id=user_id, **{f'{field}_id': ids[name]}) for user_id, name in links],
+            batch_size=1000, ignore_conflicts=True
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0026_myuser_active_hours_mask'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Language',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, unique=True)),
+            ],
+            options={
+                'verbose_name': 'Език',
+                'verbose_name_plural': 'Езици',
+            },
+        ),
+        migrations.CreateModel(
+            name='Platform',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, unique=True)),
+            ],
+            options={
+                'verbose_name': 'Платформа',
+                'verbose_name_plural': 'Платформи',
+            },
+        ),
+        migrations.CreateModel(
+            name='UserPlatform',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('platform', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='user_links', to='base.platform')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='platform_links', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='UserLanguage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('language', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='user_links', to='base.language')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='language_links', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='myuser',
+            name='language_tags',
+            field=models.ManyToManyField(blank=True, related_name='users', through='base.UserLanguage', to='base.language'),
+        ),
+        migrations.AddField(
+            model_name='myuser',
+            name='platform_tags',
+            field=models.ManyToManyField(blank=True, related_name='users', through='base.UserPlatform', to='base.platform'),
+        ),
+        migrations.AddIndex(
+            model_name='userplatform',
+            index=models.Index(fields=['platform', 'user'], name='userplatform_platform_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='userplatform',
+            unique_together={('user', 'platform')},
+        ),
+        migrations.AddIndex(
+            model_name='userlanguage',
+            index=models.Index(fields=['language', 'user'], name='userlanguage_language_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='userlanguage',
+            unique_together={('user', 'language')},
+        ),
+        migrations.RunPython(backfill_attribute_links, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 4.2.10 on 2026-10-17 03:02
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0027_platform_language'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mediablob',
+            name='referenced_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
@@ -1,4 +1,6 @@
-from django.db import models
+from django.db import models, transaction
+from django.db.models import F, Count, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
 from django.contrib.auth.models import AbstractUser
 from django.core.validators import MinValueValidator, MaxValueValidator
 from django.core.exceptions import ValidationError
@@ -10,6 +12,23 @@ Models for the Q-up platform - this is where we define all our database stuff.
 The app is for gamers to connect with each other based on their games and ranks.
 """
 
+# Часове (низове 'ЧЧ:ММ') -> 24-битова маска, бит N = час N по UTC
+def hours_to_mask(hours, offset=0):
+    """
+    Turns a list of 'HH:MM' hours in a zone `offset` hours ahead of UTC into
+    a 24-bit mask of the UTC hours they cover. Malformed entries are skipped.
+    """
+    mask = 0
+    for hour in hours or []:
+        try:
+            hour_num = int(str(hour).split(':')[0])
+        except ValueError:
+            continue
+        if 0 <= hour_num < 24:
+            mask |= 1 << ((hour_num - offset) % 24)
+    return mask
+
+
 # Разширен потребителски модел
 class MyUser(AbstractUser):
     """
@@ -19,7 +38,9 @@ class MyUser(AbstractUser):
     """
     
     # Профилни полета
-    avatar = models.ImageField(upload_to='profile_pics/', blank=True, null=True)
+    avatar = models.ImageField(upload_to='profile_pics/', blank=True, null=True, db_index=True)
+    # Умалени копия на аватара (виж base/media_derivatives.py)
+    avatar_derivatives = models.JSONField(null=True, blank=True, editable=False)
     bio = models.TextField(blank=True, null=True)
     display_name = models.CharField(max_length=150, blank=True, null=True)  # Показвано име
     email = models.EmailField(unique=True)  # Имейлът трябва да е уникален
@@ -49,6 +70,10 @@ class MyUser(AbstractUser):
         help_text="Масив от геймърски платформи"
     )
     
+    # Нормализирани копия на platforms и language_preference - за търсене и фасети
+    platform_tags = models.ManyToManyField('Platform', through='UserPlatform', related_name='users', blank=True)
+    language_tags = models.ManyToManyField('Language', through='UserLanguage', related_name='users', blank=True)
+    
     # Наличие на микрофон
     mic_available = models.BooleanField(default=True)  # Дали потребителят има микрофон
     
@@ -77,6 +102,9 @@ class MyUser(AbstractUser):
         help_text="Отместване в часове от UTC"
     )
     
+    # Активните часове по UTC като битова маска - за търсене по наличност в базата
+    active_hours_mask = models.IntegerField(default=0, db_index=True, editable=False)
+    
     # Дата на раждане (незадължително)
     date_of_birth = models.DateField(null=True, blank=True)
     
@@ -107,9 +135,25 @@ class MyUser(AbstractUser):
 
     # Пуска валидации при запис
     def save(self, *args, **kwargs):
-        """Runs validation before saving the user"""
+        """Runs validation and refreshes the UTC active-hours mask before saving the user"""
         self.full_clean()
-        super().save(*args, **kwargs)
+        self.active_hours_mask = hours_to_mask(self.active_hours, self.timezone_offset)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and {'active_hours', 'timezone_offset'} & set(update_fields):
+            kwargs['update_fields'] = set(update_fields) | {'active_hours_mask'}
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            if update_fields is None or {'platforms', 'language_preference'} & set(update_fields):
+                self.sync_attributes()
+
+    # Синхронизира нормализираните таблици с JSON масивите
+    def sync_attributes(self):
+        """
+        Mirrors the platforms and language_preference arrays into UserPlatform
+        and UserLanguage rows. Only touches the rows that changed.
+        """
+        sync_attribute_links(self, self.platforms, Platform, UserPlatform, 'platform')
+        sync_attribute_links(self, self.language_preference, Language, UserLanguage, 'language')
 
     class Meta:
         verbose_name = 'Потребител'
@@ -119,6 +163,82 @@ class MyUser(AbstractUser):
         """Returns the username for admin panel and other displays"""
         return self.username  # Показва потребителското име в админ панела
 
+# Почистване на стойностите от JSON масив - без празни и повторения
+def normalize_names(values):
+    names = []
+    for value in values if isinstance(values, list) else []:
+        name = str(value).strip()[:100]
+        if name and name not in names:
+            names.append(name)
+    return names
+
+
+# Записва връзките на потребител към платформи/езици според списъка с имена
+def sync_attribute_links(user, values, attribute_model, link_model, field):
+    names = normalize_names(values)
+    current = set(link_model.objects.filter(user=user).values_list(f'{field}__name', flat=True))
+    if current == set(names):
+        return
+
+    link_model.objects.filter(user=user).exclude(**{f'{field}__name__in': names}).delete()
+    missing = [name for name in names if name not in current]
+    if missing:
+        attribute_model.objects.bulk_create(
+            [attribute_model(name=name) for name in missing], ignore_conflicts=True
+        )
+        link_model.objects.bulk_create(
+            [link_model(user=user, **{field: attribute}) for attribute in attribute_model.objects.filter(name__in=missing)],
+            ignore_conflicts=True
+        )
+
+# Платформа (PC, PlayStation ...)
+class Platform(models.Model):
+    """A gaming platform users can list on their profile"""
+    name = models.CharField(max_length=100, unique=True)
+
+    def __str__(self):
+        return self.name
+
+    class Meta:
+        verbose_name = 'Платформа'
+        verbose_name_plural = 'Платформи'
+
+# Език
+class Language(models.Model):
+    """A language users are happy to play in"""
+    name = models.CharField(max_length=100, unique=True)
+
+    def __str__(self):
+        return self.name
+
+    class Meta:
+        verbose_name = 'Език'
+        verbose_name_plural = 'Езици'
+
+# Платформа на потребител
+class UserPlatform(models.Model):
+    user = models.ForeignKey(MyUser, on_delete=models.CASCADE, related_name='platform_links')
+    platform = models.ForeignKey(Platform, on_delete=models.CASCADE, related_name='user_links')
+
+    class Meta:
+        unique_together = ('user', 'platform')
+        indexes = [
+            # Търсене на потребители по платформа
+            models.Index(fields=['platform', 'user'], name='userplatform_platform_idx'),
+        ]
+
+# Език на потребител
+class UserLanguage(models.Model):
+    user = models.ForeignKey(MyUser, on_delete=models.CASCADE, related_name='language_links')
+    language = models.ForeignKey(Language, on_delete=models.CASCADE, related_name='user_links')
+
+    class Meta:
+        unique_together = ('user', 'language')
+        indexes = [
+            # Търсене на потребители по език
+            models.Index(fields=['language', 'user'], name='userlanguage_language_idx'),
+        ]
+
 # Игра
 class Game(models.Model):
     """
@@ -146,13 +266,6 @@ class Game(models.Model):
         """Shows game name in admin and other displays"""
         return self.name
 
-    # Изтрива файла с логото
-    def delete(self, *args, **kwargs):
-        """Deletes the logo file when deleting the game to prevent orphaned files"""
-        if self.logo:
-            self.logo.delete()
-        super().delete(*args, **kwargs)
-
 # Ранг система (ELO, рангове)
 class RankSystem(models.Model):
     """
@@ -239,13 +352,6 @@ class RankTier(models.Model):
         """Shows the game name and rank name together"""
         return f"{self.rank_system.game.name} - {self.name}"
 
-    # Изтрива файла с иконата
-    def delete(self, *args, **kwargs):
-        """Removes the icon file when deleting the rank"""
-        if self.icon:
-            self.icon.delete()
-        super().delete(*args, **kwargs)
-
     class Meta:
         ordering = ['rank_system', 'order']
         unique_together = ('rank_system', 'order')
@@ -362,7 +468,8 @@ class GameRanking(models.Model):
 # Пост
 class Post(models.Model):
     user = models.ForeignKey(MyUser, on_delete=models.CASCADE, related_name='posts')
-    image = models.ImageField(upload_to='post_images/', null=True, blank=True)
+    image = models.ImageField(upload_to='post_images/', null=True, blank=True, db_index=True)
+    image_derivatives = models.JSONField(null=True, blank=True, editable=False)  # Умалени копия на снимката
     caption = models.TextField(blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
@@ -374,18 +481,14 @@ class Post(models.Model):
         ordering = ['-created_at']
         verbose_name = 'Публикация'
         verbose_name_plural = 'Публикации'
+        indexes = [
+            # Лента с публикации на потребител (най-новите първо)
+            models.Index(fields=['user', '-created_at'], name='post_user_created_idx'),
+        ]
     
     def __str__(self):
         return f"{self.user.username}'s post ({self.id})"
     
-    # Изтрива снимката при изтриване на поста
-    def delete(self, *args, **kwargs):
-        # Изтрива снимка при изтриване на пост
-        if self.image:
-            # S3 compatible file deletion
-            self.image.delete(save=False)
-        super().delete(*args, **kwargs)
-    
     # Брой харесвания
     @property
     def likes_count(self):
@@ -425,16 +528,32 @@ class Comment(models.Model):
         ordering = ['created_at']
         verbose_name = 'Коментар'
         verbose_name_plural = 'Коментари'
+        indexes = [
+            # Коментари от най-горно ниво към пост, подредени по време
+            models.Index(fields=['post', 'parent', 'created_at'], name='comment_post_parent_idx'),
+        ]
     
     def __str__(self):
         return f"{self.user.username} коментира за {self.post}"
 
 # Чат
 class Chat(models.Model):
-    participants = models.ManyToManyField(MyUser, related_name='chats')
+    participants = models.ManyToManyField(MyUser, related_name='chats', through='ChatMembership')
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     
+    # Последно съобщение - пази се тук, за да не се търси при всяко показване на списъка
+    last_message = models.ForeignKey(
+        'Message',
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name='+'
+    )
+    
+    # Ключ на директен чат "<по-малко id>:<по-голямо id>" - един чат за всяка двойка
+    pair_key = models.CharField(max_length=64, unique=True, null=True, blank=True, editable=False)
+    
     class Meta:
         ordering = ['-updated_at']
     
@@ -448,6 +567,30 @@ class Chat(models.Model):
         self.updated_at = timezone.now()
         super().save(*args, **kwargs)
     
+    # Ключ за двойка потребители, независим от реда им
+    @staticmethod
+    def make_pair_key(user_a, user_b):
+        """Returns the canonical key of the direct chat between two users"""
+        low, high = sorted((user_a.pk, user_b.pk))
+        return f"{low}:{high}"
+    
+    # Намира или създава директен чат между двама потребители
+    @classmethod
+    def get_or_create_direct(cls, user_a, user_b):
+        """
+        Looks up the direct chat of a pair through the unique pair_key index and
+        creates it if it doesn't exist yet. Two concurrent requests for the same
+        pair end up with the same chat because the second insert hits the unique
+        constraint and falls back to reading the first one.
+        Returns (chat, created).
+        """
+        pair_key = cls.make_pair_key(user_a, user_b)
+        with transaction.atomic():
+            chat, created = cls.objects.get_or_create(pair_key=pair_key)
+            if created:
+                chat.participants.add(user_a, user_b)
+        return chat, created
+    
     # Взима всички съобщения
     def get_messages(self):
         return self.messages.all().order_by('created_at')
@@ -457,6 +600,7 @@ class Chat(models.Model):
         if not content and not image:
             raise ValidationError("Съобщението трябва да има съдържание или изображение")
         
+        # Message.save обновява и последното съобщение и брояча на непрочетени
         message = Message.objects.create(
             chat=self,
             sender=sender,
@@ -464,42 +608,195 @@ class Chat(models.Model):
             image=image
         )
         
-        # Обновява чата
-        self.save()
+        # Изпраща съобщението към отворените връзки на участниците
+        from .realtime import notify_new_message
+        notify_new_message(message)
         
         return message
+    
+    # Брой непрочетени съобщения за потребител
+    def unread_count_for(self, user):
+        """
+        Returns the user's unread counter for this chat (0 if not a participant).
+        """
+        unread_count = ChatMembership.objects.filter(
+            chat=self, user=user
+        ).values_list('unread_count', flat=True).first()
+        return unread_count or 0
+    
+    # Обновява денормализираните полета при ново съобщение
+    def register_message(self, message):
+        """
+        Points last_message at the new message and bumps the unread counter of
+        every other member. Called from Message.save inside its transaction.
+        """
+        now = timezone.now()
+        Chat.objects.filter(pk=self.pk).update(last_message=message, updated_at=now)
+        self.memberships.exclude(user_id=message.sender_id).update(unread_count=F('unread_count') + 1)
+        # Пази и обекта в паметта актуален, за да не презапише полетата при следващ save()
+        self.last_message = message
+        self.updated_at = now
+    
+    # Обновява денормализираните полета при изтрито съобщение
+    def unregister_message(self, message):
+        """
+        Undoes register_message for a deleted message: members that hadn't read it
+        get their counter decremented and last_message falls back to the newest
+        remaining message. Must run after the message row is gone.
+        """
+        self.memberships.exclude(user_id=message.sender_id).filter(
+            last_read_message_id__lt=message.id,
+            unread_count__gt=0
+        ).update(unread_count=F('unread_count') - 1)
+        
+        if self.last_message_id in (None, message.id):
+            latest = self.messages.order_by('-created_at', '-id').first()
+            Chat.objects.filter(pk=self.pk).update(last_message=latest)
+            self.last_message = latest
+
+# Участие в чат
+class ChatMembership(models.Model):
+    """
+    A user's membership in a chat, together with how far they have read.
+    
+    Read state lives here as a cursor (the id of the newest message the user
+    has seen) instead of a flag on every message, so marking a chat as read
+    is a single-row update and works the same way for group chats.
+    Reuses the table Django originally created for Chat.participants.
+    """
+    # Като автоматичната таблица, създадена с DEFAULT_AUTO_FIELD (bigint)
+    id = models.BigAutoField(primary_key=True)
+    chat = models.ForeignKey(Chat, on_delete=models.CASCADE, related_name='memberships')
+    user = models.ForeignKey(MyUser, on_delete=models.CASCADE, related_name='chat_memberships', db_column='myuser_id')
+    last_read_message_id = models.BigIntegerField(
+        default=0,
+        help_text="ID на последното прочетено съобщение (0 - нищо не е прочетено)"
+    )
+    last_read_at = models.DateTimeField(null=True, blank=True)
+    unread_count = models.PositiveIntegerField(
+        default=0,
+        help_text="Брой непрочетени съобщения от другите участници"
+    )
+    
+    class Meta:
+        db_table = 'base_chat_participants'
+        unique_together = ('chat', 'user')
+        verbose_name = 'Участник в чат'
+        verbose_name_plural = 'Участници в чат'
+    
+    def __str__(self):
+        return f"{self.user.username} в чат {self.chat_id}"
+    
+    # Отбелязва чата като прочетен до дадено съобщение
+    def mark_read(self, message_id):
+        """
+        Moves the read cursor forward to message_id. Never moves it back, so
+        an old "mark as read" request can't make newer messages unread again.
+        The unread counter is recounted in the same UPDATE from the messages
+        after the new cursor (usually none). Returns True if the cursor moved.
+        """
+        now = timezone.now()
+        remaining = Message.objects.filter(
+            chat_id=OuterRef('chat_id'), id__gt=message_id
+        ).exclude(sender_id=OuterRef('user_id')).order_by().values('chat_id').annotate(
+            total=Count('id')
+        ).values('total')
+        updated = ChatMembership.objects.filter(
+            pk=self.pk, last_read_message_id__lt=message_id
+        ).update(
+            last_read_message_id=message_id,
+            last_read_at=now,
+            unread_count=Coalesce(Subquery(remaining), Value(0))
+        )
+        if updated:
+            self.refresh_from_db(fields=['last_read_message_id', 'last_read_at', 'unread_count'])
+        return bool(updated)
 
 # Съобщение
 class Message(models.Model):
     chat = models.ForeignKey(Chat, on_delete=models.CASCADE, related_name='messages')
     sender = models.ForeignKey(MyUser, on_delete=models.CASCADE, related_name='sent_messages')
     content = models.TextField(blank=True)
-    image = models.FileField(upload_to='chat_files/', null=True, blank=True)  # Changed from ImageField to FileField to support all types
+    image = models.FileField(upload_to='chat_files/', null=True, blank=True, db_index=True)  # Changed from ImageField to FileField to support all types
     parent = models.ForeignKey('self', on_delete=models.SET_NULL, null=True, blank=True, related_name='replies')
     is_edited = models.BooleanField(default=False)
-    is_read = models.BooleanField(default=False)
+    is_read = models.BooleanField(default=False)  # Остаряло - прочитането се пази в ChatMembership
     is_delivered = models.BooleanField(default=True)  # Статус за доставка
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     file_info = models.JSONField(null=True, blank=True)  # Store additional file metadata
+    image_derivatives = models.JSONField(null=True, blank=True, editable=False)  # Умалени копия на изображението
     
     class Meta:
         ordering = ['created_at']
+        indexes = [
+            # История на чата и последно съобщение (id разделя еднакви времена)
+            models.Index(fields=['chat', 'created_at', 'id'], name='message_chat_created_idx'),
+            # Брой непрочетени съобщения след курсора за прочитане
+            models.Index(fields=['chat', 'id', 'sender'], name='message_chat_id_sender_idx'),
+        ]
     
     def __str__(self):
         return f"Съобщение от {self.sender.username} в чат {self.chat.id}"
     
-    # Изтрива картинката при изтриване
+    # Обновява чата при ново съобщение
+    def save(self, *args, **kwargs):
+        """Keeps the chat's last message and unread counters in step with new messages"""
+        adding = self._state.adding
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            if adding:
+                self.chat.register_message(self)
+    
+    # Обновява чата при изтриване (файлът се освобождава в base/media_files.py)
     def delete(self, *args, **kwargs):
-        # Изтрива снимката при изтриване
-        if hasattr(self, 'image') and self.image:
-            try:
-                # S3 compatible file deletion
-                self.image.delete(save=False)
-            except Exception as e:
-                # Log error but continue with deletion
-                print(f"Error deleting image file for message {self.id}: {str(e)}")
-                import traceback
-                traceback.print_exc()
-        
-        super().delete(*args, **kwargs)
+        # id-то се нулира от super().delete(), затова се пази копие
+        deleted = Message(id=self.id, sender_id=self.sender_id)
+        chat = self.chat
+        with transaction.atomic():
+            result = super().delete(*args, **kwargs)
+            chat.unregister_message(deleted)
+        return result
+
+# Файл в хранилището, адресиран по съдържание
+class MediaBlob(models.Model):
+    """
+    One stored copy of some file content, keyed by its SHA-256 (see
+    MediaStorage in backend/storage_backends.py). ref_count is the number of
+    saved file references to the key; the object is removed from the bucket
+    only when the last one is deleted.
+    """
+    key = models.CharField(max_length=255, unique=True)  # Име във FileField, напр. blobs/ab/<sha256>.png
+    sha256 = models.CharField(max_length=64, db_index=True)
+    size = models.BigIntegerField()
+    content_type = models.CharField(max_length=100, blank=True)
+    ref_count = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    # Последно добавена препратка - collect_orphaned_media не пипа скоро използваните
+    referenced_at = models.DateTimeField(default=timezone.now)
+    
+    def __str__(self):
+        return f"{self.key} ({self.ref_count} refs)"
+
+# Опашка за изтриване на файлове от S3
+class MediaDeletion(models.Model):
+    """
+    An object waiting to be deleted from the bucket. MediaStorage.delete only
+    adds a row here; the process_media_deletions worker removes them in
+    batches with DeleteObjects and retries failures with backoff.
+    """
+    bucket = models.CharField(max_length=255)
+    key = models.CharField(max_length=1024)  # Пълен ключ в бъкета, с префикса media/
+    attempts = models.PositiveSmallIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        indexes = [
+            # Следващите за обработка записи
+            models.Index(fields=['next_attempt_at', 'id'], name='mediadeletion_due_idx'),
+        ]
+    
+    def __str__(self):
+        return f"s3://{self.bucket}/{self.key} ({self.attempts} attempts)"
@@ -0,0 +1,46 @@
+import base64
+import json
+
+from django.db.models import Q
+
+"""
+Keyset (cursor) pagination helpers.
+
+A cursor is the position of the last row on a page, encoded as an opaque
+URL-safe string. Paging with it is a single range scan on an index instead
+of an OFFSET or an extra lookup query, and rows that share the same
+timestamp are neither skipped nor repeated because the id breaks ties.
+"""
+
+
+class InvalidCursor(ValueError):
+    """Raised when a client sends a cursor we didn't issue"""
+
+
+def encode_cursor(payload):
+    """Turns a JSON-serializable dict into an opaque cursor string"""
+    raw = json.dumps(payload, separators=(',', ':'), default=str).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Reverses encode_cursor. Raises InvalidCursor for anything malformed."""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except (ValueError, TypeError):
+        raise InvalidCursor('Invalid cursor')
+    if not isinstance(payload, dict):
+        raise InvalidCursor('Invalid cursor')
+    return payload
+
+
+# Условия за ключово странициране по (поле, id)
+def keyset_before(field, value, pk):
+    """Rows strictly before (value, pk) in (field, id) order"""
+    return Q(**{f'{field}__lt': value}) | Q(**{field: value, 'id__lt': pk})
+
+
+def keyset_after(field, value, pk):
+    """Rows strictly after (value, pk) in (field, id) order"""
+    return Q(**{f'{field}__gt': value}) | Q(**{field: value, 'id__gt': pk})
@@ -0,0 +1,148 @@
+import asyncio
+import logging
+import threading
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import transaction
+from django.utils.module_loading import import_string
+
+"""
+Real-time delivery for chat messages.
+
+Views publish events into a broadcast layer; the WebSocket handler in
+base/consumers.py forwards them to connected clients and the long-poll
+message view wakes up on them. The default layer lives in process memory,
+which is enough for a single ASGI worker and for the tests; a Redis-backed
+layer can be plugged in with the CHAT_BROADCAST_BACKEND setting as long as
+it has the same methods.
+"""
+
+logger = logging.getLogger(__name__)
+
+
+# Имена на групите, в които се публикуват събития
+def user_group(user_id):
+    """Group that every open socket of a user listens on"""
+    return f"user:{user_id}"
+
+
+def chat_group(chat_id):
+    """Group for long-poll requests waiting on a specific chat"""
+    return f"chat:{chat_id}"
+
+
+class Subscription:
+    """
+    A single listener on a group.
+
+    The queue belongs to the event loop that created the subscription, so
+    publishers from other threads hand events over with call_soon_threadsafe.
+    """
+
+    def __init__(self, layer, group, loop):
+        self.layer = layer
+        self.group = group
+        self.loop = loop
+        self.queue = asyncio.Queue()
+
+    async def get(self):
+        """Waits for the next event published to the group"""
+        return await self.queue.get()
+
+    def close(self):
+        """Stops receiving events"""
+        self.layer.unsubscribe(self)
+
+
+class InMemoryBroadcast:
+    """
+    Broadcast layer that keeps subscribers in a dict of sets.
+
+    Only reaches sockets served by the current process - deployments with
+    several workers need a shared backend (e.g. Redis pub/sub) instead.
+    """
+
+    def __init__(self):
+        self._groups = defaultdict(set)
+        self._lock = threading.Lock()
+
+    def subscribe(self, group):
+        """Registers a listener for the group. Must be called inside a running event loop."""
+        subscription = Subscription(self, group, asyncio.get_running_loop())
+        with self._lock:
+            self._groups[group].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            listeners = self._groups.get(subscription.group)
+            if listeners is not None:
+                listeners.discard(subscription)
+                if not listeners:
+                    del self._groups[subscription.group]
+
+    def publish(self, group, event):
+        """
+        Sends the event to every listener of the group.
+        Safe to call from sync views. Returns how many listeners got it.
+        """
+        with self._lock:
+            listeners = list(self._groups.get(group, ()))
+
+        delivered = 0
+        for subscription in listeners:
+            try:
+                subscription.loop.call_soon_threadsafe(subscription.queue.put_nowait, event)
+                delivered += 1
+            except RuntimeError:
+                # Цикълът на събитията е затворен - слушателят вече не съществува
+                self.unsubscribe(subscription)
+        return delivered
+
+
+_broadcast = None
+_broadcast_lock = threading.Lock()
+
+
+def get_broadcast():
+    """Returns the process-wide broadcast layer configured in settings"""
+    global _broadcast
+    if _broadcast is None:
+        with _broadcast_lock:
+            if _broadcast is None:
+                backend_path = getattr(settings, 'CHAT_BROADCAST_BACKEND', 'base.realtime.InMemoryBroadcast')
+                _broadcast = import_string(backend_path)()
+    return _broadcast
+
+
+# Публикува ново съобщение до всички участници в чата
+def notify_new_message(message):
+    """
+    Pushes a newly created message to every participant of its chat.
+
+    The payload is built right away, but it is only published once the
+    surrounding transaction commits, so clients never see a message
+    that could still be rolled back.
+    """
+    from .serializers import MessageSerializer
+
+    try:
+        participant_ids = list(message.chat.participants.values_list('id', flat=True))
+        event = {
+            'type': 'message.created',
+            'chat': message.chat_id,
+            'message': MessageSerializer(message).data,
+        }
+    except Exception as e:
+        # Доставката в реално време не трябва да проваля изпращането на съобщението
+        logger.error(f"Error preparing real-time event for message {message.id}: {str(e)}")
+        return
+
+    def publish():
+        layer = get_broadcast()
+        for user_id in participant_ids:
+            layer.publish(user_group(user_id), event)
+        layer.publish(chat_group(message.chat_id), event)
+
+    transaction.on_commit(publish)
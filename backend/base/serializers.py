@@ -1,11 +1,12 @@
 from rest_framework import serializers
 from rest_framework_simplejwt.serializers import TokenObtainPairSerializer
-from .models import MyUser, Game, GameStats, RankSystem, RankTier, PlayerGoal, GameRanking, Post, Like, Comment, Message, Chat
+from .models import MyUser, Game, GameStats, RankSystem, RankTier, PlayerGoal, GameRanking, Post, Like, Comment, Message, Chat, ChatMembership
 import json
 import logging
 from django.utils import timezone
 import os
 import mimetypes
+from .media_derivatives import pick_derivative, derivative_urls
 
 """
 Serializers for the Q-up platform.
@@ -15,6 +16,16 @@ Think of them as translators between what the database understands
 and what the frontend (React) needs to work with.
 """
 
+# URL на аватар в даден размер
+def avatar_url_for(user, size=None):
+    """URL of the `size` avatar thumbnail when it exists, otherwise of the original"""
+    if size:
+        name = pick_derivative(user.avatar_derivatives, user.avatar, size)
+        if name:
+            return user.avatar.storage.url(name)
+    return user.avatar.url
+
+
 # Сериализатор за потребителски данни - преобразува модела в JSON за API
 class UserSerializer(serializers.ModelSerializer):
     """
@@ -31,11 +42,12 @@ class UserSerializer(serializers.ModelSerializer):
     platforms = serializers.ListField(child=serializers.CharField(), required=False)
     social_links = serializers.ListField(child=serializers.CharField(), required=False)
     avatar_url = serializers.SerializerMethodField()
+    avatar_variants = serializers.SerializerMethodField()
 
     class Meta:
         model = MyUser
         fields = [
-            'id', 'username', 'display_name', 'email', 'avatar', 'avatar_url',
+            'id', 'username', 'display_name', 'email', 'avatar', 'avatar_url', 'avatar_variants',
             'followers_count', 'following_count', 'active_hours',
             'language_preference', 'platforms', 'mic_available',
             'social_links', 'created_at', 'is_active', 'timezone',
@@ -45,27 +57,39 @@ class UserSerializer(serializers.ModelSerializer):
     # Връща брой последователи
     def get_followers_count(self, obj):
         """Returns how many people follow this user"""
+        # Списъците на чатове подават предварително преброени стойности
+        if hasattr(obj, 'followers_total'):
+            return obj.followers_total
         return obj.followers.count()
 
     # Връща брой профили, които потребителят следва
     def get_following_count(self, obj):
         """Returns how many people this user follows"""
+        if hasattr(obj, 'following_total'):
+            return obj.following_total
         return obj.following.count()
 
     # Връща URL на аватара или път към стандартен аватар
-    def get_avatar_url(self, obj):
+    def get_avatar_url(self, obj, size=None):
         """
         Gets the URL for the user's avatar or returns a default
-        if they haven't uploaded one
+        if they haven't uploaded one. With a size (argument or the
+        `avatar_size` context key) it points to that thumbnail once it's ready.
         """
         if obj.avatar:
+            url = avatar_url_for(obj, size or self.context.get('avatar_size'))
             request = self.context.get('request')
             if request:
-                return request.build_absolute_uri(obj.avatar.url)
-            return obj.avatar.url
+                return request.build_absolute_uri(url)
+            return url
         # Return a reliable default avatar URL that doesn't depend on media files
         return 'https://ui-avatars.com/api/?name=' + obj.username[0].upper()
 
+    # Връща URL на умалените копия на аватара
+    def get_avatar_variants(self, obj):
+        """{size: {format: url}} of the avatar thumbnails, or None until they're generated"""
+        return derivative_urls(obj.avatar_derivatives, obj.avatar)
+
     # Валидация на полето active_hours - проверява дали е списък
     def validate_active_hours(self, value):
         """
@@ -397,10 +421,11 @@ class PostSerializer(serializers.ModelSerializer):
     comments_count = serializers.SerializerMethodField()
     liked_by_current_user = serializers.SerializerMethodField()
     game = GameSerializer(read_only=True)
+    image_variants = serializers.SerializerMethodField()
     
     class Meta:
         model = Post
-        fields = ['id', 'user', 'image', 'caption', 'created_at', 'updated_at', 
+        fields = ['id', 'user', 'image', 'image_variants', 'caption', 'created_at', 'updated_at', 
                  'likes_count', 'comments_count', 'liked_by_current_user', 'game']
         read_only_fields = ['id', 'user', 'created_at', 'updated_at', 'likes_count', 'comments_count']
     
@@ -412,6 +437,10 @@ class PostSerializer(serializers.ModelSerializer):
     def get_comments_count(self, obj):
         return obj.comments.count()
     
+    # Умалени копия на снимката за картите в лентата
+    def get_image_variants(self, obj):
+        return derivative_urls(obj.image_derivatives, obj.image)
+    
     # Проверява дали текущият потребител е харесал поста
     def get_liked_by_current_user(self, obj):
         request = self.context.get('request')
@@ -447,6 +476,7 @@ class MessageSerializer(serializers.ModelSerializer):
     replies_count = serializers.SerializerMethodField()
     parent_sender = serializers.SerializerMethodField()
     file_info = serializers.SerializerMethodField()
+    is_read = serializers.SerializerMethodField()
 
     class Meta:
         model = Message
@@ -463,17 +493,43 @@ class MessageSerializer(serializers.ModelSerializer):
     def get_sender_avatar(self, obj):
         try:
             if obj.sender and obj.sender.avatar:
-                return obj.sender.avatar.url
+                return avatar_url_for(obj.sender, 'sm')
             return None
         except Exception:
             return None
 
     def get_replies_count(self, obj):
+        # Страниците със съобщения подават броя като анотация
+        if hasattr(obj, 'replies_total'):
+            return obj.replies_total
         try:
             return obj.replies.count()
         except Exception:
             return 0
     
+    # Дали съобщението е прочетено от някой друг освен подателя
+    def get_is_read(self, obj):
+        """
+        Derived from the participants' read cursors. List views pass the cursors
+        of the chat in the context as {user_id: last_read_message_id} so they're
+        loaded once per page instead of once per message (or as
+        chat_read_cursors, {chat_id: {...}}, for pages spanning several chats).
+        """
+        read_cursors = self.context.get('read_cursors')
+        # Резултатите от търсене идват от различни чатове
+        chat_read_cursors = self.context.get('chat_read_cursors')
+        if chat_read_cursors is not None:
+            read_cursors = chat_read_cursors.get(obj.chat_id, {})
+        if read_cursors is None:
+            read_cursors = dict(
+                ChatMembership.objects.filter(chat_id=obj.chat_id).values_list('user_id', 'last_read_message_id')
+            )
+        return any(
+            last_read_id >= obj.id
+            for user_id, last_read_id in read_cursors.items()
+            if user_id != obj.sender_id
+        )
+    
     def get_parent_sender(self, obj):
         try:
             if obj.parent and obj.parent.sender:
@@ -493,11 +549,15 @@ class MessageSerializer(serializers.ModelSerializer):
                 import mimetypes
                 
                 # Get filename and type from the image field name
-                filename = os.path.basename(obj.image.name)
+                # (файловете, пазени по съдържание, се казват по хеша си - името от качването е във file_info)
+                filename = (obj.file_info or {}).get('name') or os.path.basename(obj.image.name)
                 file_type = mimetypes.guess_type(obj.image.name)[0] or 'application/octet-stream'
                 
-                # Get size if available
-                file_size = getattr(obj.image, 'size', 0)
+                # Size saved at upload time, otherwise ask the storage
+                if obj.file_info and 'size' in obj.file_info:
+                    file_size = obj.file_info['size']
+                else:
+                    file_size = getattr(obj.image, 'size', 0)
                 
                 # Check if file is an image using a more comprehensive method
                 is_image = False
@@ -526,7 +586,9 @@ class MessageSerializer(serializers.ModelSerializer):
                     'name': filename,
                     'type': file_type,
                     'size': file_size,
-                    'is_image': is_image
+                    'is_image': is_image,
+                    # Умалени копия за прегледа в чата (None, докато не са готови)
+                    'variants': derivative_urls(obj.image_derivatives, obj.image) if is_image else None
                 }
             return None
         except Exception as e:
@@ -541,6 +603,26 @@ class MessageSerializer(serializers.ModelSerializer):
             raise serializers.ValidationError("Either content or image must be provided.")
         return data
 
+# Компактен сериализатор за страница със съобщения
+class MessageListSerializer(MessageSerializer):
+    """
+    Compact message row for history pages. The sender is just an id - the
+    page carries each author once in a separate `senders` dict. Expects
+    sender and parent__sender loaded with select_related and replies_total
+    annotated, so a row needs no queries of its own.
+    """
+    sender = serializers.PrimaryKeyRelatedField(read_only=True)
+    sender_avatar = None
+    
+    class Meta(MessageSerializer.Meta):
+        fields = [
+            'id', 'chat', 'sender', 'sender_username',
+            'content', 'image', 'parent', 'is_read', 'is_delivered',
+            'created_at', 'updated_at', 'replies_count', 'parent_sender', 'file_info'
+        ]
+        read_only_fields = fields
+
+
 # Сериализатор за чатове
 class ChatSerializer(serializers.ModelSerializer):
     participants = UserSerializer(many=True, read_only=True)
@@ -555,39 +637,19 @@ class ChatSerializer(serializers.ModelSerializer):
     # Връща последното съобщение в чата
     def get_last_message(self, obj):
         try:
-            # Simple default response if anything fails
-            default_response = {
-                'id': None,
-                'content': "",
-                'sender': "",
-                'created_at': timezone.now(),
-                'has_image': False,
-                'has_file': False
-            }
-            
-            # Use a safer query approach with error handling
-            last_message = None
-            try:
-                messages = obj.messages.all().order_by('-created_at')
-                if messages.exists():
-                    last_message = messages.first()
-                
-                if not last_message:
-                    return None
-            except Exception as e:
-                import logging
-                logger = logging.getLogger(__name__)
-                logger.error(f"Error querying last message: {str(e)}")
-                return default_response
+            # Денормализирано поле - без заявка, ако е зареден със select_related
+            last_message = obj.last_message
+            if not last_message:
+                return None
                 
             # Return simplified data to avoid potential errors
             return {
                 'id': last_message.id,
                 'content': last_message.content[:50] + '...' if last_message.content and len(last_message.content) > 50 else last_message.content or "",
-                'sender': last_message.sender.username if hasattr(last_message, 'sender') and last_message.sender else "",
+                'sender': last_message.sender.username if last_message.sender else "",
                 'created_at': last_message.created_at,
-                'has_image': bool(last_message.image) if hasattr(last_message, 'image') else False,
-                'has_file': bool(last_message.image) if hasattr(last_message, 'image') else False
+                'has_image': bool(last_message.image),
+                'has_file': bool(last_message.image)
             }
                 
         except Exception as e:
@@ -609,13 +671,14 @@ class ChatSerializer(serializers.ModelSerializer):
             if not user or not user.is_authenticated:
                 return 0
             
+            # Списъкът с чатове подава броячите наведнъж
+            unread_counts = self.context.get('unread_counts')
+            if unread_counts is not None:
+                return unread_counts.get(obj.id, 0)
+            
             try:    
-                # Count unread messages sent by others
-                return obj.messages.filter(
-                    is_read=False
-                ).exclude(
-                    sender=user
-                ).count()
+                # Read the user's denormalized unread counter
+                return obj.unread_count_for(user)
             except Exception as query_error:
                 import logging
                 logger = logging.getLogger(__name__)
@@ -626,4 +689,34 @@ class ChatSerializer(serializers.ModelSerializer):
             import logging
             logger = logging.getLogger(__name__)
             logger.error(f"Error in get_unread_count: {str(e)}")
-            return 0
\ No newline at end of file
+            return 0
+
+
+# Кратки данни за участник в списъка с чатове
+class InboxParticipantSerializer(serializers.ModelSerializer):
+    avatar_url = serializers.SerializerMethodField()
+    
+    class Meta:
+        model = MyUser
+        fields = ['id', 'username', 'display_name', 'avatar_url']
+    
+    def get_avatar_url(self, obj):
+        """URL of the small avatar thumbnail (or the original), like UserSerializer"""
+        if not obj.avatar:
+            return 'https://ui-avatars.com/api/?name=' + obj.username[0].upper()
+        url = avatar_url_for(obj, size='sm')
+        request = self.context.get('request')
+        return request.build_absolute_uri(url) if request else url
+
+
+# Сериализатор за входящата кутия - без допълнителни заявки на чат
+class InboxChatSerializer(ChatSerializer):
+    """
+    Chat row for the inbox endpoint. Expects the queryset built by the inbox
+    view: last_message loaded with select_related, participants prefetched
+    and the caller's unread counter annotated as `unread`.
+    """
+    participants = InboxParticipantSerializer(many=True, read_only=True)
+    
+    def get_unread_count(self, obj):
+        return getattr(obj, 'unread', 0) or 0
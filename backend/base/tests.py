@@ -6,12 +6,35 @@ from django.core.files.uploadedfile import SimpleUploadedFile
 from .models import (
     MyUser, Game, RankSystem, RankTier, PlayerGoal, 
     GameStats, GameRanking, Post, Like, Comment, 
-    Chat, Message
+    Chat, ChatMembership, Message, MediaBlob, MediaDeletion, Platform
 )
+import io
+import os
 import json
+import asyncio
+import hashlib
+import tempfile
+import unittest
+from unittest import mock
 from datetime import date
 from django.utils import timezone
 from django.db import connection
+from django.test import override_settings
+from django.core.management import call_command
+from botocore.stub import Stubber
+from django.core.files.base import ContentFile
+from backend.storage_backends import get_s3_client, get_s3_metrics, MediaStorage
+from PIL import Image
+from asgiref.sync import sync_to_async
+from rest_framework_simplejwt.tokens import AccessToken
+from .consumers import chat_socket
+from .serializers import UserSerializer, InboxParticipantSerializer, PostSerializer
+from . import media_deletion
+from .media_deletion import process_batch
+from .media_derivatives import generate_derivatives, process_instance
+from .views.chat_views import MessageListView
+from .views.search_views import SearchView
+from .matching import FeatureMatrix, rank_candidates, get_feature_matrix
 
 
 class UserModelTests(TestCase):
@@ -376,7 +399,22 @@ class ChatAPITests(APITestCase):
         self.assertEqual(participants.count(), 2)
         self.assertTrue(self.user1 in participants)
         self.assertTrue(self.user2 in participants)
-    
+
+    def test_create_chat_returns_existing_pair(self):
+        """Test that either side of a pair gets the same direct chat back"""
+        first = self.client.post(self.chats_url, {'username': 'user2'}, format='json')
+        self.assertEqual(first.status_code, status.HTTP_201_CREATED)
+
+        self.client.force_authenticate(user=self.user2)
+        second = self.client.post(self.chats_url, {'username': 'user1'}, format='json')
+        self.assertEqual(second.status_code, status.HTTP_200_OK)
+        self.assertEqual(second.data['id'], first.data['id'])
+        self.assertEqual(Chat.objects.count(), 1)
+        self.assertEqual(
+            Chat.objects.get().pair_key,
+            f"{min(self.user1.id, self.user2.id)}:{max(self.user1.id, self.user2.id)}"
+        )
+
     def test_send_message(self):
         """Test sending a message in a chat"""
         # Create a chat first
@@ -414,6 +452,1187 @@ class ChatAPITests(APITestCase):
             self.assertEqual(message_data[2], chat.id)
 
 
+class ChatReadStateTests(APITestCase):
+    """Tests for per-participant read cursors"""
+    
+    def setUp(self):
+        self.user1 = MyUser.objects.create_user(
+            username='user1',
+            email='user1@example.com',
+            password='password123'
+        )
+        self.user2 = MyUser.objects.create_user(
+            username='user2',
+            email='user2@example.com',
+            password='password123'
+        )
+        self.chat = Chat.objects.create()
+        self.chat.participants.add(self.user1, self.user2)
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user1)
+    
+    def test_unread_count_follows_read_cursor(self):
+        """Test that marking a chat read clears the unread count"""
+        self.chat.add_message(self.user2, content='First')
+        self.chat.add_message(self.user2, content='Second')
+        self.chat.add_message(self.user1, content='My own message')
+        self.assertEqual(self.chat.unread_count_for(self.user1), 2)
+        self.assertEqual(self.chat.unread_count_for(self.user2), 1)
+        
+        response = self.client.post(reverse('chat-read', kwargs={'chat_id': self.chat.id}))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.chat.unread_count_for(self.user1), 0)
+        self.assertEqual(self.chat.unread_count_for(self.user2), 1)
+        
+        self.chat.add_message(self.user2, content='Third')
+        self.assertEqual(self.chat.unread_count_for(self.user1), 1)
+    
+    def test_read_cursor_never_moves_back(self):
+        """Test that marking an older message read keeps the newer cursor"""
+        first = self.chat.add_message(self.user2, content='First')
+        second = self.chat.add_message(self.user2, content='Second')
+        self.client.post(reverse('message-status', kwargs={'message_id': second.id}))
+        self.client.post(reverse('message-status', kwargs={'message_id': first.id}))
+        membership = ChatMembership.objects.get(chat=self.chat, user=self.user1)
+        self.assertEqual(membership.last_read_message_id, second.id)
+    
+    def test_is_read_reflects_other_participants_cursor(self):
+        """Test that the sender sees their message as read once the other side reads it"""
+        message = self.chat.add_message(self.user1, content='Did you read this?')
+        messages_url = reverse('message-list', kwargs={'chat_id': self.chat.id})
+        response = self.client.get(messages_url)
+        self.assertFalse(response.data[0]['is_read'])
+        
+        ChatMembership.objects.get(chat=self.chat, user=self.user2).mark_read(message.id)
+        response = self.client.get(messages_url)
+        self.assertTrue(response.data[0]['is_read'])
+
+    def test_last_message_and_counter_follow_deletes(self):
+        """Test that deleting a message updates last_message and the unread counter"""
+        first = self.chat.add_message(self.user2, content='First')
+        second = self.chat.add_message(self.user2, content='Second')
+        self.chat.refresh_from_db()
+        self.assertEqual(self.chat.last_message_id, second.id)
+
+        second.delete()
+        self.chat.refresh_from_db()
+        self.assertEqual(self.chat.last_message_id, first.id)
+        self.assertEqual(self.chat.unread_count_for(self.user1), 1)
+
+        # Изтриване на вече прочетено съобщение не променя брояча
+        third = self.chat.add_message(self.user2, content='Third')
+        ChatMembership.objects.get(chat=self.chat, user=self.user1).mark_read(first.id)
+        first.delete()
+        self.assertEqual(self.chat.unread_count_for(self.user1), 1)
+        self.chat.refresh_from_db()
+        self.assertEqual(self.chat.last_message_id, third.id)
+
+    def test_chat_list_query_count_is_constant(self):
+        """Test that listing chats doesn't run queries per chat"""
+        for i in range(3):
+            other = MyUser.objects.create_user(
+                username=f'friend{i}',
+                email=f'friend{i}@example.com',
+                password='password123'
+            )
+            chat = Chat.objects.create()
+            chat.participants.add(self.user1, other)
+            chat.add_message(other, content=f'Hello {i}')
+
+        url = reverse('chat-list')
+        # Броячи, чатове с последното съобщение, участници
+        with self.assertNumQueries(3):
+            response = self.client.get(url)
+        self.assertEqual(len(response.data), 4)
+        unread = {chat['id']: chat['unread_count'] for chat in response.data}
+        self.assertEqual(unread[self.chat.id], 0)
+        self.assertEqual(sorted(unread.values()), [0, 1, 1, 1])
+        self.assertEqual(response.data[0]['last_message']['content'], 'Hello 2')
+
+
+class InboxAPITests(APITestCase):
+    """Tests for the paginated chat inbox endpoint"""
+
+    def setUp(self):
+        self.user = MyUser.objects.create_user(
+            username='user1',
+            email='user1@example.com',
+            password='password123'
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+        self.url = reverse('chat-inbox')
+
+    def create_chats(self, count):
+        for i in range(count):
+            other = MyUser.objects.create_user(
+                username=f'friend{i}',
+                email=f'friend{i}@example.com',
+                password='password123'
+            )
+            chat = Chat.objects.create()
+            chat.participants.add(self.user, other)
+            chat.add_message(other, content=f'Hello {i}')
+            chat.add_message(other, content=f'Are you there {i}?')
+
+    def test_query_count_does_not_grow_with_chats(self):
+        """Test that a page is loaded with the same number of queries for 1 or 6 chats"""
+        self.create_chats(1)
+        with self.assertNumQueries(2):
+            self.client.get(self.url)
+
+        for i in range(1, 6):
+            other = MyUser.objects.create_user(
+                username=f'extra{i}',
+                email=f'extra{i}@example.com',
+                password='password123'
+            )
+            chat = Chat.objects.create()
+            chat.participants.add(self.user, other)
+            chat.add_message(other, content='Hi')
+        with self.assertNumQueries(2):
+            response = self.client.get(self.url)
+        self.assertEqual(len(response.data['results']), 6)
+        first = response.data['results'][-1]
+        self.assertEqual(first['unread_count'], 2)
+        self.assertEqual(first['last_message']['content'], 'Are you there 0?')
+        self.assertEqual(len(first['participants']), 2)
+
+    def test_cursor_pagination(self):
+        """Test that following next_cursor walks every chat exactly once"""
+        self.create_chats(5)
+        seen = []
+        response = self.client.get(self.url, {'limit': 2})
+        while True:
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            seen.extend(chat['id'] for chat in response.data['results'])
+            if not response.data['next_cursor']:
+                break
+            response = self.client.get(self.url, {'limit': 2, 'cursor': response.data['next_cursor']})
+
+        expected = list(Chat.objects.order_by('-updated_at', '-id').values_list('id', flat=True))
+        self.assertEqual(seen, expected)
+
+    def test_invalid_cursor(self):
+        """Test that a tampered cursor is rejected"""
+        response = self.client.get(self.url, {'cursor': 'not-a-cursor'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class UnreadSummaryAPITests(APITestCase):
+    """Tests for the unread badge endpoint"""
+
+    def setUp(self):
+        self.user1 = MyUser.objects.create_user(
+            username='user1',
+            email='user1@example.com',
+            password='password123'
+        )
+        self.user2 = MyUser.objects.create_user(
+            username='user2',
+            email='user2@example.com',
+            password='password123'
+        )
+        self.chat = Chat.objects.create()
+        self.chat.participants.add(self.user1, self.user2)
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user1)
+        self.url = reverse('chat-unread')
+
+    def test_counts_and_etag(self):
+        """Test that the badge answers 304 until a new message arrives"""
+        self.chat.add_message(self.user2, content='Hello')
+        with self.assertNumQueries(1):
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data, {'total': 1, 'chats': {str(self.chat.id): 1}})
+        etag = response['ETag']
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response.content, b'')
+
+        self.chat.add_message(self.user2, content='Again')
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['total'], 2)
+
+
+class MessagePaginationTests(APITestCase):
+    """Tests for keyset pagination of chat history"""
+    
+    def setUp(self):
+        self.user1 = MyUser.objects.create_user(
+            username='user1',
+            email='user1@example.com',
+            password='password123'
+        )
+        self.user2 = MyUser.objects.create_user(
+            username='user2',
+            email='user2@example.com',
+            password='password123'
+        )
+        self.chat = Chat.objects.create()
+        self.chat.participants.add(self.user1, self.user2)
+        
+        # Messages that share the same timestamp must still page correctly
+        self.messages = [
+            Message.objects.create(chat=self.chat, sender=self.user2, content=f'Message {i}')
+            for i in range(5)
+        ]
+        Message.objects.filter(chat=self.chat).update(created_at=timezone.now())
+        
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user1)
+        self.messages_url = reverse('message-list', kwargs={'chat_id': self.chat.id})
+    
+    def test_cursor_pages_cover_history_once(self):
+        """Test walking back through history with next_cursor"""
+        response = self.client.get(self.messages_url, {'cursor': '', 'limit': 2})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        seen = [m['id'] for m in response.data['results']]
+        newest_prev_cursor = response.data['prev_cursor']
+        
+        cursor = response.data['next_cursor']
+        while cursor:
+            response = self.client.get(self.messages_url, {'cursor': cursor, 'limit': 2})
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            seen = [m['id'] for m in response.data['results']] + seen
+            cursor = response.data['next_cursor']
+        
+        self.assertEqual(seen, [m.id for m in self.messages])
+        
+        # Nothing newer than the newest page yet
+        response = self.client.get(self.messages_url, {'cursor': newest_prev_cursor})
+        self.assertEqual(response.data['results'], [])
+    
+    def test_invalid_cursor(self):
+        """Test that a malformed cursor is rejected"""
+        response = self.client.get(self.messages_url, {'cursor': 'garbage'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+    
+    def test_invalid_legacy_page_parameters(self):
+        """Test that a non-numeric before_id or limit is rejected and limit is capped"""
+        for params in ({'before_id': 'abc'}, {'limit': 'x'}, {'limit': -1}):
+            response = self.client.get(self.messages_url, params)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        with mock.patch.object(MessageListView, 'max_limit', 2):
+            response = self.client.get(self.messages_url, {'limit': 50})
+        self.assertEqual(len(response.data), 2)
+    
+    def test_before_id_with_equal_timestamps(self):
+        """Test that before_id doesn't skip messages sharing a timestamp"""
+        response = self.client.get(self.messages_url, {'before_id': self.messages[3].id})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([m['id'] for m in response.data], [m.id for m in self.messages[:3]])
+
+    def test_page_query_count_and_compact_rows(self):
+        """Test that a page of messages takes a fixed number of queries"""
+        parent = self.messages[0]
+        for i in range(3):
+            Message.objects.create(chat=self.chat, sender=self.user1, content=f'Reply {i}', parent=parent)
+
+        # Чат, съобщения, курсори за прочитане
+        with self.assertNumQueries(3):
+            response = self.client.get(self.messages_url, {'cursor': '', 'limit': 50})
+        rows = {m['id']: m for m in response.data['results']}
+        self.assertEqual(rows[parent.id]['replies_count'], 3)
+        self.assertEqual(rows[parent.id]['sender'], self.user2.id)
+        reply = response.data['results'][-1]
+        self.assertEqual(reply['parent_sender']['username'], 'user2')
+        self.assertEqual(
+            set(response.data['senders']),
+            {self.user1.id, self.user2.id}
+        )
+        self.assertEqual(response.data['senders'][self.user2.id]['username'], 'user2')
+
+        # Обикновеният списък дава кратките данни за подателя във всеки ред
+        with self.assertNumQueries(3):
+            response = self.client.get(self.messages_url)
+        self.assertEqual(response.data[0]['sender']['username'], 'user2')
+        self.assertNotIn('followers_count', response.data[0]['sender'])
+
+
+class MessageSearchAPITests(APITestCase):
+    """Tests for full-text search over chat messages"""
+
+    def setUp(self):
+        self.user1 = MyUser.objects.create_user(
+            username='user1',
+            email='user1@example.com',
+            password='password123'
+        )
+        self.user2 = MyUser.objects.create_user(
+            username='user2',
+            email='user2@example.com',
+            password='password123'
+        )
+        self.outsider = MyUser.objects.create_user(
+            username='outsider',
+            email='outsider@example.com',
+            password='password123'
+        )
+        self.chat = Chat.objects.create()
+        self.chat.participants.add(self.user1, self.user2)
+        self.other_chat = Chat.objects.create()
+        self.other_chat.participants.add(self.user2, self.outsider)
+
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user1)
+        self.url = reverse('message-search')
+
+    def search(self, **params):
+        response = self.client.get(self.url, params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response
+
+    def test_finds_only_own_chats(self):
+        """Test that search matches words and prefixes only in the user's chats"""
+        match = self.chat.add_message(self.user2, content='Играем ли Valorant довечера?')
+        self.chat.add_message(self.user2, content='Нещо друго')
+        self.other_chat.add_message(self.user2, content='Valorant без user1')
+
+        response = self.search(q='valor')
+        self.assertEqual([m['id'] for m in response.data['results']], [match.id])
+        self.assertEqual(response.data['results'][0]['chat'], self.chat.id)
+        self.assertIn(self.user2.id, response.data['senders'])
+
+        response = self.search(q='довечера играем')
+        self.assertEqual([m['id'] for m in response.data['results']], [match.id])
+
+    def test_index_follows_edits_and_deletes(self):
+        """Test that edited and deleted messages are reindexed"""
+        message = self.chat.add_message(self.user2, content='old text')
+        message.content = 'brand new words'
+        message.save()
+        self.assertEqual(self.search(q='old').data['results'], [])
+        self.assertEqual(len(self.search(q='brand').data['results']), 1)
+
+        message.delete()
+        self.assertEqual(self.search(q='brand').data['results'], [])
+
+    def test_ranked_pages_with_cursor(self):
+        """Test that following next_cursor returns every hit once, best first"""
+        best = self.chat.add_message(self.user2, content='ranked ranked ranked')
+        for i in range(4):
+            self.chat.add_message(self.user2, content=f'ranked result number {i} with more filler words')
+
+        response = self.search(q='ranked', limit=2)
+        self.assertEqual(response.data['results'][0]['id'], best.id)
+        seen = [m['id'] for m in response.data['results']]
+        while response.data['next_cursor']:
+            response = self.search(q='ranked', limit=2, cursor=response.data['next_cursor'])
+            seen.extend(m['id'] for m in response.data['results'])
+        self.assertEqual(len(seen), 5)
+        self.assertEqual(len(set(seen)), 5)
+
+    def test_query_required(self):
+        """Test that an empty query is rejected"""
+        response = self.client.get(self.url, {'q': ' '})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+@override_settings(
+    AWS_ACCESS_KEY_ID='testing',
+    AWS_SECRET_ACCESS_KEY='testing',
+    AWS_STORAGE_BUCKET_NAME='test-bucket',
+    AWS_S3_REGION_NAME='eu-north-1',
+    AWS_S3_ENDPOINT_URL='http://localhost:9000'
+)
+class ChatAttachmentUploadTests(APITestCase):
+    """Tests for presigned direct-to-S3 chat uploads"""
+
+    def setUp(self):
+        self.user1 = MyUser.objects.create_user(
+            username='user1',
+            email='user1@example.com',
+            password='password123'
+        )
+        self.user2 = MyUser.objects.create_user(
+            username='user2',
+            email='user2@example.com',
+            password='password123'
+        )
+        self.chat = Chat.objects.create()
+        self.chat.participants.add(self.user1, self.user2)
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user1)
+        self.presign_url = reverse('chat-attachment-presign', kwargs={'chat_id': self.chat.id})
+        self.confirm_url = reverse('chat-attachment-confirm', kwargs={'chat_id': self.chat.id})
+
+        # Заявките към S3 се подменят с подготвени отговори
+        self.stubber = Stubber(get_s3_client())
+        self.stubber.activate()
+        self.addCleanup(self.stubber.deactivate)
+
+    def presign(self, **data):
+        payload = {'filename': 'Screen Shot.PNG', 'content_type': 'image/png', 'size': 2048}
+        payload.update(data)
+        return self.client.post(self.presign_url, payload, format='json')
+
+    def test_presign_and_confirm(self):
+        """Test that a confirmed upload becomes a message with file info"""
+        response = self.presign()
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.data['url'].startswith('http://localhost:9000/test-bucket'))
+        key = response.data['fields']['key']
+        self.assertTrue(key.startswith(f'media/chat_files/{self.chat.id}/{self.user1.id}/screen-shot_'))
+        self.assertTrue(key.endswith('.png'))
+        self.assertIn('policy', response.data['fields'])
+
+        self.stubber.add_response(
+            'head_object',
+            {'ContentLength': 2048, 'ContentType': 'image/png'},
+            {'Bucket': 'test-bucket', 'Key': key}
+        )
+        response = self.client.post(
+            self.confirm_url,
+            {'upload_token': response.data['upload_token'], 'content': 'Виж това'},
+            format='json'
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.stubber.assert_no_pending_responses()
+
+        message = Message.objects.get(id=response.data['id'])
+        self.assertEqual(message.image.name, key[len('media/'):])
+        self.assertEqual(message.file_info['size'], 2048)
+        self.assertTrue(message.file_info['is_image'])
+        self.assertEqual(self.chat.unread_count_for(self.user2), 1)
+
+    def test_confirm_twice_returns_the_same_message(self):
+        """Test that replaying an upload token doesn't create a second message for the file"""
+        token = self.presign().data['upload_token']
+        self.stubber.add_response('head_object', {'ContentLength': 2048, 'ContentType': 'image/png'})
+        first = self.client.post(self.confirm_url, {'upload_token': token}, format='json')
+        self.assertEqual(first.status_code, status.HTTP_201_CREATED)
+
+        # Без втора HEAD заявка към S3
+        second = self.client.post(self.confirm_url, {'upload_token': token}, format='json')
+        self.assertEqual(second.status_code, status.HTTP_200_OK)
+        self.assertEqual(second.data['id'], first.data['id'])
+        self.stubber.assert_no_pending_responses()
+        self.assertEqual(Message.objects.count(), 1)
+        self.assertEqual(self.chat.unread_count_for(self.user2), 1)
+
+    def test_confirm_without_upload(self):
+        """Test that confirming before the file reached the bucket fails"""
+        token = self.presign().data['upload_token']
+        self.stubber.add_client_error('head_object', service_error_code='404', http_status_code=404)
+        response = self.client.post(self.confirm_url, {'upload_token': token}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(Message.objects.exists())
+
+    def test_rejects_invalid_requests(self):
+        """Test size limits, tampered tokens and outsiders"""
+        response = self.presign(size=50 * 1024 * 1024)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        response = self.client.post(self.confirm_url, {'upload_token': 'forged'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        outsider = MyUser.objects.create_user(
+            username='outsider',
+            email='outsider@example.com',
+            password='password123'
+        )
+        self.client.force_authenticate(user=outsider)
+        self.assertEqual(self.presign().status_code, status.HTTP_404_NOT_FOUND)
+
+
+@override_settings(
+    AWS_ACCESS_KEY_ID='testing',
+    AWS_SECRET_ACCESS_KEY='testing',
+    AWS_STORAGE_BUCKET_NAME='test-bucket',
+    AWS_S3_REGION_NAME='eu-north-1',
+    MEDIA_DEDUPLICATE=False
+)
+class MediaStorageSaveTests(TestCase):
+    """Tests for streaming uploads in MediaStorage._save"""
+
+    def setUp(self):
+        self.storage = MediaStorage(bucket_name='test-bucket')
+        self.stubber = Stubber(get_s3_client())
+        self.stubber.activate()
+        self.addCleanup(self.stubber.deactivate)
+
+    def test_streams_file_without_verification(self):
+        """Test that a small file is sent in one PUT and no HEAD follows by default"""
+        self.stubber.add_response('put_object', {'ETag': '"abc"'})
+        name = self.storage._save('chat_files/note.txt', ContentFile(b'hello', name='note.txt'))
+        self.assertEqual(name, 'chat_files/note.txt')
+        self.stubber.assert_no_pending_responses()
+
+    @override_settings(AWS_S3_VERIFY_UPLOADS=True)
+    def test_optional_verification(self):
+        """Test that AWS_S3_VERIFY_UPLOADS adds a HEAD check after the upload"""
+        stubber = Stubber(get_s3_client())
+        stubber.activate()
+        self.addCleanup(stubber.deactivate)
+        stubber.add_response('put_object', {'ETag': '"abc"'})
+        stubber.add_response(
+            'head_object',
+            {'ContentLength': 5},
+            {'Bucket': 'test-bucket', 'Key': 'media/chat_files/note.txt'}
+        )
+        self.storage._save('chat_files/note.txt', ContentFile(b'hello', name='note.txt'))
+        stubber.assert_no_pending_responses()
+
+    def test_rejects_empty_file(self):
+        """Test that empty uploads are refused before reaching S3"""
+        with self.assertRaises(ValueError):
+            self.storage._save('chat_files/empty.txt', ContentFile(b'', name='empty.txt'))
+
+
+@override_settings(
+    AWS_ACCESS_KEY_ID='testing',
+    AWS_SECRET_ACCESS_KEY='testing',
+    AWS_STORAGE_BUCKET_NAME='test-bucket',
+    AWS_S3_REGION_NAME='eu-north-1',
+    MEDIA_DEDUPLICATE=True,
+    MEDIA_CONTENT_ADDRESSED_PREFIXES=('profile_pics/', 'post_images/'),
+    MEDIA_DELETE_QUEUE=False
+)
+class ContentAddressedStorageTests(TestCase):
+    """Tests for deduplicated, reference-counted storage in MediaStorage"""
+
+    def setUp(self):
+        self.storage = MediaStorage(bucket_name='test-bucket')
+        self.stubber = Stubber(get_s3_client())
+        self.stubber.activate()
+        self.addCleanup(self.stubber.deactivate)
+        digest = hashlib.sha256(b'same meme').hexdigest()
+        self.key = f"blobs/{digest[:2]}/{digest}.png"
+
+    def test_repeated_content_is_uploaded_once(self):
+        """Test that the same content under different names is one object with two references"""
+        self.stubber.add_response('put_object', {'ETag': '"abc"'})
+        first = self.storage.save('profile_pics/meme_1.png', ContentFile(b'same meme'))
+        second = self.storage.save('post_images/meme.PNG', ContentFile(b'same meme'))
+        self.stubber.assert_no_pending_responses()
+
+        self.assertEqual(first, self.key)
+        self.assertEqual(second, self.key)
+        self.assertEqual(MediaBlob.objects.get(key=self.key).ref_count, 2)
+
+    def test_object_deleted_with_last_reference(self):
+        """Test that deleting only removes the object when no references remain"""
+        self.stubber.add_response('put_object', {'ETag': '"abc"'})
+        self.storage.save('post_images/a.png', ContentFile(b'same meme'))
+        self.storage.save('post_images/b.png', ContentFile(b'same meme'))
+
+        # Първото изтриване само намалява брояча - без заявка към S3
+        self.storage.delete(self.key)
+        self.assertEqual(MediaBlob.objects.get(key=self.key).ref_count, 1)
+
+        self.stubber.add_response(
+            'delete_object', {}, {'Bucket': 'test-bucket', 'Key': f"media/{self.key}"}
+        )
+        self.storage.delete(self.key)
+        self.stubber.assert_no_pending_responses()
+        self.assertFalse(MediaBlob.objects.filter(key=self.key).exists())
+
+    def test_cascade_delete_releases_after_commit(self):
+        """Test that rows removed by a cascade drop their reference once the delete commits"""
+        self.stubber.add_response('put_object', {'ETag': '"abc"'})
+        user = MyUser.objects.create_user(
+            username='user1', email='user1@example.com', password='password123'
+        )
+        Post.objects.create(user=user, image=ContentFile(b'same meme', name='a.png'))
+        Post.objects.create(user=user, image=ContentFile(b'same meme', name='b.png'))
+        self.assertEqual(MediaBlob.objects.get(key=self.key).ref_count, 2)
+
+        with self.captureOnCommitCallbacks() as callbacks:
+            user.delete()
+        # До потвърждаването файлът се брои като използван
+        self.assertEqual(MediaBlob.objects.get(key=self.key).ref_count, 2)
+
+        self.stubber.add_response(
+            'delete_object', {}, {'Bucket': 'test-bucket', 'Key': f"media/{self.key}"}
+        )
+        for callback in callbacks:
+            callback()
+        self.stubber.assert_no_pending_responses()
+        self.assertFalse(MediaBlob.objects.filter(key=self.key).exists())
+
+    def test_other_prefixes_keep_their_names(self):
+        """Test that files outside the configured folders are stored as before"""
+        self.stubber.add_response('head_object', {'ContentLength': 1})
+        self.stubber.add_client_error('head_object', service_error_code='404', http_status_code=404)
+        self.stubber.add_response('put_object', {'ETag': '"abc"'})
+        # Името е заето, затова се добавя суфикс, както досега
+        name = self.storage.save('game_logos/logo.png', ContentFile(b'logo'))
+        self.assertTrue(name.startswith('game_logos/logo_'))
+        self.assertFalse(MediaBlob.objects.exists())
+
+
+@override_settings(
+    AWS_ACCESS_KEY_ID='testing',
+    AWS_SECRET_ACCESS_KEY='testing',
+    AWS_STORAGE_BUCKET_NAME='test-bucket',
+    AWS_S3_REGION_NAME='eu-north-1',
+    MEDIA_DEDUPLICATE=True,
+    MEDIA_CONTENT_ADDRESSED_PREFIXES=('post_images/',),
+    MEDIA_DELETE_QUEUE=True
+)
+class MediaDeletionQueueTests(TestCase):
+    """Tests for the queued, batched S3 deletes"""
+
+    def setUp(self):
+        self.storage = MediaStorage(bucket_name='test-bucket')
+        self.stubber = Stubber(get_s3_client())
+        self.stubber.activate()
+        self.addCleanup(self.stubber.deactivate)
+
+    def test_delete_is_queued_and_drained_in_one_call(self):
+        """Test that deletes make no S3 call and the worker sends one DeleteObjects with retries for failures"""
+        self.storage.delete('game_logos/a.png')
+        self.storage.delete('game_logos/b.png')
+        self.stubber.assert_no_pending_responses()
+        self.assertEqual(MediaDeletion.objects.count(), 2)
+
+        self.stubber.add_response('delete_objects', {
+            'Errors': [{'Key': 'media/game_logos/b.png', 'Code': 'InternalError', 'Message': 'try again'}]
+        })
+        self.assertEqual(process_batch(), (1, 1))
+        self.stubber.assert_no_pending_responses()
+
+        failed = MediaDeletion.objects.get()
+        self.assertEqual(failed.key, 'media/game_logos/b.png')
+        self.assertEqual(failed.attempts, 1)
+        self.assertGreater(failed.next_attempt_at, timezone.now())
+        # Неуспешният ключ изчаква преди следващия опит
+        self.assertEqual(process_batch(), (0, 0))
+
+    def test_deletion_cancelled_after_claim_is_skipped(self):
+        """Test that a key written again after a worker claimed it is not deleted"""
+        self.storage.delete('game_logos/a.png')
+        claim = media_deletion.claim_batch
+
+        def claim_then_cancel(batch_size):
+            ids = claim(batch_size)
+            media_deletion.cancel_deletion('test-bucket', 'media/game_logos/a.png')
+            return ids
+
+        with mock.patch.object(media_deletion, 'claim_batch', side_effect=claim_then_cancel):
+            self.assertEqual(process_batch(), (0, 0))
+        self.stubber.assert_no_pending_responses()
+
+    def test_reuploaded_blob_cancels_pending_deletion(self):
+        """Test that saving content again removes its queued deletion"""
+        self.stubber.add_response('put_object', {'ETag': '"abc"'})
+        self.stubber.add_response('put_object', {'ETag': '"abc"'})
+        key = self.storage.save('post_images/a.png', ContentFile(b'meme'))
+        self.storage.delete(key)
+        self.assertTrue(MediaDeletion.objects.filter(key=f"media/{key}").exists())
+
+        self.storage.save('post_images/b.png', ContentFile(b'meme'))
+        self.stubber.assert_no_pending_responses()
+        self.assertFalse(MediaDeletion.objects.exists())
+
+
+@override_settings(
+    AWS_ACCESS_KEY_ID='testing',
+    AWS_SECRET_ACCESS_KEY='testing',
+    AWS_STORAGE_BUCKET_NAME='test-bucket',
+    AWS_S3_REGION_NAME='eu-north-1',
+    MEDIA_DELETE_QUEUE=False
+)
+class SharedS3ClientTests(APITestCase):
+    """Tests for the process-wide S3 client and its metrics"""
+
+    def setUp(self):
+        self.s3 = get_s3_client()
+        self.stubber = Stubber(self.s3)
+        self.stubber.activate()
+        self.addCleanup(self.stubber.deactivate)
+
+    def test_client_is_shared_and_tuned(self):
+        """Test that every caller gets the same client with the pooled config"""
+        created = get_s3_metrics()['clients_created']
+        self.assertIs(get_s3_client(), self.s3)
+        self.assertEqual(get_s3_metrics()['clients_created'], created)
+        self.assertEqual(self.s3.meta.config.max_pool_connections, 50)
+        self.assertEqual(self.s3.meta.config.retries['mode'], 'standard')
+
+    def test_storage_paths_use_shared_client(self):
+        """Test that exists and delete go through the shared client and are counted"""
+        storage = MediaStorage(bucket_name='test-bucket')
+        calls = get_s3_metrics()['api_calls']
+        self.stubber.add_response(
+            'head_object', {'ContentLength': 5},
+            {'Bucket': 'test-bucket', 'Key': 'media/avatars/a.png'}
+        )
+        self.stubber.add_response(
+            'delete_object', {},
+            {'Bucket': 'test-bucket', 'Key': 'media/avatars/a.png'}
+        )
+        self.assertTrue(storage.exists('avatars/a.png'))
+        storage.delete('avatars/a.png')
+        self.stubber.assert_no_pending_responses()
+        self.assertEqual(get_s3_metrics()['api_calls'], calls + 2)
+
+    def test_metrics_endpoint_requires_admin(self):
+        """Test that only staff can read the storage metrics"""
+        user = MyUser.objects.create_user(
+            username='user1', email='user1@example.com', password='password123'
+        )
+        self.client.force_authenticate(user=user)
+        url = reverse('storage-metrics')
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_403_FORBIDDEN)
+
+        user.is_staff = True
+        user.save()
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn('connection_reuse', response.data)
+
+
+@override_settings(
+    AWS_ACCESS_KEY_ID='testing',
+    AWS_SECRET_ACCESS_KEY='testing',
+    AWS_STORAGE_BUCKET_NAME='test-bucket',
+    AWS_S3_REGION_NAME='eu-north-1'
+)
+class MediaMigrationTests(TestCase):
+    """Tests for the resumable bulk migration in s3_uploader"""
+
+    def setUp(self):
+        import s3_uploader
+        self.uploader = s3_uploader
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.media = os.path.join(self.tmp.name, 'avatars')
+        os.makedirs(self.media)
+        for name, data in (('a.png', b'aaaa'), ('b.png', b'bbbbbb')):
+            with open(os.path.join(self.media, name), 'wb') as fh:
+                fh.write(data)
+        self.manifest_path = os.path.join(self.tmp.name, 'manifest.jsonl')
+        self.stubber = Stubber(get_s3_client())
+        self.stubber.activate()
+        self.addCleanup(self.stubber.deactivate)
+
+    def migrate(self, dry_run=False):
+        manifest = self.uploader.UploadManifest(self.manifest_path)
+        files = sorted(self.uploader.collect_files(self.media, 'media/avatars'))
+        return self.uploader.migrate_files(files, manifest, workers=1, dry_run=dry_run)
+
+    def test_skips_matching_objects_and_resumes_from_manifest(self):
+        """Test that matching size/ETag skips the upload and a rerun makes no S3 calls"""
+        etag = hashlib.md5(b'aaaa').hexdigest()
+        self.stubber.add_response('head_object', {'ContentLength': 4, 'ETag': f'"{etag}"'})
+        self.stubber.add_client_error('head_object', service_error_code='404', http_status_code=404)
+        self.stubber.add_response('put_object', {'ETag': '"x"'})
+
+        counts = self.migrate()
+        self.assertEqual(counts, {'uploaded': 1, 'skipped': 1, 'failed': 0})
+        self.stubber.assert_no_pending_responses()
+
+        # Второто изпълнение не трябва да прави заявки - всичко е в манифеста
+        self.assertEqual(self.migrate(), {'uploaded': 0, 'skipped': 2, 'failed': 0})
+
+    def test_dry_run_uploads_nothing(self):
+        """Test that a dry run only checks the bucket and leaves the manifest empty"""
+        self.stubber.add_client_error('head_object', service_error_code='404', http_status_code=404)
+        self.stubber.add_client_error('head_object', service_error_code='404', http_status_code=404)
+
+        self.assertEqual(self.migrate(dry_run=True), {'uploaded': 2, 'skipped': 0, 'failed': 0})
+        self.stubber.assert_no_pending_responses()
+        self.assertFalse(os.path.exists(self.manifest_path))
+
+
+@override_settings(
+    DEFAULT_FILE_STORAGE='django.core.files.storage.FileSystemStorage',
+    MEDIA_DERIVATIVE_WORKERS=0
+)
+class MediaDerivativeTests(APITestCase):
+    """Tests for the thumbnail pipeline in base/media_derivatives.py"""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        media = override_settings(MEDIA_ROOT=self.tmp.name)
+        media.enable()
+        self.addCleanup(media.disable)
+        self.user = MyUser.objects.create_user(
+            username='user1', email='user1@example.com', password='password123'
+        )
+        self.client.force_authenticate(user=self.user)
+
+    def make_image(self, name, size=(800, 600)):
+        buffer = io.BytesIO()
+        Image.new('RGB', size, (200, 30, 30)).save(buffer, format='PNG')
+        return SimpleUploadedFile(name, buffer.getvalue(), content_type='image/png')
+
+    def test_avatar_thumbnails_generated_after_upload(self):
+        """Test that an avatar upload records thumbnails and serves the small one to chat lists"""
+        url = reverse('upload-avatar', kwargs={'username': 'user1'})
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(url, {'avatar': self.make_image('me.png')}, format='multipart')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        self.user.refresh_from_db()
+        record = self.user.avatar_derivatives
+        self.assertEqual(record['source'], self.user.avatar.name)
+        small = record['sizes']['sm']['webp']
+        with self.user.avatar.storage.open(small) as fh:
+            self.assertLessEqual(max(Image.open(fh).size), 64)
+
+        data = UserSerializer(self.user).data
+        self.assertIn('webp', data['avatar_variants']['md'])
+        self.assertTrue(InboxParticipantSerializer(self.user).data['avatar_url'].endswith('sm.webp'))
+
+    def test_replaced_avatar_released_after_save(self):
+        """Test that the previous avatar is removed only once the new one is saved"""
+        url = reverse('upload-avatar', kwargs={'username': 'user1'})
+        self.client.post(url, {'avatar': self.make_image('a.png')}, format='multipart')
+        self.user.refresh_from_db()
+        old_name = self.user.avatar.name
+
+        with mock.patch.object(MyUser, 'save', side_effect=RuntimeError('db down')):
+            with self.assertRaises(RuntimeError):
+                self.client.post(url, {'avatar': self.make_image('b.png')}, format='multipart')
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.avatar.name, old_name)
+        self.assertTrue(self.user.avatar.storage.exists(old_name))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(url, {'avatar': self.make_image('c.png')}, format='multipart')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.user.refresh_from_db()
+        self.assertNotEqual(self.user.avatar.name, old_name)
+        self.assertTrue(self.user.avatar.storage.exists(self.user.avatar.name))
+        self.assertFalse(self.user.avatar.storage.exists(old_name))
+
+    def test_replaced_image_does_not_use_old_thumbnails(self):
+        """Test that thumbnails of a previous file are ignored and removed"""
+        with self.captureOnCommitCallbacks(execute=True):
+            post = Post.objects.create(user=self.user, image=self.make_image('a.png'))
+        post.refresh_from_db()
+        old_small = post.image_derivatives['sizes']['sm']['webp']
+
+        with self.captureOnCommitCallbacks(execute=True):
+            post.image = self.make_image('b.png')
+            post.save()
+            self.assertIsNone(PostSerializer(post).data['image_variants'])
+        post.refresh_from_db()
+        self.assertEqual(post.image_derivatives['source'], post.image.name)
+        self.assertFalse(post.image.storage.exists(old_small))
+
+    def test_regenerating_releases_previous_thumbnails(self):
+        """Test that a rerun for the same file replaces the old thumbnails instead of adding copies"""
+        with self.captureOnCommitCallbacks(execute=True):
+            post = Post.objects.create(user=self.user, image=self.make_image('a.png'))
+        post.refresh_from_db()
+        old_record = post.image_derivatives
+
+        with self.captureOnCommitCallbacks(execute=True):
+            new_record = process_instance(Post, post.pk)
+        storage = post.image.storage
+        for size, variants in old_record['sizes'].items():
+            for fmt, name in variants.items():
+                self.assertNotEqual(new_record['sizes'][size][fmt], name)
+                self.assertFalse(storage.exists(name))
+                self.assertTrue(storage.exists(new_record['sizes'][size][fmt]))
+
+    def test_thumbnails_of_replaced_file_are_dropped(self):
+        """Test that thumbnails generated for a file replaced meanwhile are removed, not recorded"""
+        post = Post.objects.create(user=self.user, image=self.make_image('a.png'))
+        generated = []
+
+        def generate_then_replace(fieldfile, kind):
+            generated.append(generate_derivatives(fieldfile, kind))
+            Post.objects.filter(pk=post.pk).update(image='post_images/other.png')
+            return generated[-1]
+
+        with mock.patch('base.media_derivatives.generate_derivatives', side_effect=generate_then_replace):
+            with self.captureOnCommitCallbacks(execute=True):
+                self.assertIsNone(process_instance(Post, post.pk))
+        post.refresh_from_db()
+        self.assertIsNone(post.image_derivatives)
+        for variants in generated[0]['sizes'].values():
+            for name in variants.values():
+                self.assertFalse(post.image.storage.exists(name))
+
+    def test_documents_are_skipped(self):
+        """Test that non-image chat files get no thumbnails"""
+        chat = Chat.objects.create()
+        chat.participants.add(self.user)
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            Message.objects.create(
+                chat=chat, sender=self.user,
+                image=SimpleUploadedFile('notes.pdf', b'%PDF-1.4', content_type='application/pdf')
+            )
+        self.assertEqual(callbacks, [])
+
+
+@override_settings(
+    AWS_ACCESS_KEY_ID='testing',
+    AWS_SECRET_ACCESS_KEY='testing',
+    AWS_STORAGE_BUCKET_NAME='test-bucket',
+    AWS_S3_REGION_NAME='eu-north-1'
+)
+class OrphanedMediaTests(TestCase):
+    """Tests for the collect_orphaned_media command"""
+
+    def setUp(self):
+        user = MyUser.objects.create_user(
+            username='user1', email='user1@example.com', password='password123'
+        )
+        MyUser.objects.filter(pk=user.pk).update(avatar='profile_pics/me.png')
+        self.stubber = Stubber(get_s3_client())
+        self.stubber.activate()
+        self.addCleanup(self.stubber.deactivate)
+
+        old = timezone.now() - timezone.timedelta(days=3)
+        Post.objects.filter(pk=Post.objects.create(user=user).pk).update(
+            image='blobs/ab/abc.png',
+            image_derivatives={'source': 'blobs/ab/abc.png', 'sizes': {'sm': {'webp': 'blobs/12/123.webp'}}}
+        )
+        for key, referenced_at in [
+            ('blobs/ab/abc.png', old), ('blobs/12/123.webp', old),
+            ('blobs/ef/efg.png', old), ('blobs/34/345.png', timezone.now()),
+        ]:
+            MediaBlob.objects.create(key=key, sha256=key, size=3, ref_count=1, referenced_at=referenced_at)
+
+        contents = [
+            ('media/_derivatives/profile_pics/me.png/sm.webp', old),
+            ('media/_derivatives/profile_pics/gone.png/sm.webp', old),
+            ('media/blobs/12/123.webp', old),
+            ('media/blobs/34/345.png', old),
+            ('media/blobs/ab/abc.png', old),
+            ('media/blobs/cd/cde.png', old),
+            ('media/blobs/ef/efg.png', old),
+            ('media/chat_files/uploading.pdf', timezone.now()),
+            ('media/profile_pics/me.png', old),
+            ('media/profile_pics/old.png', old),
+        ]
+        self.stubber.add_response('list_objects_v2', {
+            'Contents': [{'Key': key, 'LastModified': modified, 'Size': 10} for key, modified in contents],
+            'IsTruncated': False
+        })
+
+    def test_reports_orphans_without_deleting(self):
+        """Test that only unreferenced objects older than the cutoff are reported"""
+        out = io.StringIO()
+        call_command('collect_orphaned_media', stdout=out)
+        self.stubber.assert_no_pending_responses()
+
+        reported = {line.split(' ')[1] for line in out.getvalue().splitlines() if line.startswith('orphan:')}
+        # Брояч без препратки не пази обекта; скоро използваният - да
+        self.assertEqual(reported, {
+            '_derivatives/profile_pics/gone.png/sm.webp', 'blobs/cd/cde.png',
+            'blobs/ef/efg.png', 'profile_pics/old.png'
+        })
+
+    def test_deletes_orphans_in_one_batch(self):
+        """Test that --delete removes a page of orphans with one DeleteObjects call"""
+        self.stubber.add_response('delete_objects', {})
+        out = io.StringIO()
+        call_command('collect_orphaned_media', '--delete', stdout=out)
+        self.stubber.assert_no_pending_responses()
+        self.assertIn('4 orphans', out.getvalue())
+        self.assertIn('4 deleted', out.getvalue())
+        self.assertEqual(
+            set(MediaBlob.objects.values_list('key', flat=True)),
+            {'blobs/ab/abc.png', 'blobs/12/123.webp', 'blobs/34/345.png'}
+        )
+
+
+@override_settings(
+    AWS_ACCESS_KEY_ID='testing',
+    AWS_SECRET_ACCESS_KEY='testing',
+    AWS_STORAGE_BUCKET_NAME='test-bucket',
+    AWS_S3_REGION_NAME='eu-north-1',
+    AWS_S3_CUSTOM_DOMAIN=None,
+    MEDIA_CDN_DOMAIN=None
+)
+class MediaStorageURLTests(TestCase):
+    """Tests for cached URL generation in MediaStorage.url"""
+
+    def test_urls_are_cached(self):
+        """Test that repeated lookups of a name are served from the cache"""
+        storage = MediaStorage(bucket_name='test-bucket', querystring_auth=False)
+        url = storage.url('profile_pics/me 1.png')
+        self.assertEqual(url, 'https://test-bucket.s3.eu-north-1.amazonaws.com/media/profile_pics/me%201.png')
+        self.assertEqual(storage.url('profile_pics/me 1.png'), url)
+        self.assertEqual(storage.get_url_cache().hits, 1)
+
+    @override_settings(MEDIA_CDN_DOMAIN='cdn.example.com')
+    def test_cdn_domain(self):
+        """Test that MEDIA_CDN_DOMAIN replaces the bucket host"""
+        storage = MediaStorage(bucket_name='test-bucket', querystring_auth=False)
+        self.assertEqual(storage.url('avatars/a.png'), 'https://cdn.example.com/media/avatars/a.png')
+
+    def test_signed_urls_reused_within_window(self):
+        """Test that a signed URL is reused for half its lifetime and re-signed after"""
+        storage = MediaStorage(bucket_name='test-bucket', querystring_auth=True, querystring_expire=600)
+        with mock.patch('backend.storage_backends.time.time', return_value=1000):
+            first = storage.url('chat_files/a.pdf')
+        with mock.patch('backend.storage_backends.time.time', return_value=1250):
+            self.assertEqual(storage.url('chat_files/a.pdf'), first)
+        self.assertIn('X-Amz-Signature', first)
+
+        with mock.patch('backend.storage_backends.time.time', return_value=1300):
+            storage.url('chat_files/a.pdf')
+        self.assertEqual(storage.get_url_cache().misses, 2)
+
+
+@unittest.skipUnless(connection.vendor == 'sqlite', 'Query plans are checked on SQLite')
+class QueryPlanIndexTests(TestCase):
+    """Tests that the hot chat and feed queries use their composite indexes"""
+    
+    def setUp(self):
+        self.user1 = MyUser.objects.create_user(
+            username='user1',
+            email='user1@example.com',
+            password='password123'
+        )
+        self.user2 = MyUser.objects.create_user(
+            username='user2',
+            email='user2@example.com',
+            password='password123'
+        )
+        self.chat = Chat.objects.create()
+        self.chat.participants.add(self.user1, self.user2)
+        self.post = Post.objects.create(user=self.user1, caption='Test post')
+    
+    def assertUsesIndex(self, queryset, index_name):
+        plan = queryset.explain()
+        self.assertIn(index_name, plan)
+    
+    def test_message_history_uses_chat_created_index(self):
+        """Test the history page query"""
+        queryset = Message.objects.filter(chat=self.chat).order_by('-created_at', '-id')[:20]
+        self.assertUsesIndex(queryset, 'message_chat_created_idx')
+    
+    def test_unread_count_uses_read_cursor_index(self):
+        """Test the unread count query (answered from the index alone)"""
+        queryset = Message.objects.filter(
+            chat=self.chat, id__gt=0
+        ).exclude(sender=self.user1).order_by().values('pk')
+        self.assertUsesIndex(queryset, 'message_chat_id_sender_idx')
+    
+    def test_user_posts_use_user_created_index(self):
+        """Test the user's posts feed query"""
+        queryset = Post.objects.filter(user=self.user1).order_by('-created_at')
+        self.assertUsesIndex(queryset, 'post_user_created_idx')
+    
+    def test_top_level_comments_use_post_parent_index(self):
+        """Test the top-level comments query"""
+        queryset = Comment.objects.filter(post=self.post, parent=None)
+        self.assertUsesIndex(queryset, 'comment_post_parent_idx')
+
+
+class ChatRealtimeTests(TestCase):
+    """Tests for real-time chat delivery (WebSocket and long-poll)"""
+    
+    def setUp(self):
+        self.user1 = MyUser.objects.create_user(
+            username='user1',
+            email='user1@example.com',
+            password='password123'
+        )
+        self.user2 = MyUser.objects.create_user(
+            username='user2',
+            email='user2@example.com',
+            password='password123'
+        )
+        self.chat = Chat.objects.create()
+        self.chat.participants.add(self.user1, self.user2)
+    
+    async def open_socket(self, token):
+        """Starts the socket handler with in-memory receive/send queues"""
+        incoming = asyncio.Queue()
+        outgoing = asyncio.Queue()
+        scope = {
+            'type': 'websocket',
+            'path': '/ws/chat/',
+            'query_string': f'token={token}'.encode(),
+        }
+        task = asyncio.ensure_future(chat_socket(scope, incoming.get, outgoing.put))
+        await incoming.put({'type': 'websocket.connect'})
+        return task, incoming, outgoing
+    
+    async def test_participant_receives_new_message(self):
+        """Test that a new message is pushed to the other participant"""
+        token = str(AccessToken.for_user(self.user1))
+        task, incoming, outgoing = await self.open_socket(token)
+        accepted = await asyncio.wait_for(outgoing.get(), 5)
+        self.assertEqual(accepted['type'], 'websocket.accept')
+        
+        def send_message():
+            with self.captureOnCommitCallbacks(execute=True):
+                return self.chat.add_message(self.user2, content='Hello over the socket')
+        message = await sync_to_async(send_message)()
+        
+        pushed = await asyncio.wait_for(outgoing.get(), 5)
+        payload = json.loads(pushed['text'])
+        self.assertEqual(payload['type'], 'message.created')
+        self.assertEqual(payload['chat'], self.chat.id)
+        self.assertEqual(payload['message']['id'], message.id)
+        self.assertEqual(payload['message']['content'], 'Hello over the socket')
+        
+        await incoming.put({'type': 'websocket.disconnect', 'code': 1000})
+        await asyncio.wait_for(task, 5)
+    
+    async def test_long_poll_returns_new_message(self):
+        """Test that a parked long-poll request wakes up when a message arrives"""
+        token = str(AccessToken.for_user(self.user1))
+        url = reverse('message-wait', kwargs={'chat_id': self.chat.id})
+        since = timezone.now().isoformat()
+        request = asyncio.ensure_future(self.async_client.get(
+            url,
+            {'after_timestamp': since, 'timeout': 5},
+            headers={'Authorization': f'Bearer {token}'}
+        ))
+        await asyncio.sleep(0.1)
+        
+        def send_message():
+            with self.captureOnCommitCallbacks(execute=True):
+                return self.chat.add_message(self.user2, content='Wake up')
+        message = await sync_to_async(send_message)()
+        
+        response = await asyncio.wait_for(request, 5)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.json()
+        self.assertEqual(len(data), 1)
+        self.assertEqual(data[0]['id'], message.id)
+        # Същите редове като простия списък на MessageListView
+        self.assertEqual(data[0]['sender']['id'], self.user2.id)
+        self.assertEqual(data[0]['sender']['username'], self.user2.username)
+    
+    async def test_long_poll_times_out_with_empty_list(self):
+        """Test that a long-poll request with no new messages returns an empty list"""
+        token = str(AccessToken.for_user(self.user1))
+        url = reverse('message-wait', kwargs={'chat_id': self.chat.id})
+        response = await self.async_client.get(
+            url,
+            {'after_timestamp': timezone.now().isoformat(), 'timeout': 0.1},
+            headers={'Authorization': f'Bearer {token}'}
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json(), [])
+    
+    async def test_long_poll_rejects_bad_parameters(self):
+        """Test that malformed long-poll parameters are a 400, not a 500"""
+        token = str(AccessToken.for_user(self.user1))
+        url = reverse('message-wait', kwargs={'chat_id': self.chat.id})
+        for params in ({'after_timestamp': '2024-13-45T00:00'},
+                       {'after_timestamp': timezone.now().isoformat(), 'limit': 'many'},
+                       {'after_timestamp': timezone.now().isoformat(), 'timeout': 'nan'},
+                       {'after_timestamp': timezone.now().isoformat(), 'timeout': 'inf'},
+                       {'after_timestamp': timezone.now().isoformat(), 'timeout': 'soon'}):
+            response = await self.async_client.get(url, params, headers={'Authorization': f'Bearer {token}'})
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+    
+    async def test_invalid_token_is_rejected(self):
+        """Test that a socket without a valid token is closed"""
+        task, incoming, outgoing = await self.open_socket('not-a-token')
+        closed = await asyncio.wait_for(outgoing.get(), 5)
+        self.assertEqual(closed['type'], 'websocket.close')
+        await asyncio.wait_for(task, 5)
+
+
 class SearchAPITests(APITestCase):
     """Tests for search functionality"""
     
@@ -497,7 +1716,122 @@ class SearchAPITests(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(len(response.data), 1)
         self.assertEqual(response.data[0]['username'], 'casualplayer')
-    
+
+    def test_platform_and_language_filters_ignore_blank_values(self):
+        """Test that list filters trim spaces and skip empty items"""
+        response = self.client.get(f"{self.search_url}?platforms=Xbox, Mac&languages=English,")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([user['username'] for user in response.data], ['gamer123'])
+
+    def test_search_by_active_hours_in_utc(self):
+        """Test that active hours are matched in UTC through the stored mask"""
+        self.assertEqual(self.user1.active_hours_mask, (1 << 14) | (1 << 15) | (1 << 16))
+
+        # 22:00 в София (+2) е 20:00 UTC
+        self.user2.timezone_offset = 2
+        self.user2.active_hours = ['22:00']
+        self.user2.save(update_fields=['timezone_offset', 'active_hours'])
+        self.user2.refresh_from_db()
+        self.assertEqual(self.user2.active_hours_mask, 1 << 20)
+
+        response = self.client.get(f"{self.search_url}?active_hours=20:00")
+        self.assertEqual([user['username'] for user in response.data], ['casualplayer'])
+        response = self.client.get(f"{self.search_url}?active_hours=16:00,22:00")
+        self.assertEqual([user['username'] for user in response.data], ['gamer123'])
+        response = self.client.get(f"{self.search_url}?active_hours=03:00")
+        self.assertEqual(response.data, [])
+
+    def test_profile_update_rewrites_attribute_links(self):
+        """Test that platforms and languages are mirrored into the link tables"""
+        self.assertEqual(
+            set(self.user1.platform_tags.values_list('name', flat=True)), {'PC', 'Xbox'}
+        )
+
+        self.client.force_authenticate(user=self.user1)
+        response = self.client.patch(
+            reverse('update-profile', kwargs={'username': 'gamer123'}),
+            {'platforms': json.dumps(['PC', ' Switch ', 'PC']), 'language_preference': json.dumps([])}
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            set(self.user1.platform_tags.values_list('name', flat=True)), {'PC', 'Switch'}
+        )
+        self.assertFalse(self.user1.language_tags.exists())
+        # Двамата потребители делят един ред за Switch
+        self.assertEqual(Platform.objects.filter(name='Switch').count(), 1)
+
+        response = self.client.get(f"{self.search_url}?platforms=Switch")
+        self.assertEqual(
+            sorted(user['username'] for user in response.data), ['casualplayer', 'gamer123']
+        )
+
+    def test_search_facets(self):
+        """Test facet counts, each computed without its own filter"""
+        response = self.client.get(f"{reverse('search-facets')}?platforms=PC&mic_available=true")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            response.data['platforms'],
+            [{'name': 'PC', 'count': 1}, {'name': 'Xbox', 'count': 1}]
+        )
+        self.assertEqual(
+            response.data['languages'],
+            [{'name': 'English', 'count': 1}, {'name': 'German', 'count': 1}]
+        )
+
+        response = self.client.get(reverse('search-facets'))
+        self.assertEqual(len(response.data['platforms']), 4)
+
+    def test_search_pages_by_relevance_then_id(self):
+        """Test cursor pagination over results ordered by relevance, then id"""
+        for i in range(4):
+            MyUser.objects.create_user(
+                username=f'player{i}', email=f'player{i}@example.com', password='password123',
+                display_name='Gamer' if i == 2 else None
+            )
+        MyUser.objects.create_user(username='gamer', email='exact@example.com', password='password123')
+
+        seen = []
+        cursor = None
+        while True:
+            url = f"{self.search_url}?q=gamer&limit=2" + (f"&cursor={cursor}" if cursor else '')
+            with self.assertNumQueries(2):
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertLessEqual(len(response.data['results']), 2)
+            seen += [user['username'] for user in response.data['results']]
+            cursor = response.data['next_cursor']
+            if not cursor:
+                break
+
+        # Точно име, начало на името, начало на показваното име, останалите
+        self.assertEqual(seen, ['gamer', 'gamer123', 'player2'])
+
+        response = self.client.get(f"{self.search_url}?cursor=garbage")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.get(f"{self.search_url}?limit=0")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_legacy_search_list_is_not_capped(self):
+        """Test that the plain list without paging parameters returns every match"""
+        with mock.patch.object(SearchView, 'max_limit', 1):
+            response = self.client.get(self.search_url)
+            self.assertEqual(len(response.data), 2)
+            response = self.client.get(f"{self.search_url}?limit=5")
+            self.assertEqual(len(response.data['results']), 1)
+
+    def test_search_count_estimate(self):
+        """Test that counting is exact up to the cap and a lower bound past it"""
+        response = self.client.get(f"{self.search_url}?count=estimate")
+        self.assertEqual(response.data['count'], 2)
+        self.assertTrue(response.data['count_exact'])
+
+        with mock.patch.object(SearchView, 'count_cap', 1):
+            response = self.client.get(f"{self.search_url}?count=estimate&limit=1")
+        self.assertEqual(response.data['count'], 1)
+        self.assertFalse(response.data['count_exact'])
+        self.assertEqual(len(response.data['results']), 1)
+        self.assertIsNotNone(response.data['next_cursor'])
+
     def test_search_by_mic_availability(self):
         """Test searching users by mic availability"""
         response = self.client.get(f"{self.search_url}?mic_available=true")
@@ -520,6 +1854,106 @@ class SearchAPITests(APITestCase):
         self.assertEqual(response.data[0]['username'], 'gamer123')
 
 
+@override_settings(MATCH_FEATURES_TTL=0)
+class TeammateMatchingTests(APITestCase):
+    """Tests for teammate match scoring"""
+
+    def setUp(self):
+        self.game = Game.objects.create(name='Ranked Game')
+        self.other_game = Game.objects.create(name='Other Game')
+        rank_system = RankSystem.objects.create(game=self.game, name='Tiers')
+        self.tiers = [
+            RankTier.objects.create(rank_system=rank_system, name=f'Tier {order}', order=order)
+            for order in range(1, 6)
+        ]
+        competitive = PlayerGoal.objects.create(name='Competitive', description='Win')
+        casual = PlayerGoal.objects.create(name='Casual', description='Fun')
+
+        def player(username, languages, platforms, hours, game, tier=None, goal=None):
+            user = MyUser.objects.create_user(
+                username=username, email=f'{username}@example.com', password='password123',
+                language_preference=languages, platforms=platforms, active_hours=hours
+            )
+            stats = GameStats.objects.create(user=user, game=game, hours_played=100, player_goal=goal)
+            if tier:
+                GameRanking.objects.create(game_stats=stats, rank_system=rank_system, rank=self.tiers[tier - 1])
+            return user
+
+        self.seeker = player('seeker', ['English'], ['PC'], ['18:00', '19:00', '20:00'], self.game, 3, competitive)
+        self.twin = player('twin', ['English'], ['PC'], ['18:00', '19:00', '20:00'], self.game, 3, competitive)
+        self.close = player('close', ['German'], ['PC'], ['19:00'], self.game, 5, casual)
+        self.stranger = player('stranger', ['French'], ['Switch'], ['03:00'], self.other_game)
+
+    def test_rank_candidates(self):
+        """Test that the weighted parts order candidates from best to worst"""
+        ids, scores = rank_candidates(self.seeker)
+        self.assertEqual(ids.tolist(), [self.twin.id, self.close.id, self.stranger.id])
+        self.assertAlmostEqual(float(scores[0]), 1.0, places=5)
+        # Игра 0.3 + ранг 0.2 * 0.5 + часове 0.2 / 3 + платформа 0.05
+        self.assertAlmostEqual(float(scores[1]), 0.3 + 0.1 + 0.2 / 3 + 0.05, places=5)
+        self.assertAlmostEqual(float(scores[2]), 0.0, places=5)
+
+        ids, scores = rank_candidates(self.seeker, [self.stranger.id, self.close.id], weights={'platform': 1})
+        self.assertEqual(ids.tolist(), [self.close.id, self.stranger.id])
+
+    def test_search_ordered_by_match(self):
+        """Test match ordering, scores and cursors in the search endpoint"""
+        url = reverse('search')
+        response = self.client.get(f"{url}?order=match")
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+        self.client.force_authenticate(user=self.seeker)
+        with override_settings(MATCH_FEATURES_TTL=300, MATCH_FEATURES_REFRESH=0):
+            response = self.client.get(f"{url}?order=match&limit=2&count=estimate")
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual([user['username'] for user in response.data['results']], ['twin', 'close'])
+            self.assertEqual(response.data['results'][0]['match_score'], 1.0)
+            self.assertEqual(response.data['count'], 3)
+            cursor = response.data['next_cursor']
+
+            response = self.client.get(f"{url}?order=match&limit=2&cursor={cursor}")
+            self.assertEqual([user['username'] for user in response.data['results']], ['stranger'])
+            self.assertIsNone(response.data['next_cursor'])
+
+        # След ново построяване на матрицата курсорът вече не важи
+        response = self.client.get(f"{url}?order=match&limit=2&cursor={cursor}")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        response = self.client.get(f"{url}?order=match&platforms=PC")
+        self.assertEqual([user['username'] for user in response.data], ['twin', 'close'])
+
+    @override_settings(MATCH_FEATURES_TTL=300, MATCH_FEATURES_REFRESH=0)
+    def test_feature_matrix_rebuilt_after_changes(self):
+        """Test that the cached matrix is reused until a profile changes"""
+        matrix = get_feature_matrix()
+        self.assertIs(get_feature_matrix(), matrix)
+        self.assertEqual(len(matrix), 4)
+
+        # Входът записва само last_login
+        self.stranger.last_login = timezone.now()
+        self.stranger.save(update_fields=['last_login'])
+        self.assertIs(get_feature_matrix(), matrix)
+
+        self.stranger.language_preference = ['English']
+        self.stranger.save()
+        # Докато се строи новата матрица, останалите заявки ползват текущата
+        build = FeatureMatrix.build
+        during_build = []
+
+        def build_and_read(*args, **kwargs):
+            during_build.append(get_feature_matrix())
+            return build(*args, **kwargs)
+
+        with mock.patch.object(FeatureMatrix, 'build', side_effect=build_and_read):
+            rebuilt = get_feature_matrix()
+        self.assertEqual(during_build, [matrix])
+        self.assertIsNot(rebuilt, matrix)
+        self.assertIs(get_feature_matrix(), rebuilt)
+        row = rebuilt.user_ids.tolist().index(self.stranger.id)
+        self.assertTrue(rebuilt.languages[row, rebuilt.language_index['English']])
+        self.assertNotIn('French', rebuilt.language_index)
+
+
 class PasswordResetAPITests(APITestCase):
     """Tests for password reset functionality"""
     
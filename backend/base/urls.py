@@ -10,6 +10,8 @@ from .views import (
     GameStatsListView,
     GameStatsUpdateView,
     SearchView,
+    SearchFacetsView,
+    StorageMetricsView,
     UploadAvatarView,
     FollowUserView,
     UnfollowUserView,
@@ -30,9 +32,14 @@ from .views import (
     CommentRepliesView,
     ChatListView,
     ChatDetailView,
+    InboxView,
+    ChatAttachmentPresignView,
+    ChatAttachmentConfirmView,
+    UnreadSummaryView,
     ChatReadView,
     MessageListView,
     MessageDetailView,
+    MessageSearchView,
     MessageReplyView,
     MutualFollowersView,
     PasswordResetRequestView,
@@ -40,7 +47,7 @@ from .views import (
     MessageStatusView,
 )
 # Import the new SimpleChatsView
-from .views.chat_views import SimpleChatsView, ChatDebugView, raw_chats_view
+from .views.chat_views import SimpleChatsView, ChatDebugView, raw_chats_view, wait_for_messages_view
 
 # Всички API крайни точки
 urlpatterns = [
@@ -52,6 +59,7 @@ urlpatterns = [
     path('users/<str:username>/game-stats/', GameStatsListView.as_view(), name='game-stats'),
     path('users/<str:username>/game-stats/<int:game_id>/', GameStatsUpdateView.as_view(), name='update-game-stats'),
     path('search/', SearchView.as_view(), name='search'),
+    path('search/facets/', SearchFacetsView.as_view(), name='search-facets'),
     path('users/<str:username>/avatar/', UploadAvatarView.as_view(), name='upload-avatar'),
     path('users/<str:username>/follow/', FollowUserView.as_view(), name='follow-user'),
     path('users/<str:username>/unfollow/', UnfollowUserView.as_view(), name='unfollow-user'),
@@ -74,6 +82,8 @@ urlpatterns = [
     path('comments/<int:comment_id>/', CommentView.as_view(), name='comment-detail'),
     path('comments/<int:comment_id>/replies/', CommentRepliesView.as_view(), name='comment-replies'),
     path('chats/', ChatListView.as_view(), name='chat-list'),
+    path('chats/inbox/', InboxView.as_view(), name='chat-inbox'),
+    path('chats/unread/', UnreadSummaryView.as_view(), name='chat-unread'),
     # Add the simplified chats route
     path('simple-chats/', SimpleChatsView.as_view(), name='simple-chats-list'),
     # Add chat debug route
@@ -81,11 +91,16 @@ urlpatterns = [
     path('raw-chats/', raw_chats_view, name='raw-chats'),
     path('chats/<int:chat_id>/', ChatDetailView.as_view(), name='chat-detail'),
     path('chats/<int:chat_id>/messages/', MessageListView.as_view(), name='message-list'),
+    path('chats/<int:chat_id>/messages/wait/', wait_for_messages_view, name='message-wait'),
     path('chats/<int:chat_id>/read/', ChatReadView.as_view(), name='chat-read'),
+    path('chats/<int:chat_id>/attachments/presign/', ChatAttachmentPresignView.as_view(), name='chat-attachment-presign'),
+    path('chats/<int:chat_id>/attachments/confirm/', ChatAttachmentConfirmView.as_view(), name='chat-attachment-confirm'),
+    path('messages/search/', MessageSearchView.as_view(), name='message-search'),
     path('messages/<int:message_id>/', MessageDetailView.as_view(), name='message-detail'),
     path('messages/<int:message_id>/replies/', MessageReplyView.as_view(), name='message-replies'),
     path('messages/<int:message_id>/status/', MessageStatusView.as_view(), name='message-status'),
     path('users/<str:username>/mutual-followers/', MutualFollowersView.as_view(), name='mutual-followers'),
+    path('storage/metrics/', StorageMetricsView.as_view(), name='storage-metrics'),
 ]
 #Добавя медийни файлове в режим на разработка
 if settings.DEBUG:
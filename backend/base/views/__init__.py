@@ -38,14 +38,21 @@ from .social_views import (
 from .chat_views import (
     ChatListView,
     ChatDetailView,
+    InboxView,
+    ChatAttachmentPresignView,
+    ChatAttachmentConfirmView,
+    UnreadSummaryView,
     ChatReadView,
     MessageListView,
     MessageDetailView,
+    MessageSearchView,
     MessageReplyView,
     MessageStatusView
 )
 
-from .search_views import SearchView
+from .search_views import SearchView, SearchFacetsView
+
+from .storage_views import StorageMetricsView
 
 from .password_views import (
     PasswordResetRequestView,
@@ -64,7 +71,7 @@ def test_s3_upload(request):
     try:
         logger.error("Starting S3 test upload...")
         from django.conf import settings
-        import boto3
+        from backend.storage_backends import get_s3_client
         
         # Check settings
         logger.error(f"AWS settings check - Key exists: {bool(settings.AWS_ACCESS_KEY_ID)}")
@@ -72,10 +79,7 @@ def test_s3_upload(request):
         logger.error(f"AWS settings check - Region: {settings.AWS_S3_REGION_NAME}")
         
         # Test direct boto3 upload
-        s3 = boto3.client('s3',
-                       aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
-                       aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
-                       region_name=settings.AWS_S3_REGION_NAME)
+        s3 = get_s3_client()
         
         test_content = b"This is a test upload via direct boto3 call"
         s3.put_object(
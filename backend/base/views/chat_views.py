@@ -3,19 +3,39 @@ from rest_framework.response import Response
 from rest_framework import status, permissions
 from rest_framework.parsers import MultiPartParser, FormParser
 from django.http import Http404, JsonResponse
-from ..models import Chat, Message, MyUser
+from ..models import Chat, ChatMembership, Message, MyUser
 from ..serializers import (
     ChatSerializer,
+    InboxChatSerializer,
+    InboxParticipantSerializer,
+    MessageListSerializer,
     MessageSerializer
 )
+from ..realtime import notify_new_message, get_broadcast, chat_group
+from ..message_search import get_message_index
+from asgiref.sync import sync_to_async
+from rest_framework.utils.encoders import JSONEncoder
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework.exceptions import AuthenticationFailed
+from django.conf import settings
+from django.core import signing
+from backend.storage_backends import create_presigned_upload, get_uploaded_object
+import asyncio
+import hashlib
+import json
+import math
+from django.utils.http import quote_etag, parse_etags
 from django.utils.dateparse import parse_datetime
 from django.utils import timezone
 import logging
 import os
 from django.utils.text import slugify
 import uuid
-from django.db.models import Q
+from django.db import transaction
+from django.db.models import F, Q, OuterRef, Subquery, Count, Prefetch, Value
+from django.db.models.functions import Coalesce
 import mimetypes
+from ..pagination import encode_cursor, decode_cursor, keyset_before, keyset_after, InvalidCursor
 
 # Configure logging
 logger = logging.getLogger(__name__)
@@ -73,6 +93,29 @@ def is_image_file(filename, content_type=None):
     return guessed_type and guessed_type.startswith('image/') and 'svg' not in guessed_type
 
 
+# Заявки за списъка с чатове на потребител
+def get_chat_list(user):
+    """
+    Returns the user's chats ready for ChatSerializer plus a {chat_id: unread}
+    map: last message and participants are loaded up front and unread counts
+    come from the membership rows, so the number of queries doesn't grow
+    with the number of chats.
+    """
+    participants = MyUser.objects.annotate(
+        followers_total=Count('followers', distinct=True),
+        following_total=Count('following', distinct=True)
+    )
+    chats = Chat.objects.filter(participants=user).select_related(
+        'last_message__sender'
+    ).prefetch_related(
+        Prefetch('participants', queryset=participants)
+    )
+    unread_counts = dict(
+        ChatMembership.objects.filter(user=user).values_list('chat_id', 'unread_count')
+    )
+    return chats, unread_counts
+
+
 class ChatListView(APIView):
     """
     Списък на всички чатове или създаване на нов чат.
@@ -98,8 +141,7 @@ class ChatListView(APIView):
             
             # Try to get chats with explicit error handling
             try:
-                chats = Chat.objects.filter(participants=request.user)
-                logger.info(f"Found {chats.count()} chats for user {request.user.username}")
+                chats, unread_counts = get_chat_list(request.user)
             except Exception as db_error:
                 logger.error(f"Database error in ChatListView.get: {str(db_error)}")
                 return Response(
@@ -110,7 +152,11 @@ class ChatListView(APIView):
             # Serialize with explicit error handling
             try:
                 # Use a smaller context and simpler serialization
-                serializer = ChatSerializer(chats, many=True, context={'request': request})
+                serializer = ChatSerializer(
+                    chats,
+                    many=True,
+                    context={'request': request, 'unread_counts': unread_counts}
+                )
                 return Response(serializer.data)
             except Exception as ser_error:
                 logger.error(f"Serialization error in ChatListView.get: {str(ser_error)}")
@@ -152,21 +198,13 @@ class ChatListView(APIView):
                     status=status.HTTP_400_BAD_REQUEST
                 )
 
-            # Check if chat already exists between these users
-            existing_chats = Chat.objects.filter(participants=request.user).filter(participants=other_user)
-            
-            if existing_chats.exists():
-                existing_chat = existing_chats.first()
-                serializer = ChatSerializer(existing_chat, context={'request': request})
-                return Response(serializer.data)
-
-            # Create new chat
-            chat = Chat.objects.create()
-            chat.participants.add(request.user, other_user)
-            chat.save()
+            # Return the existing chat between these users or create it
+            chat, created = Chat.get_or_create_direct(request.user, other_user)
             
             serializer = ChatSerializer(chat, context={'request': request})
-            return Response(serializer.data, status=status.HTTP_201_CREATED)
+            if created:
+                return Response(serializer.data, status=status.HTTP_201_CREATED)
+            return Response(serializer.data)
 
         except Exception as e:
             print(f"Error in ChatListView.post: {str(e)}")
@@ -231,6 +269,240 @@ class ChatDetailView(APIView):
             )
 
 
+class InboxView(APIView):
+    """
+    Списък с чатове за входящата кутия - страницата се зарежда с две заявки.
+    
+    Query params:
+        limit: chats per page (default 20, max 50)
+        cursor: next_cursor from the previous page
+    """
+    permission_classes = [permissions.IsAuthenticated]
+    default_limit = 20
+    max_limit = 50
+    
+    def get(self, request):
+        try:
+            limit = min(int(request.query_params.get('limit', self.default_limit)), self.max_limit)
+            if limit < 1:
+                raise ValueError
+        except ValueError:
+            return Response({'detail': 'Невалиден брой чатове на страница'}, status=status.HTTP_400_BAD_REQUEST)
+        
+        # Последното съобщение и броячът са денормализирани, затова стигат една заявка
+        # за чатовете и една за участниците
+        chats = Chat.objects.filter(memberships__user=request.user).annotate(
+            unread=F('memberships__unread_count')
+        ).select_related(
+            'last_message__sender'
+        ).prefetch_related(
+            Prefetch('participants', queryset=MyUser.objects.only('id', 'username', 'display_name', 'avatar', 'avatar_derivatives'))
+        ).order_by('-updated_at', '-id')
+        
+        cursor = request.query_params.get('cursor')
+        if cursor:
+            try:
+                payload = decode_cursor(cursor)
+                boundary = parse_datetime(payload['t'])
+                if boundary is None:
+                    raise InvalidCursor('Invalid cursor')
+                chats = chats.filter(keyset_before('updated_at', boundary, int(payload['id'])))
+            except (InvalidCursor, KeyError, TypeError, ValueError):
+                return Response({'detail': 'Невалиден курсор'}, status=status.HTTP_400_BAD_REQUEST)
+        
+        page = list(chats[:limit + 1])
+        has_more = len(page) > limit
+        page = page[:limit]
+        
+        next_cursor = None
+        if has_more:
+            last = page[-1]
+            next_cursor = encode_cursor({'t': last.updated_at.isoformat(), 'id': last.id})
+        
+        serializer = InboxChatSerializer(page, many=True, context={'request': request})
+        return Response({
+            'results': serializer.data,
+            'next_cursor': next_cursor
+        })
+
+
+class UnreadSummaryView(APIView):
+    """
+    Брой непрочетени съобщения за значката в хедъра.
+    
+    Returns {"total": n, "chats": {chat_id: n}} from the membership counters
+    in a single query. The response carries an ETag, and a poll that sends
+    it back in If-None-Match gets an empty 304 while nothing has changed.
+    """
+    permission_classes = [permissions.IsAuthenticated]
+    
+    def get(self, request):
+        counts = ChatMembership.objects.filter(
+            user=request.user, unread_count__gt=0
+        ).order_by('chat_id').values_list('chat_id', 'unread_count')
+        chats = {str(chat_id): unread for chat_id, unread in counts}
+        
+        # ETag-ът зависи само от броячите, затова е еднакъв докато няма нови съобщения
+        digest = hashlib.md5(json.dumps(chats, sort_keys=True).encode()).hexdigest()
+        etag = quote_etag(digest)
+        
+        if etag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', '')):
+            response = Response(status=status.HTTP_304_NOT_MODIFIED)
+        else:
+            response = Response({'total': sum(chats.values()), 'chats': chats})
+        response['ETag'] = etag
+        # Браузърът пази отговора, но винаги го проверява отново
+        response['Cache-Control'] = 'private, no-cache'
+        return response
+
+
+# Подпис на токена за потвърждаване на директно качване
+UPLOAD_TOKEN_SALT = 'base.chat-attachment-upload'
+
+
+class ChatAttachmentPresignView(APIView):
+    """
+    Първа стъпка на директно качване: подписана форма за качване в S3.
+    
+    Body: {"filename", "content_type", "size"}. The browser POSTs the file to
+    "url" with "fields" and then calls the confirm endpoint with "upload_token",
+    so the file itself never passes through Django.
+    """
+    permission_classes = [permissions.IsAuthenticated]
+    
+    def post(self, request, chat_id):
+        if not ChatMembership.objects.filter(chat_id=chat_id, user=request.user).exists():
+            return Response(
+                {'detail': 'Чатът не е намерен или не сте участник'},
+                status=status.HTTP_404_NOT_FOUND
+            )
+        
+        filename = str(request.data.get('filename', '')).strip()
+        content_type = str(request.data.get('content_type') or '').strip() or \
+            mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        try:
+            size = int(request.data.get('size', 0))
+        except (TypeError, ValueError):
+            size = 0
+        
+        max_size = settings.CHAT_ATTACHMENT_MAX_SIZE
+        if not filename or size < 1:
+            return Response({'detail': 'Името и размерът на файла са задължителни'}, status=status.HTTP_400_BAD_REQUEST)
+        if size > max_size:
+            return Response(
+                {'detail': f'Файлът е по-голям от {max_size // (1024 * 1024)}MB'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        # Same naming as MessageListView.post, grouped by chat and uploader
+        base_name, ext = os.path.splitext(filename)
+        unique_filename = f"{slugify(base_name) or 'file'}_{uuid.uuid4().hex[:8]}{ext.lower()}"
+        name = f"chat_files/{chat_id}/{request.user.id}/{unique_filename}"
+        expires_in = settings.CHAT_UPLOAD_URL_EXPIRES
+        
+        try:
+            upload = create_presigned_upload(name, content_type, max_size, expires_in)
+        except Exception as e:
+            logger.error(f"Error creating presigned upload for chat {chat_id}: {str(e)}")
+            return Response(
+                {'detail': 'Неуспешна подготовка на качването'},
+                status=status.HTTP_500_INTERNAL_SERVER_ERROR
+            )
+        
+        upload_token = signing.dumps(
+            {'name': name, 'chat': chat_id, 'user': request.user.id, 'type': content_type},
+            salt=UPLOAD_TOKEN_SALT
+        )
+        return Response({
+            'url': upload['url'],
+            'fields': upload['fields'],
+            'upload_token': upload_token,
+            'expires_in': expires_in,
+        })
+
+
+class ChatAttachmentConfirmView(APIView):
+    """
+    Втора стъпка на директно качване: създава съобщението с вече качения файл.
+    
+    Body: {"upload_token", "content" (optional), "parent" (optional)}.
+    Повторно потвърждение със същия токен връща вече създаденото съобщение
+    (200) - два реда с един и същ файл биха го изтрили заедно с първия.
+    """
+    permission_classes = [permissions.IsAuthenticated]
+    
+    def post(self, request, chat_id):
+        try:
+            membership = ChatMembership.objects.select_related('chat').get(chat_id=chat_id, user=request.user)
+        except ChatMembership.DoesNotExist:
+            return Response(
+                {'detail': 'Чатът не е намерен или не сте участник'},
+                status=status.HTTP_404_NOT_FOUND
+            )
+        
+        try:
+            upload = signing.loads(
+                str(request.data.get('upload_token', '')),
+                salt=UPLOAD_TOKEN_SALT,
+                max_age=settings.CHAT_UPLOAD_URL_EXPIRES * 2
+            )
+        except signing.BadSignature:
+            return Response({'detail': 'Невалиден или изтекъл токен за качване'}, status=status.HTTP_400_BAD_REQUEST)
+        if upload['chat'] != chat_id or upload['user'] != request.user.id:
+            return Response({'detail': 'Невалиден или изтекъл токен за качване'}, status=status.HTTP_400_BAD_REQUEST)
+        
+        existing = Message.objects.filter(image=upload['name']).first()
+        if existing is not None:
+            return Response(MessageSerializer(existing).data, status=status.HTTP_200_OK)
+        
+        parent = None
+        parent_id = request.data.get('parent')
+        if parent_id:
+            parent = Message.objects.filter(id=parent_id, chat_id=chat_id).first()
+            if parent is None:
+                return Response({'detail': 'Parent message does not exist'}, status=status.HTTP_400_BAD_REQUEST)
+        
+        try:
+            uploaded = get_uploaded_object(upload['name'])
+        except Exception as e:
+            logger.error(f"Error checking uploaded file {upload['name']}: {str(e)}")
+            return Response(
+                {'detail': 'Неуспешна проверка на качения файл'},
+                status=status.HTTP_500_INTERNAL_SERVER_ERROR
+            )
+        if uploaded is None:
+            return Response({'detail': 'Файлът не е качен'}, status=status.HTTP_400_BAD_REQUEST)
+        size, content_type = uploaded
+        content_type = content_type or upload['type']
+        
+        unique_filename = os.path.basename(upload['name'])
+        message = Message(
+            chat=membership.chat,
+            sender=request.user,
+            content=str(request.data.get('content', '')).strip(),
+            parent=parent,
+            file_info={
+                'name': unique_filename,
+                'type': content_type,
+                'size': size,
+                'is_image': is_image_file(unique_filename, content_type)
+            }
+        )
+        message.image.name = upload['name']
+        with transaction.atomic():
+            # Едновременните потвърждения на един потребител в чата се изчакват
+            ChatMembership.objects.select_for_update().get(pk=membership.pk)
+            existing = Message.objects.filter(image=upload['name']).first()
+            if existing is not None:
+                return Response(MessageSerializer(existing).data, status=status.HTTP_200_OK)
+            message.save()
+        
+        notify_new_message(message)
+        
+        serializer = MessageSerializer(message)
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+
+
 class ChatReadView(APIView):
     """
     Маркиране на всички съобщения в чат като прочетени за текущия потребител.
@@ -239,23 +511,22 @@ class ChatReadView(APIView):
     
     def post(self, request, chat_id):
         try:
-            chat = Chat.objects.get(id=chat_id, participants=request.user)
+            membership = ChatMembership.objects.get(chat_id=chat_id, user=request.user)
             
-            # Find all unread messages in this chat sent by other users
-            unread_messages = Message.objects.filter(
-                chat=chat,
-                is_read=False
-            ).exclude(sender=request.user)
-            
-            # Mark all as read
-            updated_count = unread_messages.update(is_read=True)
+            # Move the read cursor to the newest message - a single row update
+            latest_id = Message.objects.filter(chat_id=chat_id).order_by('-id').values_list('id', flat=True).first()
+            if latest_id:
+                membership.mark_read(latest_id)
             
             return Response(
-                {"detail": f"Маркирани {updated_count} съобщения като прочетени."}, 
+                {
+                    "detail": "Чатът е маркиран като прочетен.",
+                    "last_read_message_id": membership.last_read_message_id
+                },
                 status=status.HTTP_200_OK
             )
             
-        except Chat.DoesNotExist:
+        except ChatMembership.DoesNotExist:
             return Response(
                 {'detail': 'Чатът не е намерен или не сте участник'},
                 status=status.HTTP_404_NOT_FOUND
@@ -268,22 +539,68 @@ class ChatReadView(APIView):
             )
 
 
+# Данни, нужни на MessageListSerializer, заредени с една заявка
+def with_row_data(messages_query):
+    """
+    Joins in the senders and adds the reply count as a correlated subquery,
+    which only runs for the rows that make it into the page.
+    """
+    replies = Message.objects.filter(parent=OuterRef('pk')).order_by().values('parent').annotate(
+        total=Count('id')
+    ).values('total')
+    return messages_query.select_related(
+        'sender', 'parent__sender'
+    ).annotate(
+        replies_total=Coalesce(Subquery(replies), Value(0))
+    )
+
+
+def serialize_senders(request, messages):
+    """Returns {sender_id: short user data} with every author of the page once"""
+    senders = {}
+    serializer = InboxParticipantSerializer(context={'request': request})
+    for msg in messages:
+        if msg.sender_id not in senders:
+            senders[msg.sender_id] = serializer.to_representation(msg.sender)
+    return senders
+
+
 class MessageListView(APIView):
     """
     Списък на всички съобщения в чат или създаване на ново съобщение.
     """
     permission_classes = [permissions.IsAuthenticated]
     parser_classes = [MultiPartParser, FormParser]
+    max_limit = 100
 
     def get(self, request, chat_id):
+        """
+        Returns a page of messages, oldest first.
+        
+        Two ways to page:
+        - cursor mode (?cursor=, empty for the newest page): responds with
+          {"results", "senders", "next_cursor", "prev_cursor"}; rows carry the
+          sender id and "senders" maps it to the user's short data.
+          next_cursor loads older history, prev_cursor loads messages newer
+          than the page.
+        - legacy ?before_id= / ?after_timestamp=: responds with a plain list
+          whose rows carry the short sender data inline.
+        
+        Both are keyset scans on (created_at, id), so messages sharing a
+        timestamp are never skipped or repeated.
+        """
         try:
-            import logging
-            logger = logging.getLogger(__name__)
-            
             # Pagination parameters
-            limit = int(request.query_params.get('limit', 20))  # Default 20 messages
-            before_id = request.query_params.get('before_id')  # Message ID to load messages before
+            try:
+                limit = min(int(request.query_params.get('limit', 20)), self.max_limit)  # Default 20 messages
+                before_id = request.query_params.get('before_id')  # Message ID to load messages before
+                before_id = int(before_id) if before_id else None
+                if limit < 1:
+                    raise ValueError
+            except ValueError:
+                return Response({'detail': 'Невалидни параметри за страниране'}, status=status.HTTP_400_BAD_REQUEST)
             after_timestamp = request.query_params.get('after_timestamp')  # Timestamp to load messages after
+            cursor_mode = 'cursor' in request.query_params
             
             logger.info(f"Fetching messages for chat {chat_id}, before_id={before_id}, after_timestamp={after_timestamp}")
             
@@ -296,40 +613,23 @@ class MessageListView(APIView):
                     status=status.HTTP_404_NOT_FOUND
                 )
             
-            # Start with all messages in this chat - use only_fields to specify exactly which fields we need
-            try:
-                # Only select fields that actually exist in the database
-                messages_query = Message.objects.filter(chat=chat).only(
-                    'id', 'chat', 'sender', 'content', 'image', 'parent', 
-                    'is_edited', 'is_read', 'is_delivered', 'created_at', 'updated_at'
-                )
-                logger.info(f"Found {messages_query.count()} messages in chat {chat_id}")
-            except Exception as query_error:
-                logger.error(f"Error querying messages: {str(query_error)}")
-                return Response(
-                    {'detail': f'Грешка при извличане на съобщения: {str(query_error)}'},
-                    status=status.HTTP_500_INTERNAL_SERVER_ERROR
-                )
+            messages_query = self.get_page_queryset(chat)
+            
+            if cursor_mode:
+                return self.get_cursor_page(request, messages_query, limit)
             
             # Filter messages before the given ID if specified
             if before_id:
-                try:
-                    before_message = Message.objects.get(id=before_id)
-                    messages_query = messages_query.filter(created_at__lt=before_message.created_at)
-                except Message.DoesNotExist:
-                    logger.warning(f"Message with ID {before_id} not found")
-                    pass
-                except Exception as e:
-                    logger.warning(f"Error filtering by before_id {before_id}: {str(e)}")
-                    # Continue without this filter
+                # Resolve the boundary inside the same query instead of a separate lookup
+                boundary = Message.objects.filter(id=before_id, chat=chat).values('created_at')[:1]
+                messages_query = messages_query.filter(
+                    Q(created_at__lt=Subquery(boundary)) |
+                    Q(created_at=Subquery(boundary), id__lt=before_id)
+                )
             
             # Filter messages after the given timestamp if specified
             if after_timestamp:
                 try:
-                    # Parse the timestamp and convert to timezone-aware datetime if needed
-                    from django.utils.dateparse import parse_datetime
-                    from django.utils import timezone
-                    
                     parsed_timestamp = parse_datetime(after_timestamp)
                     
                     # Make it timezone-aware if it's not
@@ -344,79 +644,111 @@ class MessageListView(APIView):
                     # Continue without timestamp filtering
             
             # Get messages in the appropriate order and limit the result
-            try:
-                if after_timestamp:
-                    # For newer messages, use ascending order (oldest to newest)
-                    messages = messages_query.order_by('created_at')[:limit]
-                else:
-                    # For older messages, use descending order (newest to oldest) and reverse for display
-                    messages = messages_query.order_by('-created_at')[:limit]
-                    messages = list(reversed(messages))
-                
-                logger.info(f"Returning {len(messages)} messages for chat {chat_id}")
-            except Exception as order_error:
-                logger.error(f"Error sorting messages: {str(order_error)}")
-                # Fall back to basic query with safe SQL
-                from django.db import connection
-                cursor = connection.cursor()
-                try:
-                    # Use raw SQL that doesn't reference the problematic columns
-                    cursor.execute(
-                        "SELECT id, chat_id, sender_id, content, image, parent_id, is_edited, is_read, is_delivered, created_at, updated_at "
-                        "FROM base_message WHERE chat_id = %s ORDER BY created_at DESC LIMIT %s",
-                        [chat_id, limit]
-                    )
-                    message_ids = [row[0] for row in cursor.fetchall()]
-                    messages = Message.objects.filter(id__in=message_ids).order_by('-created_at')[:limit]
-                    messages = list(reversed(messages))
-                    logger.info(f"Used fallback query to get {len(messages)} messages")
-                except Exception as sql_error:
-                    logger.error(f"SQL error in fallback query: {str(sql_error)}")
-                    return Response(
-                        {'detail': f'Critical database error: {str(sql_error)}'},
-                        status=status.HTTP_500_INTERNAL_SERVER_ERROR
-                    )
+            if after_timestamp:
+                # For newer messages, use ascending order (oldest to newest)
+                messages = list(messages_query.order_by('created_at', 'id')[:limit])
+            else:
+                # For older messages, use descending order (newest to oldest) and reverse for display
+                messages = list(reversed(messages_query.order_by('-created_at', '-id')[:limit]))
             
-            # Serialize messages with error handling
-            try:
-                import traceback
-                logger.info(f"Serializing {len(messages)} messages")
-                # Try to serialize messages one by one to identify problematic messages
-                serialized_messages = []
-                problem_message_ids = []
-                
-                for msg in messages:
-                    try:
-                        msg_serializer = MessageSerializer(msg, context={'request': request})
-                        serialized_messages.append(msg_serializer.data)
-                    except Exception as msg_error:
-                        logger.error(f"Error serializing message {msg.id}: {str(msg_error)}")
-                        logger.error(traceback.format_exc())
-                        problem_message_ids.append(msg.id)
-                
-                if problem_message_ids:
-                    logger.warning(f"Skipped problematic messages: {problem_message_ids}")
-                
-                return Response(serialized_messages)
-            except Exception as ser_error:
-                logger.error(f"Error serializing messages: {str(ser_error)}")
-                import traceback
-                logger.error(traceback.format_exc())
-                return Response(
-                    {'detail': f'Грешка при обработка на съобщения: {str(ser_error)}'},
-                    status=status.HTTP_500_INTERNAL_SERVER_ERROR
-                )
+            logger.info(f"Returning {len(messages)} messages for chat {chat_id}")
+            return Response(self.serialize_messages(request, messages, expand_senders=True))
                 
         except Exception as e:
-            import logging
-            logger = logging.getLogger(__name__)
-            logger.error(f"Unexpected error in MessageListView.get: {str(e)}")
             import traceback
+            logger.error(f"Unexpected error in MessageListView.get: {str(e)}")
             logger.error(traceback.format_exc())
             return Response(
                 {'detail': f'Неочаквана грешка: {str(e)}'},
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR
             )
+    
+    def get_cursor_page(self, request, messages_query, limit):
+        """Serves one page in cursor mode"""
+        raw_cursor = request.query_params.get('cursor')
+        direction = 'before'
+        if raw_cursor:
+            try:
+                position = decode_cursor(raw_cursor)
+                direction = position['d']
+                created_at = parse_datetime(position['t'])
+                message_id = int(position['id'])
+                if direction not in ('before', 'after') or created_at is None:
+                    raise InvalidCursor('Invalid cursor')
+            except (InvalidCursor, KeyError, TypeError, ValueError):
+                return Response({'detail': 'Невалиден курсор'}, status=status.HTTP_400_BAD_REQUEST)
+            
+            if direction == 'before':
+                messages_query = messages_query.filter(keyset_before('created_at', created_at, message_id))
+            else:
+                messages_query = messages_query.filter(keyset_after('created_at', created_at, message_id))
+        
+        # Fetch one extra row to know whether there is more in this direction
+        if direction == 'before':
+            page = list(messages_query.order_by('-created_at', '-id')[:limit + 1])
+            has_more = len(page) > limit
+            messages = list(reversed(page[:limit]))
+        else:
+            page = list(messages_query.order_by('created_at', 'id')[:limit + 1])
+            has_more = len(page) > limit
+            messages = page[:limit]
+        
+        next_cursor = None
+        prev_cursor = raw_cursor or None
+        if messages:
+            oldest, newest = messages[0], messages[-1]
+            # Older history exists if we were paging back and got a full page, or if we paged forward at all
+            if direction == 'after' or has_more:
+                next_cursor = encode_cursor({'d': 'before', 't': oldest.created_at.isoformat(), 'id': oldest.id})
+            prev_cursor = encode_cursor({'d': 'after', 't': newest.created_at.isoformat(), 'id': newest.id})
+        
+        senders = serialize_senders(request, messages)
+        return Response({
+            'results': self.serialize_messages(request, messages),
+            'senders': senders,
+            'next_cursor': next_cursor,
+            'prev_cursor': prev_cursor,
+        })
+    
+    def get_page_queryset(self, chat):
+        """Messages of the chat with everything a MessageListSerializer row needs"""
+        return with_row_data(Message.objects.filter(chat=chat))
+    
+    def serialize_messages(self, request, messages, expand_senders=False):
+        """
+        Serializes a page of messages, skipping any that fail so one bad row
+        doesn't break the chat. With expand_senders each row gets the short
+        sender data inline (for clients of the plain list response).
+        """
+        import traceback
+        serialized_messages = []
+        problem_message_ids = []
+        
+        # Read cursors of the chat, loaded once for the whole page
+        context = {'request': request}
+        if messages:
+            context['read_cursors'] = dict(
+                ChatMembership.objects.filter(chat_id=messages[0].chat_id).values_list('user_id', 'last_read_message_id')
+            )
+        senders = serialize_senders(request, messages) if expand_senders else None
+        
+        # Един сериализатор за цялата страница вместо нов за всеки ред
+        msg_serializer = MessageListSerializer(context=context)
+        for msg in messages:
+            try:
+                data = msg_serializer.to_representation(msg)
+                if senders is not None:
+                    data['sender'] = senders[msg.sender_id]
+                serialized_messages.append(data)
+            except Exception as msg_error:
+                logger.error(f"Error serializing message {msg.id}: {str(msg_error)}")
+                logger.error(traceback.format_exc())
+                problem_message_ids.append(msg.id)
+        
+        if problem_message_ids:
+            logger.warning(f"Skipped problematic messages: {problem_message_ids}")
+        
+        return serialized_messages
 
     def post(self, request, chat_id):
         """
@@ -541,8 +873,8 @@ class MessageListView(APIView):
                         status=status.HTTP_500_INTERNAL_SERVER_ERROR
                     )
             
-            # Update chat's updated_at field
-            chat.save()
+            # Push the message to the participants' open sockets
+            notify_new_message(message)
             
             # Serialize and return the new message
             serializer = MessageSerializer(message)
@@ -565,6 +897,92 @@ class MessageListView(APIView):
             )
 
 
+class MessageSearchView(APIView):
+    """
+    Търсене в съобщенията от всички чатове на потребителя.
+    
+    Query params:
+        q: text to search for (required)
+        chat: only search this chat
+        limit: hits per page (default 20, max 50)
+        cursor: next_cursor from the previous page
+    
+    Responds with {"results", "senders", "next_cursor"}; results are compact
+    message rows (see MessageListSerializer), best match first.
+    """
+    permission_classes = [permissions.IsAuthenticated]
+    default_limit = 20
+    max_limit = 50
+    
+    def get(self, request):
+        query = request.query_params.get('q', '').strip()
+        if not query:
+            return Response({'detail': 'Въведете текст за търсене'}, status=status.HTTP_400_BAD_REQUEST)
+        
+        try:
+            limit = min(int(request.query_params.get('limit', self.default_limit)), self.max_limit)
+            chat_id = request.query_params.get('chat')
+            chat_id = int(chat_id) if chat_id else None
+            if limit < 1:
+                raise ValueError
+        except ValueError:
+            return Response({'detail': 'Невалидни параметри за търсене'}, status=status.HTTP_400_BAD_REQUEST)
+        
+        after = None
+        cursor = request.query_params.get('cursor')
+        if cursor:
+            try:
+                payload = decode_cursor(cursor)
+                after = (float(payload['s']), int(payload['id']))
+            except (InvalidCursor, KeyError, TypeError, ValueError):
+                return Response({'detail': 'Невалиден курсор'}, status=status.HTTP_400_BAD_REQUEST)
+        
+        message_index = get_message_index()
+        if message_index is None:
+            return Response(
+                {'detail': 'Търсенето не се поддържа от тази база данни'},
+                status=status.HTTP_501_NOT_IMPLEMENTED
+            )
+        
+        try:
+            hits = message_index.search(request.user, query, limit + 1, chat_id=chat_id, after=after)
+        except Exception as e:
+            logger.error(f"Message search failed for '{query}': {str(e)}")
+            return Response(
+                {'detail': 'Търсенето не успя. Опитайте отново.'},
+                status=status.HTTP_500_INTERNAL_SERVER_ERROR
+            )
+        
+        has_more = len(hits) > limit
+        hits = hits[:limit]
+        next_cursor = None
+        if has_more:
+            last_id, _, last_score = hits[-1]
+            next_cursor = encode_cursor({'s': last_score, 'id': last_id})
+        
+        # Редовете се зареждат наведнъж и се подреждат като резултатите
+        rows = with_row_data(Message.objects.filter(id__in=[hit[0] for hit in hits])).in_bulk()
+        messages = [rows[hit[0]] for hit in hits if hit[0] in rows]
+        
+        chat_ids = {message.chat_id for message in messages}
+        chat_read_cursors = {}
+        for membership_chat_id, user_id, last_read_id in ChatMembership.objects.filter(
+            chat_id__in=chat_ids
+        ).values_list('chat_id', 'user_id', 'last_read_message_id'):
+            chat_read_cursors.setdefault(membership_chat_id, {})[user_id] = last_read_id
+        
+        serializer = MessageListSerializer(
+            messages,
+            many=True,
+            context={'request': request, 'chat_read_cursors': chat_read_cursors}
+        )
+        return Response({
+            'results': serializer.data,
+            'senders': serialize_senders(request, messages),
+            'next_cursor': next_cursor,
+        })
+
+
 class MessageDetailView(APIView):
     """
     Извличане, актуализиране или изтриване на съобщение.
@@ -656,8 +1074,7 @@ class MessageReplyView(APIView):
                 parent=parent_message
             )
             
-            # Update the chat's updated_at timestamp
-            parent_message.chat.save()
+            notify_new_message(serializer.instance)
             
             return Response(serializer.data, status=status.HTTP_201_CREATED)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
@@ -684,9 +1101,9 @@ class MessageStatusView(APIView):
             return Response({"detail": "Не можете да отбележите собствените си съобщения като прочетени."}, 
                           status=status.HTTP_400_BAD_REQUEST)
         
-        # Mark as read
-        message.is_read = True
-        message.save()
+        # Mark as read by moving the user's read cursor up to this message
+        membership = ChatMembership.objects.get(chat_id=message.chat_id, user=request.user)
+        membership.mark_read(message.id)
         
         return Response({"detail": "Съобщението е отбелязано като прочетено."}, status=status.HTTP_200_OK)
 
@@ -705,7 +1122,12 @@ class SimpleChatsView(APIView):
             
             try:
                 # Get chat objects but don't use complex prefetch_related
-                chats = Chat.objects.filter(participants=request.user).order_by('-updated_at')
+                chats = Chat.objects.filter(participants=request.user).select_related(
+                    'last_message__sender'
+                ).prefetch_related('participants').order_by('-updated_at')
+                unread_counts = dict(
+                    ChatMembership.objects.filter(user=request.user).values_list('chat_id', 'unread_count')
+                )
                 
                 # Manually construct a simple response
                 for chat in chats:
@@ -722,7 +1144,7 @@ class SimpleChatsView(APIView):
                         # Get last message with minimal processing
                         last_message = None
                         try:
-                            last_msg = chat.messages.order_by('-created_at').first()
+                            last_msg = chat.last_message
                             if last_msg:
                                 last_message = {
                                     'id': last_msg.id,
@@ -733,11 +1155,7 @@ class SimpleChatsView(APIView):
                         except Exception:
                             pass
                         
-                        # Count unread messages safely
-                        try:
-                            unread_count = chat.messages.filter(is_read=False).exclude(sender=request.user).count()
-                        except Exception:
-                            unread_count = 0
+                        unread_count = unread_counts.get(chat.id, 0)
                         
                         # Add to result
                         chats_data.append({
@@ -873,7 +1291,12 @@ def raw_chats_view(request):
     
     try:
         # Get all chats for this user
-        chats = Chat.objects.filter(participants=request.user).order_by('-updated_at')
+        chats = Chat.objects.filter(participants=request.user).select_related(
+            'last_message__sender'
+        ).prefetch_related('participants').order_by('-updated_at')
+        unread_counts = dict(
+            ChatMembership.objects.filter(user=request.user).values_list('chat_id', 'unread_count')
+        )
         
         # Prepare response manually
         chats_data = []
@@ -899,7 +1322,7 @@ def raw_chats_view(request):
                     })
                 
                 # Get last message
-                last_message = chat.messages.order_by('-created_at').first()
+                last_message = chat.last_message
                 if last_message:
                     chat_data['last_message'] = {
                         'id': last_message.id,
@@ -910,11 +1333,7 @@ def raw_chats_view(request):
                     }
                 
                 # Count unread messages
-                chat_data['unread_count'] = chat.messages.filter(
-                    is_read=False
-                ).exclude(
-                    sender=request.user
-                ).count()
+                chat_data['unread_count'] = unread_counts.get(chat.id, 0)
                 
                 # Add to result
                 chats_data.append(chat_data)
@@ -925,4 +1344,91 @@ def raw_chats_view(request):
         return JsonResponse(chats_data, safe=False)
     except Exception as e:
         print(f"Error in raw_chats_view: {str(e)}")
-        return JsonResponse({'error': str(e)}, status=500) 
\ No newline at end of file
+        return JsonResponse({'error': str(e)}, status=500)
+
+
+@sync_to_async
+def _get_poll_context(request, chat_id):
+    """
+    Authenticates the JWT from the Authorization header and checks that the user
+    takes part in the chat. Returns (user, error_response).
+    """
+    try:
+        auth_result = JWTAuthentication().authenticate(request)
+    except AuthenticationFailed:
+        auth_result = None
+    if auth_result is None:
+        return None, JsonResponse({'detail': 'Authentication credentials were not provided.'}, status=401)
+
+    user = auth_result[0]
+    if not Chat.objects.filter(id=chat_id, participants=user).exists():
+        return None, JsonResponse({'detail': 'Чатът не е намерен или не сте участник'}, status=404)
+    return user, None
+
+
+@sync_to_async
+def _get_messages_after(request, chat_id, after, limit):
+    """
+    Serializes the chat's messages created strictly after the given timestamp,
+    in the rows of MessageListView's plain list (short sender data inline)
+    """
+    messages = list(
+        with_row_data(Message.objects.filter(chat_id=chat_id, created_at__gt=after)).order_by('created_at', 'id')[:limit]
+    )
+    return MessageListView().serialize_messages(request, messages, expand_senders=True)
+
+
+async def wait_for_messages_view(request, chat_id):
+    """
+    Long-poll version of GET chats/<id>/messages/?after_timestamp=.
+
+    Returns the messages newer than after_timestamp straight away if there are any.
+    Otherwise the request is parked until a message lands in the chat or the
+    timeout (seconds, ?timeout=, capped by CHAT_LONG_POLL_MAX_TIMEOUT) runs out,
+    in which case it returns an empty list. The response has the same shape as
+    MessageListView.get, so clients can switch between the two freely.
+    """
+    if request.method != 'GET':
+        return JsonResponse({'detail': 'Method not allowed'}, status=405)
+
+    user, error_response = await _get_poll_context(request, chat_id)
+    if error_response is not None:
+        return error_response
+
+    try:
+        after = parse_datetime(request.GET.get('after_timestamp', ''))
+    except ValueError:
+        return JsonResponse({'detail': 'Невалиден after_timestamp'}, status=400)
+    if after is None:
+        return JsonResponse({'detail': 'after_timestamp is required'}, status=400)
+    if timezone.is_naive(after):
+        after = timezone.make_aware(after)
+
+    max_timeout = getattr(settings, 'CHAT_LONG_POLL_MAX_TIMEOUT', 30)
+    try:
+        wait_timeout = float(request.GET.get('timeout', max_timeout))
+        # nan минава през min/max и wait_for никога не изтича
+        if not math.isfinite(wait_timeout):
+            raise ValueError
+        wait_timeout = min(max(wait_timeout, 0), max_timeout)
+    except ValueError:
+        return JsonResponse({'detail': 'Невалиден timeout'}, status=400)
+    try:
+        limit = min(max(int(request.GET.get('limit', 50)), 1), MessageListView.max_limit)
+    except ValueError:
+        return JsonResponse({'detail': 'Невалиден limit'}, status=400)
+
+    # Абонира се преди първата проверка, за да не изпусне съобщение между двете
+    subscription = get_broadcast().subscribe(chat_group(chat_id))
+    try:
+        messages = await _get_messages_after(request, chat_id, after, limit)
+        if not messages:
+            try:
+                await asyncio.wait_for(subscription.get(), timeout=wait_timeout)
+            except asyncio.TimeoutError:
+                return JsonResponse([], safe=False)
+            messages = await _get_messages_after(request, chat_id, after, limit)
+    finally:
+        subscription.close()
+
+    return JsonResponse(messages, safe=False, encoder=JSONEncoder)
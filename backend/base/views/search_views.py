@@ -1,153 +1,321 @@
+import json
+import logging
+
+import numpy as np
+
 from rest_framework.views import APIView
 from rest_framework.response import Response
-from rest_framework import permissions
-from django.db.models import Q
-from ..models import MyUser
+from rest_framework import status, permissions
+from django.db import connection
+from django.db.models import Case, Count, Exists, F, IntegerField, OuterRef, Q, Value, When
+from ..models import MyUser, Platform, Language, UserPlatform, UserLanguage, hours_to_mask
+from ..matching import get_feature_matrix, rank_candidates
+from ..pagination import encode_cursor, decode_cursor, InvalidCursor
 from ..serializers import UserSerializer
 
+logger = logging.getLogger(__name__)
+
+# Фасети: параметър на търсенето -> модел на стойностите
+FACETS = {
+    'platforms': Platform,
+    'languages': Language,
+}
+
+
+def split_values(param):
+    """Comma-separated query parameter -> list of non-empty, stripped values"""
+    if not param:
+        return []
+    return [value.strip() for value in param.split(",") if value.strip()]
+
+
+def filter_users(params, skip=()):
+    """
+    Builds the user queryset for the search parameters. Filters named in
+    `skip` are left out (a facet is counted without its own filter).
+    """
+    query = params.get("q", "")
+    
+    # Start with a base queryset
+    users = MyUser.objects.all()
+    
+    # Apply text search if query is provided
+    if query:
+        users = users.filter(
+            Q(username__icontains=query) | 
+            Q(display_name__icontains=query) |
+            Q(bio__icontains=query)
+        )
+    
+    # Filter by platforms
+    # Users who have at least one of the specified platforms - an indexed lookup in UserPlatform
+    platform_list = split_values(params.get("platforms"))
+    if platform_list and 'platforms' not in skip:
+        users = users.filter(Exists(UserPlatform.objects.filter(
+            user=OuterRef('pk'), platform__name__in=platform_list
+        )))
+    
+    # Filter by languages
+    language_list = split_values(params.get("languages"))
+    if language_list and 'languages' not in skip:
+        users = users.filter(Exists(UserLanguage.objects.filter(
+            user=OuterRef('pk'), language__name__in=language_list
+        )))
+    
+    # Filter by active hours
+    # The hours are already in UTC from the frontend and every user keeps their
+    # active hours as a UTC bitmask, so overlap is one bitwise test per row
+    hours_list = split_values(params.get("active_hours"))
+    if hours_list:
+        users = users.alias(
+            hours_overlap=F('active_hours_mask').bitand(hours_to_mask(hours_list))
+        ).filter(hours_overlap__gt=0)
+    
+    # Filter by mic availability
+    mic_available = params.get("mic_available")
+    if mic_available is not None:
+        mic_bool = mic_available.lower() == 'true'
+        users = users.filter(mic_available=mic_bool)
+    
+    # Filter by games
+    games = params.get("games")
+    if games:
+        game_ids = games.split(",")
+        # Find users who play these games
+        users = users.filter(game_stats__game__id__in=game_ids).distinct()
+    
+    # Filter by player goals
+    player_goals = params.get("player_goals")
+    if player_goals:
+        goal_ids = player_goals.split(",")
+        # Find users who have these player goals
+        users = users.filter(game_stats__player_goal__id__in=goal_ids).distinct()
+    
+    # Filter by minimum hours played
+    min_hours_played = params.get("min_hours_played")
+    if min_hours_played:
+        try:
+            min_hours = int(float(min_hours_played))
+            # Find users who have played at least this many hours in any game
+            users = users.filter(game_stats__hours_played__gte=min_hours).distinct()
+        except (ValueError, TypeError):
+            # If conversion fails, ignore this filter
+            pass
+    
+    # Filter by game-specific minimum hours played
+    for param, value in params.items():
+        if param.startswith('min_hours_game_'):
+            try:
+                game_id = param.replace('min_hours_game_', '')
+                min_hours = int(float(value))
+                # Find users who have played at least this many hours in this specific game
+                logger.debug(f"Filtering by game {game_id} with min hours {min_hours}")
+                users = users.filter(
+                    game_stats__game__id=game_id,
+                    game_stats__hours_played__gte=min_hours
+                ).distinct()
+            except (ValueError, TypeError):
+                # If conversion fails, ignore this filter
+                pass
+    
+    # Filter by game-specific goals
+    for param, value in params.items():
+        if param.startswith('goals_game_'):
+            try:
+                game_id = param.replace('goals_game_', '')
+                goal_ids = value.split(',')
+                logger.debug(f"Filtering by game {game_id} with goals {goal_ids}")
+                
+                # Use OR between different goals for the same game
+                # A user matches if they have ANY of the selected goals for this game
+                game_goals_filter = Q()
+                for goal_id in goal_ids:
+                    game_goals_filter |= Q(game_stats__game__id=game_id, game_stats__player_goal__id=goal_id)
+                
+                # This creates an AND between previously filtered users (which may include hours filter)
+                # and the goals filter
+                users = users.filter(game_goals_filter).distinct()
+            except Exception as e:
+                logger.debug(f"Error processing game goals filter: {e}")
+                # If any error occurs, ignore this filter
+                pass
+    
+    return users
+
+
+# Релевантност на потребител спрямо текста на търсенето (по-голямо = по-добро)
+def with_relevance(users, query):
+    """
+    Annotates `relevance`: 4 for an exact username, 3 for a username prefix,
+    2 for a display name prefix, 1 for any other match, 0 without a query.
+    """
+    if not query:
+        return users.annotate(relevance=Value(0, output_field=IntegerField()))
+    return users.annotate(relevance=Case(
+        When(username__iexact=query, then=Value(4)),
+        When(username__istartswith=query, then=Value(3)),
+        When(display_name__istartswith=query, then=Value(2)),
+        default=Value(1),
+        output_field=IntegerField()
+    ))
+
+
+# Брой резултати - точен до `cap`, след това приблизителен
+def estimate_count(users, cap):
+    """
+    Returns (count, exact). Counting stops after `cap` rows; past that
+    PostgreSQL's planner estimate is used, and other databases report `cap`
+    as a lower bound.
+    """
+    counted = users.order_by()[:cap + 1].count()
+    if counted <= cap:
+        return counted, True
+    if connection.vendor == 'postgresql':
+        sql, params = users.order_by().query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute(f"EXPLAIN (FORMAT JSON) {sql}", params)
+            plan = cursor.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return max(int(plan[0]['Plan']['Plan Rows']), counted), False
+    return cap, False
+
+
 class SearchView(APIView):
+    """
+    Търсене на потребители.
+    
+    Query params: the filters of filter_users, plus
+        limit: users per page (default 20, max 100)
+        cursor: next_cursor from the previous page
+        count: "estimate" to include the number of matches (exact up to
+               1000, estimated beyond)
+        order: "match" to rank by teammate compatibility with the signed-in
+               user (base/matching.py); each result gets a match_score.
+               Scores change when the matrix is rebuilt, so a match cursor
+               only works against the build that issued it - after a
+               rebuild it gets a 400 and the client starts from page one
+    
+    Results are ordered by relevance to `q` (or by match score), then by id. With limit, cursor
+    or count the response is {"results", "next_cursor"[, "count",
+    "count_exact"]}; without them it is the plain list of every match,
+    uncapped, as older clients (SearchProfiles.jsx) expect.
+    """
     permission_classes = [permissions.AllowAny]
+    default_limit = 20
+    max_limit = 100
+    count_cap = 1000
 
     def get(self, request, format=None):
-        query = request.query_params.get("q", "")
-        
-        # Start with a base queryset
-        users = MyUser.objects.all()
-        
-        # Apply text search if query is provided
-        if query:
-            users = users.filter(
-                Q(username__icontains=query) | 
-                Q(display_name__icontains=query) |
-                Q(bio__icontains=query)
+        params = request.query_params
+        paged = any(key in params for key in ('limit', 'cursor', 'count'))
+
+        try:
+            limit = min(int(params.get('limit', self.default_limit)), self.max_limit)
+            if limit < 1:
+                raise ValueError
+        except ValueError:
+            return Response({'detail': 'Невалидни параметри за търсене'}, status=status.HTTP_400_BAD_REQUEST)
+
+        by_match = params.get('order') == 'match'
+        if by_match and not request.user.is_authenticated:
+            return Response(
+                {'detail': 'Влезте в профила си, за да подредите по съвместимост'},
+                status=status.HTTP_401_UNAUTHORIZED
             )
-        
-        # Filter by platforms
-        platforms = request.query_params.get("platforms")
-        if platforms:
-            platform_list = platforms.split(",")
-            # Filter users who have at least one of the specified platforms
-            platform_users = []
-            for user in users:
-                if any(platform in user.platforms for platform in platform_list):
-                    platform_users.append(user.id)
-            users = users.filter(id__in=platform_users)
-        
-        # Filter by languages
-        languages = request.query_params.get("languages")
-        if languages:
-            language_list = languages.split(",")
-            # Filter users who have at least one of the specified languages
-            language_users = []
-            for user in users:
-                if any(language in user.language_preference for language in language_list):
-                    language_users.append(user.id)
-            users = users.filter(id__in=language_users)
-        
-        # Filter by active hours
-        active_hours = request.query_params.get("active_hours")
-        if active_hours:
-            hours_list = active_hours.split(",")
-            
-            # The hours are already in UTC from the frontend
-            # We need to convert them to each user's local time for comparison
-            active_users = []
-            
-            for user in users:
-                user_timezone_offset = user.timezone_offset
-                
-                # Convert the requested hours to the user's timezone
-                user_local_hours = []
-                for hour in hours_list:
-                    if hour:  # Skip empty strings
-                        hour_parts = hour.split(':')
-                        if len(hour_parts) == 2:
-                            hour_num = int(hour_parts[0])
-                            minute_str = hour_parts[1]
-                            
-                            # Convert UTC hour to user's local hour
-                            local_hour = (hour_num + user_timezone_offset) % 24
-                            local_hour_str = f"{local_hour:02d}:{minute_str}"
-                            user_local_hours.append(local_hour_str)
-                
-                # Check if any of the user's active hours match the converted search hours
-                if any(hour in user.active_hours for hour in user_local_hours):
-                    active_users.append(user.id)
-            
-            if hours_list:  # Only apply filter if we have valid hours
-                users = users.filter(id__in=active_users)
-        
-        # Filter by mic availability
-        mic_available = request.query_params.get("mic_available")
-        if mic_available is not None:
-            mic_bool = mic_available.lower() == 'true'
-            users = users.filter(mic_available=mic_bool)
-        
-        # Filter by games
-        games = request.query_params.get("games")
-        if games:
-            game_ids = games.split(",")
-            # Find users who play these games
-            users = users.filter(game_stats__game__id__in=game_ids).distinct()
-        
-        # Filter by player goals
-        player_goals = request.query_params.get("player_goals")
-        if player_goals:
-            goal_ids = player_goals.split(",")
-            # Find users who have these player goals
-            users = users.filter(game_stats__player_goal__id__in=goal_ids).distinct()
-        
-        # Filter by minimum hours played
-        min_hours_played = request.query_params.get("min_hours_played")
-        if min_hours_played:
+
+        users = filter_users(params)
+        matrix = None
+        if by_match:
+            users = users.exclude(id=request.user.id)
+            matrix = get_feature_matrix()
+        after = None
+        cursor = params.get('cursor')
+        if cursor:
             try:
-                min_hours = int(float(min_hours_played))
-                # Find users who have played at least this many hours in any game
-                users = users.filter(game_stats__hours_played__gte=min_hours).distinct()
-            except (ValueError, TypeError):
-                # If conversion fails, ignore this filter
-                pass
-        
-        # Filter by game-specific minimum hours played
-        for param, value in request.query_params.items():
-            if param.startswith('min_hours_game_'):
-                try:
-                    game_id = param.replace('min_hours_game_', '')
-                    min_hours = int(float(value))
-                    # Find users who have played at least this many hours in this specific game
-                    print(f"Filtering by game {game_id} with min hours {min_hours}")
-                    users = users.filter(
-                        game_stats__game__id=game_id,
-                        game_stats__hours_played__gte=min_hours
-                    ).distinct()
-                    print(f"Users count after hours filter: {users.count()}")
-                except (ValueError, TypeError):
-                    # If conversion fails, ignore this filter
-                    pass
-        
-        # Filter by game-specific goals
-        for param, value in request.query_params.items():
-            if param.startswith('goals_game_'):
-                try:
-                    game_id = param.replace('goals_game_', '')
-                    goal_ids = value.split(',')
-                    print(f"Filtering by game {game_id} with goals {goal_ids}")
-                    
-                    # Use OR between different goals for the same game
-                    # A user matches if they have ANY of the selected goals for this game
-                    game_goals_filter = Q()
-                    for goal_id in goal_ids:
-                        game_goals_filter |= Q(game_stats__game__id=game_id, game_stats__player_goal__id=goal_id)
-                    
-                    # This creates an AND between previously filtered users (which may include hours filter)
-                    # and the goals filter
-                    users = users.filter(game_goals_filter).distinct()
-                    print(f"Users count after goals filter: {users.count()}")
-                except Exception as e:
-                    print(f"Error processing game goals filter: {e}")
-                    # If any error occurs, ignore this filter
-                    pass
-        
-        # Serialize and return the filtered users
-        serializer = UserSerializer(users, many=True)
-        return Response(serializer.data) 
\ No newline at end of file
+                payload = decode_cursor(cursor)
+                after = (float(payload['m']) if by_match else int(payload['r']), int(payload['id']))
+            except (InvalidCursor, KeyError, TypeError, ValueError):
+                return Response({'detail': 'Невалиден курсор'}, status=status.HTTP_400_BAD_REQUEST)
+            if by_match and payload.get('v') != matrix.version:
+                return Response(
+                    {'detail': 'Подредбата по съвместимост е обновена - заредете първата страница отново'},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+
+        # Старият вид отговор е целият списък; страниците взимат един ред повече за next_cursor
+        fetch = limit + 1 if paged else None
+        # Първо само id-тата на страницата (с ключа на подредбата), после редовете
+        if by_match:
+            hits = self.match_hits(request.user, users, after, fetch, matrix)
+        else:
+            users = with_relevance(users, params.get('q', ''))
+            page = users
+            if after:
+                # Следващите след (релевантност, id) при подредба -relevance, id
+                page = page.filter(Q(relevance__lt=after[0]) | Q(relevance=after[0], id__gt=after[1]))
+            hits = list(page.order_by('-relevance', 'id').values_list('id', 'relevance')[:fetch])
+        has_more = paged and len(hits) > limit
+        if paged:
+            hits = hits[:limit]
+
+        rows = MyUser.objects.filter(id__in=[user_id for user_id, _ in hits]).annotate(
+            followers_total=Count('followers', distinct=True),
+            following_total=Count('following', distinct=True)
+        ).in_bulk()
+        results = UserSerializer([rows[user_id] for user_id, _ in hits if user_id in rows], many=True).data
+        if by_match:
+            scores = dict(hits)
+            for result in results:
+                result['match_score'] = round(scores[result['id']], 4)
+
+        if not paged:
+            return Response(results)
+
+        next_cursor = None
+        if has_more:
+            last_id, last_key = hits[-1]
+            if by_match:
+                next_cursor = encode_cursor({'m': last_key, 'id': last_id, 'v': matrix.version})
+            else:
+                next_cursor = encode_cursor({'r': last_key, 'id': last_id})
+        data = {'results': results, 'next_cursor': next_cursor}
+
+        if params.get('count') == 'estimate':
+            data['count'], data['count_exact'] = estimate_count(users, self.count_cap)
+        return Response(data)
+
+    # Кандидатите, подредени по съвместимост с търсещия
+    def match_hits(self, user, users, after, limit, matrix):
+        """
+        Up to `limit` (user id, match score) pairs after the `after`
+        (score, id) position, best match first; every pair for None.
+        """
+        ids, scores = rank_candidates(user, list(users.values_list('id', flat=True)), matrix=matrix)
+        scores = scores.astype(np.float64)
+        if after:
+            keep = (scores < after[0]) | ((scores == after[0]) & (ids > after[1]))
+            ids, scores = ids[keep], scores[keep]
+        return list(zip(ids[:limit].tolist(), scores[:limit].tolist()))
+
+
+class SearchFacetsView(APIView):
+    """
+    Counts of matching users per platform and per language for the same
+    parameters as SearchView. Each facet ignores its own filter, so the
+    counts show what picking another value would return.
+    """
+    permission_classes = [permissions.AllowAny]
+
+    def get(self, request, format=None):
+        facets = {}
+        for param, model in FACETS.items():
+            users = filter_users(request.query_params, skip=(param,))
+            counts = (
+                model.objects.filter(user_links__user__in=users.values('pk'))
+                .annotate(count=Count('user_links'))
+                .order_by('-count', 'name')
+                .values('name', 'count')
+            )
+            facets[param] = list(counts)
+        return Response(facets)
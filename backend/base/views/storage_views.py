@@ -0,0 +1,24 @@
+from rest_framework.views import APIView
+from rest_framework.response import Response
+from rest_framework import permissions, status
+import logging
+
+from backend.storage_backends import get_s3_metrics
+
+logger = logging.getLogger(__name__)
+
+
+class StorageMetricsView(APIView):
+    """Connection pool and call counters of the shared S3 client (admins only)"""
+    permission_classes = [permissions.IsAdminUser]
+
+    # Връща статистиката за S3 клиента на текущия процес
+    def get(self, request):
+        try:
+            return Response(get_s3_metrics())
+        except Exception as e:
+            logger.error(f"Error reading S3 metrics: {str(e)}")
+            return Response(
+                {"detail": "Грешка при извличане на статистиката"},
+                status=status.HTTP_500_INTERNAL_SERVER_ERROR
+            )
@@ -3,6 +3,7 @@ from rest_framework.response import Response
 from rest_framework import status, permissions
 from rest_framework.parsers import MultiPartParser, FormParser
 from ..models import MyUser
+from ..media_files import release_on_commit
 from ..serializers import (
     UserSerializer,
     FollowSerializer,
@@ -139,12 +140,12 @@ class UpdateProfileView(APIView):
             logger.error(f"Avatar upload - Headers: {dict(request.headers)}")
 
             # Handle avatar upload
+            old_avatar = None
             if 'avatar' in request.FILES:
                 logger.error(f"Avatar found in request.FILES - Name: {request.FILES['avatar'].name}, Size: {request.FILES['avatar'].size}")
                 try:
-                    if user.avatar:
-                        logger.error(f"Deleting existing avatar: {user.avatar.name}")
-                        user.avatar.delete(save=False)
+                    # Старият файл се освобождава едва след успешен запис на новия
+                    old_avatar = user.avatar if user.avatar else None
                     user.avatar = request.FILES['avatar']
                     logger.error(f"Avatar assigned to user model: {user.avatar.name}")
                 except Exception as e:
@@ -157,6 +158,9 @@ class UpdateProfileView(APIView):
             try:
                 user.full_clean()
                 user.save()
+                if old_avatar is not None:
+                    logger.error(f"Releasing previous avatar: {old_avatar.name}")
+                    release_on_commit(old_avatar)
                 logger.error(f"User saved successfully. Avatar URL: {user.avatar.url if user.avatar else 'None'}")
                 serializer = UserSerializer(user)
                 return Response(serializer.data)
@@ -214,13 +218,12 @@ class UploadAvatarView(APIView):
         if not serializer.is_valid():
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
-        # Delete old avatar if it exists
-        if request.user.avatar:
-            request.user.avatar.delete(save=False)
-
-        # Save new avatar
+        # Save new avatar, then release the old one
+        old_avatar = request.user.avatar if request.user.avatar else None
         request.user.avatar = serializer.validated_data['avatar']
         request.user.save()
+        if old_avatar is not None:
+            release_on_commit(old_avatar)
 
         return Response({
             "detail": "Аватарът е актуализиран успешно",
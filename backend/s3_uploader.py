@@ -1,31 +1,26 @@
 import os
-import boto3
+import json
+import time
+import hashlib
 import logging
+import argparse
+import mimetypes
+import threading
 import django
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 from botocore.exceptions import ClientError
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s'
-)
 logger = logging.getLogger(__name__)
 
-# Configure Django to access settings
+# Настройките се четат при първо използване; django.setup() и логването се пускат в main(),
+# за да може модулът да се импортира (напр. от тестовете) без странични ефекти
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
-django.setup()
 
 from django.conf import settings
 
-def get_s3_client():
-    """Create an S3 client with proper credentials"""
-    return boto3.client(
-        's3',
-        aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
-        aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
-        region_name=settings.AWS_S3_REGION_NAME
-    )
+# Същият пулиран клиент като в приложението
+from backend.storage_backends import get_s3_client, get_transfer_config
 
 def test_s3_connection():
     """Test S3 connection and bucket access"""
@@ -49,6 +44,10 @@ def test_s3_connection():
         logger.error(f"S3 connection error: {str(e)}")
         return False
 
+def guess_content_type(filename):
+    """Content type for an upload based on the file extension"""
+    return mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+
 def upload_file_to_s3(local_path, s3_key):
     """Upload a single file to S3 with proper content type detection"""
     try:
@@ -57,18 +56,6 @@ def upload_file_to_s3(local_path, s3_key):
             return False
             
         s3 = get_s3_client()
-        filename = os.path.basename(local_path)
-        
-        # Determine content type based on file extension
-        content_type = 'application/octet-stream'
-        if filename.lower().endswith(('.jpg', '.jpeg')):
-            content_type = 'image/jpeg'
-        elif filename.lower().endswith('.png'):
-            content_type = 'image/png'
-        elif filename.lower().endswith('.gif'):
-            content_type = 'image/gif'
-        elif filename.lower().endswith('.webp'):
-            content_type = 'image/webp'
         
         # Upload file to S3
         with open(local_path, 'rb') as file_data:
@@ -77,8 +64,9 @@ def upload_file_to_s3(local_path, s3_key):
                 settings.AWS_STORAGE_BUCKET_NAME,
                 s3_key,
                 ExtraArgs={
-                    'ContentType': content_type
-                }
+                    'ContentType': guess_content_type(local_path)
+                },
+                Config=get_transfer_config()
             )
         
         logger.info(f"Successfully uploaded: {local_path} -> s3://{settings.AWS_STORAGE_BUCKET_NAME}/{s3_key}")
@@ -88,15 +76,103 @@ def upload_file_to_s3(local_path, s3_key):
         logger.error(f"Error uploading {local_path}: {str(e)}")
         return False
 
-def upload_directory_to_s3(local_dir, s3_prefix):
-    """Upload all files in a directory to S3"""
-    if not os.path.exists(local_dir):
-        logger.error(f"Directory not found: {local_dir}")
-        return 0
-        
-    count = 0
-    errors = 0
-    
+def local_etag(local_path, size):
+    """
+    ETag S3 gives the file when it is uploaded with the shared transfer
+    config: the MD5 of the content, or for multipart uploads the MD5 of the
+    part MD5s followed by "-<number of parts>".
+    """
+    config = get_transfer_config()
+    whole = hashlib.md5()
+    parts = []
+    with open(local_path, 'rb') as fh:
+        while True:
+            chunk = fh.read(config.multipart_chunksize)
+            if not chunk:
+                break
+            whole.update(chunk)
+            parts.append(hashlib.md5(chunk).digest())
+    if size < config.multipart_threshold:
+        return whole.hexdigest()
+    return f"{hashlib.md5(b''.join(parts)).hexdigest()}-{len(parts)}"
+
+def remote_object(s3_key):
+    """(size, etag) of an object in the bucket, or None if it isn't there"""
+    try:
+        response = get_s3_client().head_object(Bucket=settings.AWS_STORAGE_BUCKET_NAME, Key=s3_key)
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+            return None
+        raise
+    return response['ContentLength'], response.get('ETag', '').strip('"')
+
+class UploadManifest:
+    """
+    Keys already migrated, one JSON line per file with its size and mtime.
+    Appending a line after every upload makes an interrupted run resumable:
+    the next run skips those files without asking S3 about them.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.lock = threading.Lock()
+        if path and os.path.exists(path):
+            with open(path, encoding='utf-8') as fh:
+                for line in fh:
+                    try:
+                        entry = json.loads(line)
+                        self.entries[entry['key']] = entry
+                    except (ValueError, KeyError):
+                        # Недовършен ред от прекъснато изпълнение
+                        continue
+
+    def is_done(self, s3_key, size, mtime):
+        entry = self.entries.get(s3_key)
+        return entry is not None and entry['size'] == size and entry['mtime'] == mtime
+
+    def record(self, s3_key, size, mtime, etag):
+        entry = {'key': s3_key, 'size': size, 'mtime': mtime, 'etag': etag}
+        with self.lock:
+            self.entries[s3_key] = entry
+            if self.path:
+                with open(self.path, 'a', encoding='utf-8') as fh:
+                    fh.write(json.dumps(entry) + '\n')
+
+class MigrationProgress:
+    """Thread-safe counters with a log line every few seconds"""
+
+    def __init__(self, total_files, total_bytes, interval=5):
+        self.total_files = total_files
+        self.total_bytes = total_bytes
+        self.interval = interval
+        self.started = time.monotonic()
+        self.last_report = self.started
+        self.counts = {'uploaded': 0, 'skipped': 0, 'failed': 0}
+        self.bytes_done = 0
+        self.lock = threading.Lock()
+
+    def add(self, outcome, size):
+        with self.lock:
+            self.counts[outcome] += 1
+            self.bytes_done += size
+            now = time.monotonic()
+            if now - self.last_report >= self.interval:
+                self.last_report = now
+                self.report()
+
+    def report(self):
+        done = sum(self.counts.values())
+        elapsed = max(time.monotonic() - self.started, 0.001)
+        logger.info(
+            f"Progress: {done}/{self.total_files} files, "
+            f"{self.bytes_done / (1024 * 1024):.1f}/{self.total_bytes / (1024 * 1024):.1f} MB, "
+            f"{self.bytes_done / (1024 * 1024) / elapsed:.1f} MB/s "
+            f"(uploaded {self.counts['uploaded']}, skipped {self.counts['skipped']}, failed {self.counts['failed']})"
+        )
+
+def collect_files(local_dir, s3_prefix):
+    """(local_path, s3_key) for every file under local_dir, keeping the directory structure"""
     for root, dirs, files in os.walk(local_dir):
         for filename in files:
             # Skip hidden files and temporary files
@@ -107,17 +183,75 @@ def upload_directory_to_s3(local_dir, s3_prefix):
             # Create S3 key preserving directory structure
             rel_path = os.path.relpath(local_path, local_dir)
             s3_key = f"{s3_prefix}/{rel_path}".replace('\\', '/')
-            
-            if upload_file_to_s3(local_path, s3_key):
-                count += 1
-            else:
-                errors += 1
+            yield local_path, s3_key
+
+def migrate_file(local_path, s3_key, manifest, dry_run=False):
+    """
+    Uploads one file unless it is already in the manifest or the bucket
+    already has an object with the same size and ETag. Returns
+    ('uploaded' | 'skipped', size).
+    """
+    stat = os.stat(local_path)
+    size, mtime = stat.st_size, int(stat.st_mtime)
+    if manifest.is_done(s3_key, size, mtime):
+        return 'skipped', size
+
+    remote = remote_object(s3_key)
+    if remote is not None and remote[0] == size:
+        etag = local_etag(local_path, size)
+        if remote[1] == etag:
+            if not dry_run:
+                manifest.record(s3_key, size, mtime, etag)
+            return 'skipped', size
+
+    if dry_run:
+        logger.info(f"[dry run] Would upload {local_path} -> s3://{settings.AWS_STORAGE_BUCKET_NAME}/{s3_key}")
+        return 'uploaded', size
+
+    if not upload_file_to_s3(local_path, s3_key):
+        raise RuntimeError(f"Upload failed for {local_path}")
+    manifest.record(s3_key, size, mtime, None)
+    return 'uploaded', size
+
+def migrate_files(files, manifest, workers=8, dry_run=False):
+    """Migrates (local_path, s3_key) pairs on a thread pool and returns the outcome counts"""
+    files = list(files)
+    total_bytes = sum(os.path.getsize(path) for path, key in files)
+    progress = MigrationProgress(len(files), total_bytes)
+
+    # Клиентът е общ за нишките; пулът му от връзки е достатъчен за workers * max_concurrency
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(migrate_file, path, key, manifest, dry_run): (path, key)
+            for path, key in files
+        }
+        for future in as_completed(futures):
+            path, key = futures[future]
+            try:
+                outcome, size = future.result()
+            except Exception as e:
+                logger.error(f"Error migrating {path}: {str(e)}")
+                outcome, size = 'failed', 0
+            progress.add(outcome, size)
+
+    progress.report()
+    return progress.counts
+
+def upload_directory_to_s3(local_dir, s3_prefix, workers=8, manifest=None, dry_run=False):
+    """Upload all files in a directory to S3"""
+    if not os.path.exists(local_dir):
+        logger.error(f"Directory not found: {local_dir}")
+        return 0
+    
+    if manifest is None:
+        manifest = UploadManifest(None)
+    counts = migrate_files(collect_files(local_dir, s3_prefix), manifest, workers, dry_run)
     
     logger.info(f"Directory upload complete: {local_dir} -> s3://{settings.AWS_STORAGE_BUCKET_NAME}/{s3_prefix}")
-    logger.info(f"Uploaded: {count} files, Errors: {errors}")
-    return count
+    logger.info(f"Uploaded: {counts['uploaded']} files, Skipped: {counts['skipped']}, Errors: {counts['failed']}")
+    return counts['uploaded']
 
-def upload_all_media():
+def upload_all_media(workers=8, manifest_path=None, dry_run=False):
     """Upload all media directories to S3"""
     logger.info("===== S3 MEDIA UPLOADER =====")
     logger.info(f"AWS Region: {settings.AWS_S3_REGION_NAME}")
@@ -134,9 +268,6 @@ def upload_all_media():
         logger.error("S3 connection failed. Check your credentials and bucket.")
         return False
     
-    # Upload each media directory separately
-    total_uploaded = 0
-    
     # Also handle the root level media directories
     media_dirs = [
         ('media', 'media'),
@@ -145,25 +276,50 @@ def upload_all_media():
         ('profile_pics', 'media/profile_pics')
     ]
     
-    # Upload files from each directory
+    # Всички файлове се събират в един списък, за да ги обработва един общ пул от нишки
+    files = {}
     for local_dir_name, s3_prefix in media_dirs:
         local_dir = os.path.join('Q-up', 'backend', local_dir_name)
         if os.path.exists(local_dir):
-            logger.info(f"Uploading files from {local_dir} to {s3_prefix}")
-            count = upload_directory_to_s3(local_dir, s3_prefix)
-            total_uploaded += count
+            logger.info(f"Collecting files from {local_dir} for {s3_prefix}")
+            files.update((key, path) for path, key in collect_files(local_dir, s3_prefix))
     
     # Upload from media subdirectories
     for subdir in os.listdir(settings.MEDIA_ROOT):
         subdir_path = os.path.join(settings.MEDIA_ROOT, subdir)
         if os.path.isdir(subdir_path):
             s3_prefix = f"media/{subdir}"
-            logger.info(f"Uploading files from {subdir_path} to {s3_prefix}")
-            count = upload_directory_to_s3(subdir_path, s3_prefix)
-            total_uploaded += count
+            logger.info(f"Collecting files from {subdir_path} for {s3_prefix}")
+            files.update((key, path) for path, key in collect_files(subdir_path, s3_prefix))
+    
+    manifest = UploadManifest(manifest_path)
+    logger.info(
+        f"{len(files)} files to check, {len(manifest.entries)} already in the manifest, "
+        f"{workers} workers{' (dry run)' if dry_run else ''}"
+    )
+    counts = migrate_files(((path, key) for key, path in files.items()), manifest, workers, dry_run)
     
-    logger.info(f"Total files uploaded: {total_uploaded}")
-    return True
+    logger.info(f"Total files uploaded: {counts['uploaded']}, skipped: {counts['skipped']}, failed: {counts['failed']}")
+    return counts['failed'] == 0
+
+def main():
+    # Configure logging
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s'
+    )
+    # Configure Django to access settings
+    django.setup()
+
+    parser = argparse.ArgumentParser(description='Migrate local media files to the S3 bucket')
+    parser.add_argument('--workers', type=int, default=8, help='Files uploaded in parallel (default: 8)')
+    parser.add_argument(
+        '--manifest', default='s3_upload_manifest.jsonl',
+        help='File recording migrated keys so reruns can resume (default: s3_upload_manifest.jsonl)'
+    )
+    parser.add_argument('--dry-run', action='store_true', help='Only report what would be uploaded')
+    args = parser.parse_args()
+    upload_all_media(workers=args.workers, manifest_path=args.manifest, dry_run=args.dry_run)
 
 if __name__ == "__main__":
-    upload_all_media() 
\ No newline at end of file
+    main()
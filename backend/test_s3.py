@@ -1,5 +1,4 @@
 import os
-import boto3
 import io
 import django
 import logging
@@ -20,17 +19,13 @@ os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
 django.setup()
 
 from django.conf import settings
+from backend.storage_backends import get_s3_client
 
 def test_s3_connection():
     """Test basic S3 connection by listing buckets"""
     try:
         logger.info("Testing S3 connection...")
-        s3 = boto3.client(
-            's3',
-            aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
-            aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
-            region_name=settings.AWS_S3_REGION_NAME,
-        )
+        s3 = get_s3_client()
         
         # List buckets to verify credentials
         response = s3.list_buckets()
@@ -53,12 +48,7 @@ def test_direct_upload():
     """Test direct upload to S3 without ACL permissions"""
     try:
         logger.info("Testing direct upload to S3...")
-        s3 = boto3.client(
-            's3',
-            aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
-            aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
-            region_name=settings.AWS_S3_REGION_NAME,
-        )
+        s3 = get_s3_client()
         
         # Create a test content to upload
         test_content = b"This is a test upload to verify S3 permissions"
@@ -105,12 +95,7 @@ def test_image_upload():
         
         image_file = io.BytesIO(png_data)
         
-        s3 = boto3.client(
-            's3',
-            aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
-            aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
-            region_name=settings.AWS_S3_REGION_NAME,
-        )
+        s3 = get_s3_client()
         
         # Test key for the image
         test_key = f"media/test/test_image_{os.urandom(4).hex()}.png"
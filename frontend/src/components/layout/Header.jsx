@@ -80,12 +80,11 @@ const Header = () => {
    */
   const checkUnreadMessages = async () => {
     try {
-      const response = await API.get('/chats/');
-      const chats = response.data;
+      // Лек endpoint само с броячите - браузърът го проверява с ETag
+      const response = await API.get('/chats/unread/');
       
-      // Проверка дали някой чат има непрочетени съобщения
-      const hasUnread = chats.some(chat => chat.unread_count > 0);
-      setHasUnreadMessages(hasUnread);
+      // Проверка дали има непрочетени съобщения
+      setHasUnreadMessages(response.data.total > 0);
     } catch (error) {
       console.error('Error checking unread messages:', error);
     }